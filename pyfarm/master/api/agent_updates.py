@@ -22,19 +22,26 @@ The API allows access to agent update packages, possibly through redirects
 """
 import re
 import tempfile
-from os import makedirs
+from hashlib import sha256
+from os import makedirs, remove, rename, stat
 from os.path import join, isfile
 from errno import EEXIST
+from threading import Lock
 
 try:
-    from httplib import BAD_REQUEST, CREATED, NOT_FOUND
+    from httplib import (
+        OK, BAD_REQUEST, CREATED, NOT_FOUND, NOT_MODIFIED, PARTIAL_CONTENT,
+        REQUESTED_RANGE_NOT_SATISFIABLE)
 except ImportError:  # pragma: no cover
-    from http.client import BAD_REQUEST, CREATED, NOT_FOUND
+    from http.client import (
+        OK, BAD_REQUEST, CREATED, NOT_FOUND, NOT_MODIFIED, PARTIAL_CONTENT,
+        REQUESTED_RANGE_NOT_SATISFIABLE)
 
 from flask.views import MethodView
-from flask import request, redirect, send_file
+from flask import Response, request, redirect
 
 from pyfarm.core.logger import getLogger
+from pyfarm.master.application import request_body
 from pyfarm.master.config import config
 from pyfarm.master.utility import jsonify
 
@@ -45,6 +52,16 @@ VERSION_REGEX = re.compile("\d+(\.\d+(\.\d+)?)?((-pre\d?)|(-dev\d?)|(-rc?\d?)|"
 
 UPDATES_DIR = config.get("agent_updates_dir")
 UPDATES_WEBDIR = config.get("agent_updates_webdir")
+UPDATES_SENDFILE = config.get("agent_updates_sendfile")
+UPDATES_ACCEL_PREFIX = config.get("agent_updates_accel_prefix")
+
+# The number of bytes read or written at once when transferring updates
+CHUNK_SIZE = 65536
+
+# Maps the path of each update file to a tuple of
+# ``(inode, mtime, size, sha256)``
+_checksums = {}
+_checksums_lock = Lock()
 
 
 try:
@@ -54,7 +71,44 @@ except OSError as e:  # pragma: no cover
         raise
 
 
+def file_checksum(path):
+    """
+    Returns the sha256 checksum of the file at ``path``.  The checksum is
+    only calculated again if the file was modified since the last call.
+    """
+    stat_result = stat(path)
+    key = (stat_result.st_ino, stat_result.st_mtime, stat_result.st_size)
+    with _checksums_lock:
+        cached = _checksums.get(path)
+    if cached is not None and cached[:3] == key:
+        return cached[3]
+
+    checksum = sha256()
+    with open(path, "rb") as update_file:
+        for chunk in iter(lambda: update_file.read(CHUNK_SIZE), b""):
+            checksum.update(chunk)
+
+    checksum = checksum.hexdigest()
+    with _checksums_lock:
+        _checksums[path] = key + (checksum, )
+    return checksum
+
+
+def read_file(path, start, stop):
+    """Yields the bytes from ``start`` up to ``stop`` of the file at ``path``"""
+    with open(path, "rb") as update_file:
+        update_file.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = update_file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
 class AgentUpdatesAPI(MethodView):
+    @request_body(max_size=None, parse_json=False)
     def put(self, version):
         """
         A ``PUT`` to this endpoint will upload a new version of pyfarm-agent to
@@ -68,6 +122,7 @@ class AgentUpdatesAPI(MethodView):
 
                 PUT /api/v1/agents/updates/1.2.3 HTTP/1.1
                 Content-Type: application/zip
+                X-Checksum-SHA256: 8d2f6b...
 
                 <binary data>
 
@@ -78,10 +133,15 @@ class AgentUpdatesAPI(MethodView):
                 HTTP/1.1 200 OK
                 Content-Type: application/json
 
+        The upload is streamed to disk and only replaces an existing update
+        of the same version once it has been received completely.  If the
+        optional ``X-Checksum-SHA256`` header is sent the upload is rejected
+        unless its checksum matches.
+
         :statuscode 201: The update was put in place
         :statuscode 400: there was something wrong with the request (such as an
-                         invalid version number specified or the  mime type not
-                         being application/zip)
+                         invalid version number specified, the  mime type not
+                         being application/zip or a checksum mismatch)
         """
         if request.mimetype != "application/zip":
             return (jsonify(error="Data for agent updates must be "
@@ -91,9 +151,38 @@ class AgentUpdatesAPI(MethodView):
                     BAD_REQUEST)
 
         path = join(UPDATES_DIR, "pyfarm-agent-%s.zip" % version)
-        with open(path, "wb+") as zip_file:
-            zip_file.write(request.data)
-
+        checksum = sha256()
+        with tempfile.NamedTemporaryFile(
+                dir=UPDATES_DIR, prefix=".upload-", delete=False) as temp_file:
+            try:
+                for chunk in iter(
+                        lambda: request.stream.read(CHUNK_SIZE), b""):
+                    checksum.update(chunk)
+                    temp_file.write(chunk)
+            except Exception:
+                # Such as the client disconnecting, the partial upload
+                # should not be left behind
+                logger.error("Failed to receive update %s", version)
+                temp_file.close()
+                remove(temp_file.name)
+                raise
+
+        expected_checksum = request.headers.get("X-Checksum-SHA256")
+        if (expected_checksum is not None and
+                expected_checksum.lower() != checksum.hexdigest()):
+            remove(temp_file.name)
+            return (jsonify(error="Checksum of the update does not match "
+                                  "X-Checksum-SHA256"), BAD_REQUEST)
+
+        try:
+            rename(temp_file.name, path)
+        except OSError:  # pragma: no cover
+            # Windows does not replace existing files on rename
+            remove(path)
+            rename(temp_file.name, path)
+
+        logger.info("Received update %s with checksum %s", version,
+                    checksum.hexdigest())
         return "", CREATED
 
     def get(self, version):
@@ -116,14 +205,26 @@ class AgentUpdatesAPI(MethodView):
 
                 HTTP/1.1 200 OK
                 Content-Type: application/zip
+                ETag: "8d2f6b..."
+                X-Checksum-SHA256: 8d2f6b...
+                Accept-Ranges: bytes
 
                 <binary data>
 
+        Interrupted downloads can be resumed with a ``Range`` header.  When
+        ``agent_updates_sendfile`` is set the file itself is sent by the
+        web server in front of the master through ``X-Sendfile`` or
+        ``X-Accel-Redirect``.
+
         :statuscode 200: The update file was found and is returned
+        :statuscode 206: The requested range of the update file is returned
         :statuscode 301: The update can be found under a different URL
+        :statuscode 304: The update matches the ``ETag`` sent in
+                         ``If-None-Match``
         :statuscode 400: there was something wrong with the request (such as an
                          invalid version number specified or the  mime type not
                          being application/zip)
+        :statuscode 416: The requested range is outside of the update file
         """
         if not VERSION_REGEX.match(version):
             return (jsonify(error="Version is not an acceptable version number"),
@@ -137,4 +238,45 @@ class AgentUpdatesAPI(MethodView):
         if not isfile(update_file):
             return (jsonify(error="Specified update not found"), NOT_FOUND)
 
-        return send_file(update_file)
+        checksum = file_checksum(update_file)
+        size = stat(update_file).st_size
+        response = Response(mimetype="application/zip")
+        response.set_etag(checksum)
+        response.headers["X-Checksum-SHA256"] = checksum
+        response.headers["Accept-Ranges"] = "bytes"
+
+        if request.if_none_match.contains(checksum):
+            response.status_code = NOT_MODIFIED
+            return response
+
+        if UPDATES_SENDFILE == "x-sendfile":
+            response.headers["X-Sendfile"] = update_file
+            return response
+        elif UPDATES_SENDFILE == "x-accel-redirect":
+            response.headers["X-Accel-Redirect"] = (
+                UPDATES_ACCEL_PREFIX.rstrip("/") + "/" + filename)
+            return response
+
+        start, stop = 0, size
+        if (request.range is not None and
+                len(request.range.ranges) == 1 and
+                request.range.units == "bytes" and
+                (request.if_range.etag is None or
+                 request.if_range.etag == checksum)):
+            requested_range = request.range.range_for_length(size)
+            if requested_range is None:
+                response.status_code = REQUESTED_RANGE_NOT_SATISFIABLE
+                response.headers["Content-Range"] = "bytes */%s" % size
+                return response
+
+            start, stop = requested_range
+            response.status_code = PARTIAL_CONTENT
+            response.headers["Content-Range"] = "bytes %s-%s/%s" % (
+                start, stop - 1, size)
+        else:
+            response.status_code = OK
+
+        response.response = read_file(update_file, start, stop)
+        response.direct_passthrough = True
+        response.content_length = stop - start
+        return response
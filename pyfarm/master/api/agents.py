@@ -45,7 +45,8 @@ from sqlalchemy import or_, not_
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState, AgentState, _AgentState, STRING_TYPES
 from pyfarm.scheduler.tasks import (
-    assign_tasks, update_agent, assign_tasks_to_agent, send_tasks_to_agent)
+    assign_tasks, dispatch_agent_updates, assign_tasks_to_agent,
+    send_tasks_to_agent)
 from pyfarm.models.agent import (
     Agent, AgentMacAddress, AgentSoftwareVersionAssociation)
 from pyfarm.models.gpu import GPU
@@ -54,7 +55,8 @@ from pyfarm.models.software import Software, SoftwareVersion
 from pyfarm.master.config import config
 from pyfarm.models.tag import Tag
 from pyfarm.models.disk import AgentDisk
-from pyfarm.master.application import db
+from pyfarm.master.application import (
+    db, request_body, MAX_BULK_REQUEST_SIZE)
 from pyfarm.master.utility import (
     jsonify, validate_with_model, get_ipaddr_argument, get_integer_argument,
     get_hostname_argument, get_port_argument, isuuid)
@@ -138,6 +140,7 @@ def schema():
 
 
 class AgentIndexAPI(MethodView):
+    @request_body(max_size=MAX_BULK_REQUEST_SIZE)
     @validate_with_model(Agent, ignore=("current_assignments", "id",
                                         "farm_name"))
     def post(self):
@@ -423,7 +426,7 @@ class AgentIndexAPI(MethodView):
                     agent_data = agent.to_dict(unpack_relationships=["tags"])
                     logger.info("Updated agent %r: %r", agent.id, agent_data)
                     for task in failed_tasks:
-                        task.job.update_state()
+                        task.job.update_state(new_task_state=task.state)
                     db.session.commit()
                     assign_tasks.delay()
                     return jsonify(agent_data), OK
@@ -627,6 +630,7 @@ class SingleAgentAPI(MethodView):
         else:
             return jsonify(error="Agent %s not found" % agent_id), NOT_FOUND
 
+    @request_body(max_size=MAX_BULK_REQUEST_SIZE)
     @validate_with_model(
         Agent,
         type_checks={"id": isuuid},
@@ -734,7 +738,7 @@ class SingleAgentAPI(MethodView):
         agent.last_heard_from = datetime.utcnow()
 
         if "upgrade_to" in modified:
-            update_agent.delay(agent.id)
+            agent.update_requested = None
 
         if mac_addresses is not None:
             modified["mac_addresses"] = mac_addresses
@@ -813,16 +817,16 @@ class SingleAgentAPI(MethodView):
         db.session.commit()
 
         for task in failed_tasks:
-            task.job.update_state()
+            task.job.update_state(new_task_state=task.state)
+        requeued_job_ids = []
         if agent.state == _AgentState.OFFLINE:
-            for task in agent.tasks.filter(Task.state != WorkState.DONE,
-                                           Task.state != WorkState.FAILED):
-                task.agent = None
-                task.state = None
-                task.job.update_state()
-                db.session.add(task)
+            requeued_job_ids = agent.requeue_tasks()
         db.session.commit()
 
+        if requeued_job_ids:
+            assign_tasks.delay()
+        if "upgrade_to" in modified:
+            dispatch_agent_updates.delay()
         assign_tasks_to_agent.delay(agent_id)
 
         return jsonify(agent.to_dict(unpack_relationships=["tags"])), OK
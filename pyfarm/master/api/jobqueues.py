@@ -310,14 +310,8 @@ class SingleJobQueueAPI(MethodView):
         if g.json:
             return jsonify(error="Unkown columns: %s" % g.json), BAD_REQUEST
 
-        # It is possible for a call to this to change a queue's name
-        db.session.add(jobqueue)
-        db.session.flush()
-        jobqueue.fullpath = jobqueue.path()
-        for childqueue in jobqueue.children:
-            childqueue.fullpath = childqueue.path()
-            db.session.add(childqueue)
-
+        # It is possible for a call to this to change a queue's name, the
+        # paths of the queue and all queues below it are updated on flush
         db.session.add(jobqueue)
         db.session.commit()
 
@@ -23,7 +23,6 @@ This module defines an API for managing and querying jobs
 """
 
 from decimal import Decimal
-from json import loads
 from datetime import datetime
 
 try:
@@ -37,9 +36,11 @@ from flask.views import MethodView
 from flask import g, request
 
 from sqlalchemy.sql import func, or_
+from sqlalchemy.orm import undefer_group
 
 from pyfarm.core.logger import getLogger
-from pyfarm.core.enums import STRING_TYPES, NUMERIC_TYPES, WorkState, _WorkState
+from pyfarm.core.enums import (
+    NOTSET, STRING_TYPES, NUMERIC_TYPES, WorkState, _WorkState)
 from pyfarm.scheduler.tasks import (
     assign_tasks_to_agent, assign_tasks, delete_job)
 from pyfarm.models.statistics.task_event_count import TaskEventCount
@@ -52,13 +53,25 @@ from pyfarm.models.software import (
 from pyfarm.models.tag import Tag, JobTagRequirement
 from pyfarm.models.jobqueue import JobQueue
 from pyfarm.models.agent import Agent
-from pyfarm.master.application import db
+from pyfarm.master.application import (
+    db, request_body, MAX_BULK_REQUEST_SIZE)
 from pyfarm.master.utility import (
     jsonify, validate_with_model, get_request_argument)
 from pyfarm.master.config import config
 
 RANGE_TYPES = NUMERIC_TYPES[:-1] + (Decimal, )
 
+
+def to_decimal(value):
+    """
+    Converts a frame number from the request's json to a :class:`Decimal`.
+    Floats are converted through their shortest representation, so ``0.1``
+    becomes ``Decimal("0.1")`` instead of its binary approximation.
+    """
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
+
 try:
   # pylint: disable=undefined-variable
   range_ = xrange
@@ -220,6 +233,7 @@ def schema():
 
 
 class JobIndexAPI(MethodView):
+    @request_body(max_size=MAX_BULK_REQUEST_SIZE)
     @validate_with_model(Job,
                          type_checks={"by": lambda x: isinstance(
                              x, RANGE_TYPES)},
@@ -399,8 +413,8 @@ class JobIndexAPI(MethodView):
         notified_usernames = g.json.pop("notified_users", None)
         tag_requirements = g.json.pop("tag_requirements", None)
 
-        g.json.pop("start", None)
-        g.json.pop("end", None)
+        start = g.json.pop("start", NOTSET)
+        end = g.json.pop("end", NOTSET)
         job = Job(**g.json)
         job.jobtype_version = jobtype_version
         job.software_requirements = software_requirements
@@ -447,25 +461,29 @@ class JobIndexAPI(MethodView):
                     tag_requirement.negate = True
                 db.session.add(tag_requirement)
 
-        custom_json = loads(request.data.decode(), parse_float=Decimal)
-        if "end" in custom_json and "start" not in custom_json:
+        if end is not NOTSET and start is NOTSET:
             return (jsonify(error="`end` is specified while `start` is not"),
                     BAD_REQUEST)
-        start = custom_json.get("start", Decimal("1.0"))
-        end = custom_json.get("end", start)
+        if start is NOTSET:
+            start = Decimal("1.0")
+        if end is NOTSET:
+            end = start
         if (not isinstance(start, RANGE_TYPES) or
             not isinstance(end, RANGE_TYPES)):
             return (jsonify(error="`start` and `end` need to be of type decimal "
                                     "or int"), BAD_REQUEST)
+        start = to_decimal(start)
+        end = to_decimal(end)
 
         if not end >= start:
             return (jsonify(error="`end` must be larger than or equal to start"),
                     BAD_REQUEST)
 
-        by = custom_json.pop("by", Decimal("1.0"))
+        by = g.json.get("by", Decimal("1.0"))
         if not isinstance(by, RANGE_TYPES):
             return (jsonify(error="`by` needs to be of type decimal or int"),
                     BAD_REQUEST)
+        by = to_decimal(by)
 
         num_tiles = g.json.get("num_tiles", None)
         if not jobtype_version.supports_tiling and num_tiles is not None:
@@ -678,10 +696,11 @@ class SingleJobAPI(MethodView):
         :statuscode 200: no error
         :statuscode 404: job not found
         """
+        query = Job.query.options(undefer_group("payload"))
         if isinstance(job_name, STRING_TYPES):
-            job = Job.query.filter_by(title=job_name).first()
+            job = query.filter_by(title=job_name).first()
         else:
-            job = Job.query.filter_by(id=job_name).first()
+            job = query.filter_by(id=job_name).first()
 
         if not job:
             return jsonify(error="Job not found"), NOT_FOUND
@@ -828,10 +847,9 @@ class SingleJobAPI(MethodView):
         end = old_last_task.frame
 
         if "start" in g.json or "end" in g.json or "by" in g.json:
-            json = loads(request.data.decode(), parse_float=Decimal)
-            start = Decimal(json.pop("start", old_first_task.frame))
-            end = Decimal(json.pop("end", old_last_task.frame))
-            by = Decimal(json.pop("by", job.by))
+            start = to_decimal(g.json.get("start", old_first_task.frame))
+            end = to_decimal(g.json.get("end", old_last_task.frame))
+            by = to_decimal(g.json.get("by", job.by))
 
             try:
                 job.alter_frame_range(start, end, by)
@@ -1260,12 +1278,11 @@ class JobSingleTaskAPI(MethodView):
         # This needs to be done after the transaction in which the task state
         # was set has committed, so that the new transaction will see the results
         # of other threads that were running concurrently but finished earlier.
+        # Children unblocked by the job finishing trigger the assignment of
+        # tasks once this commits, see Job.after_commit()
         if task.job and state_transition:
-            old_state = task.job.state
-            task.job.update_state()
+            task.job.update_state(new_task_state=task.state)
             db.session.commit()
-            if task.job.state != old_state and task.job.state == WorkState.DONE:
-                assign_tasks.delay()
 
         if config.get("enable_statistics") and task.job and state_transition:
             task_event_count = TaskEventCount(
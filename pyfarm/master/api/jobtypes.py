@@ -22,6 +22,10 @@ Jobtypes
 This module defines an API for managing and querying jobtypes
 """
 
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+
 try:
     from httplib import (
         OK, CREATED, CONFLICT, NOT_FOUND, BAD_REQUEST, NO_CONTENT,
@@ -31,7 +35,7 @@ except ImportError:  # pragma: no cover
         OK, CREATED, CONFLICT, NOT_FOUND, BAD_REQUEST, NO_CONTENT,
         METHOD_NOT_ALLOWED)
 
-from flask import g, Response
+from flask import g, request, Response
 from flask.views import MethodView
 
 from sqlalchemy import or_, func, sql
@@ -42,15 +46,86 @@ from pyfarm.models.software import (
     Software, SoftwareVersion, JobTypeSoftwareRequirement)
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.master.application import db
+from pyfarm.master.config import config
 from pyfarm.master.utility import jsonify
 
 logger = getLogger("api.jobtypes")
 
+CODE_MAX_AGE = config.get("jobtype_code_max_age")
+
 
 class ObjectNotFound(Exception):
     pass
 
 
+class JobTypeCodeCache(object):
+    """
+    Least recently used cache for the code of job type versions, which
+    never changes once a version has been created.  Entries are kept under
+    the id of the :class:`JobTypeVersion`, which unlike the name of a job
+    type or the number of a version is never given to different code, and
+    are evicted once the code held by the cache exceeds ``max_size`` bytes.
+
+    Each entry is a tuple of ``(jobtype_id, etag, code)`` with the code
+    encoded as utf-8.  The id of the job type allows dropping all of its
+    entries when it's deleted.
+
+    :param int max_size:
+        The maximum number of bytes of code to keep
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, version_id):
+        """Returns the entry for the job type version ``version_id``"""
+        with self.lock:
+            entry = self.entries.pop(version_id, None)
+            if entry is not None:
+                self.entries[version_id] = entry
+            return entry
+
+    def set(self, version_id, jobtype_id, code):
+        """
+        Creates the entry for ``code``, the code of the job type version
+        ``version_id``, caches it if it fits and returns it
+        """
+        code = code.encode("utf-8")
+        entry = (jobtype_id, sha256(code).hexdigest(), code)
+        if len(code) > self.max_size:
+            return entry
+
+        with self.lock:
+            previous = self.entries.pop(version_id, None)
+            if previous is not None:
+                self.size -= len(previous[2])
+            self.entries[version_id] = entry
+            self.size += len(code)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[2])
+
+        return entry
+
+    def discard(self, jobtype_id):
+        """Drops all entries of the job type with the id ``jobtype_id``"""
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry[0] == jobtype_id:
+                    del self.entries[key]
+                    self.size -= len(entry[2])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+code_cache = JobTypeCodeCache(config.get("jobtype_code_cache_size"))
+
+
 def parse_requirements(requirements):
     """
     Takes a list dicts specifying a software and optional min- and max-versions
@@ -540,6 +615,9 @@ class SingleJobTypeAPI(MethodView):
 
         db.session.add_all([jobtype, jobtype_version])
         db.session.commit()
+        if not new:
+            # The jobtype may have been renamed
+            code_cache.discard(jobtype.id)
         jobtype_data = jobtype_version.to_dict(
             unpack_relationships=["software_requirements"])
         jobtype_data.update(jobtype.to_dict(unpack_relationships=False))
@@ -578,6 +656,7 @@ class SingleJobTypeAPI(MethodView):
 
         if jobtype:
             logger.debug("jobtype %s will be deleted",jobtype.name)
+            code_cache.discard(jobtype.id)
             db.session.delete(jobtype)
             db.session.commit()
             logger.info("jobtype %s has been deleted",jobtype.name)
@@ -741,6 +820,7 @@ class VersionedJobTypeAPI(MethodView):
         if jobtype_version:
             logger.debug("version %s of jobtype %s will be deleted",
                          version, jobtype.name)
+            code_cache.discard(jobtype.id)
             db.session.delete(jobtype_version)
             db.session.commit()
             logger.info("version %s of jobtype %s has been deleted",
@@ -770,6 +850,8 @@ class JobTypeCodeAPI(MethodView):
 
                 HTTP/1.1 200 OK
                 Content-Type: text/x-python
+                ETag: "1f4a2b..."
+                Cache-Control: public, max-age=60
 
                 from pyfarm.jobtypes.core.jobtype import JobType
 
@@ -782,32 +864,57 @@ class JobTypeCodeAPI(MethodView):
                             self.assignment_data["job"]["data"]["path"], "%04d" %
                             self.assignment_data["tasks"][0]["frame"])]
 
+        The code of a version never changes, so after looking up the id of
+        the version it's served from memory and can be revalidated by
+        sending its ``ETag`` in an ``If-None-Match`` header.
+
         :statuscode 200:
             no error
 
+        :statuscode 304:
+            the code matches the ``ETag`` sent in ``If-None-Match``
+
         :statuscode 404:
             jobtype or version not found
         """
-        if isinstance(jobtype_name, STRING_TYPES):
-            jt_tuple = db.session.query(
-                JobType, JobTypeVersion).filter(
-                    JobType.id == JobTypeVersion.jobtype_id,
-                    JobType.name == jobtype_name,
-                    JobTypeVersion.version == version).first()
-        else:
-            jt_tuple = db.session.query(
-                JobType, JobTypeVersion).filter(
-                    JobType.id == JobTypeVersion.jobtype_id,
-                    JobType.id == jobtype_name,
-                    JobTypeVersion.version == version).first()
-
-        if not jt_tuple:
+        entry = self.load_code(jobtype_name, version)
+        if entry is None:
             return (jsonify(error="JobType %s, version %s not found" %
                             (jobtype_name, version)), NOT_FOUND)
 
-        jobtype, jobtype_version = jt_tuple
+        _, etag, code = entry
+        response = Response(code, OK, mimetype="text/x-python")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "public, max-age=%s" % CODE_MAX_AGE
+        return response.make_conditional(request)
 
-        return Response(jobtype_version.code, OK, mimetype="text/x-python")
+    def load_code(self, jobtype_name, version):
+        """
+        Looks up the id of ``version`` of ``jobtype_name`` and returns the
+        cache entry for its code, loading the code only if it's not cached
+        yet.  Returns ``None`` if the version does not exist.
+        """
+        query = db.session.query(JobType.id, JobTypeVersion.id).filter(
+            JobType.id == JobTypeVersion.jobtype_id,
+            JobTypeVersion.version == version)
+        if isinstance(jobtype_name, STRING_TYPES):
+            query = query.filter(JobType.name == jobtype_name)
+        else:
+            query = query.filter(JobType.id == jobtype_name)
+
+        ids = query.first()
+        if not ids:
+            return None
+
+        jobtype_id, version_id = ids
+        entry = code_cache.get(version_id)
+        if entry is None:
+            code = db.session.query(JobTypeVersion.code).filter(
+                JobTypeVersion.id == version_id).scalar()
+            if code is None:
+                return None
+            entry = code_cache.set(version_id, jobtype_id, code)
+        return entry
 
 
 class JobTypeSoftwareRequirementsIndexAPI(MethodView):
@@ -22,22 +22,28 @@ Path Maps
 API endpoints for viewing and managing path maps
 """
 
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+from time import time
+
 try:
     from httplib import OK, CREATED, BAD_REQUEST, NOT_FOUND, NO_CONTENT
 except ImportError:  # pragma: no cover
     from http.client import OK, CREATED, BAD_REQUEST, NOT_FOUND, NO_CONTENT
 
 
-from flask import g
+from flask import current_app, g, request
 from flask.views import MethodView
 
-from sqlalchemy import or_
+from sqlalchemy import event, or_
+from sqlalchemy.orm import Session, joinedload
 
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import STRING_TYPES
 from pyfarm.models.pathmap import PathMap
 from pyfarm.models.tag import Tag
-from pyfarm.models.agent import Agent
+from pyfarm.models.agent import AgentTagAssociation
 from pyfarm.master.application import db
 from pyfarm.master.config import config
 from pyfarm.master.utility import (
@@ -47,6 +53,89 @@ from pyfarm.master.utility import (
 logger = getLogger("api.pathmaps")
 
 
+class PathMapCache(object):
+    """
+    Least recently used cache for the path maps applying to agents, keyed
+    by the set of tags an agent has, so agents sharing the same tags share
+    an entry.  Each entry is a tuple of ``(etag, body)`` with ``body`` being
+    the serialized response.
+
+    Changes committed by this process clear the cache right away.  Entries
+    expire after ``max_age`` seconds so changes made through other
+    processes are picked up as well.
+
+    :param int max_entries:
+        The maximum number of tag sets to keep path maps for
+
+    :param int max_age:
+        The number of seconds an entry may be used for
+    """
+    def __init__(self, max_entries, max_age):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        """Returns the entry for ``key`` or ``None``"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time() - self.max_age:
+                return None
+            self.entries[key] = entry
+            return entry[1:]
+
+    def set(self, key, generation, etag, body):
+        """
+        Caches ``body`` under ``key`` unless the cache was cleared since
+        ``generation`` was read, in which case the body may be outdated
+        """
+        if self.max_entries < 1:
+            return
+
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time(), etag, body)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """
+        Notes when path maps or tags, whose names are part of the cached
+        path maps, were changed
+        """
+        for instance in session.new | session.dirty | session.deleted:
+            if isinstance(instance, (PathMap, Tag)):
+                session.info["pathmaps_changed"] = True
+                return
+
+    @staticmethod
+    def after_commit(session):
+        if session.info.pop("pathmaps_changed", False):
+            cache.clear()
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop("pathmaps_changed", None)
+
+
+cache = PathMapCache(config.get("pathmap_cache_size"),
+                     config.get("pathmap_cache_max_age"))
+
+event.listen(Session, "after_flush", PathMapCache.after_flush)
+event.listen(Session, "after_commit", PathMapCache.after_commit)
+event.listen(Session, "after_rollback", PathMapCache.after_rollback)
+
+
 def schema():
     """
     Returns the basic schema of :class:`.Agent`
@@ -195,28 +284,55 @@ class PathMapIndexAPI(MethodView):
                     }
                 ]
 
+        The response carries an ``ETag`` which can be sent back in an
+        ``If-None-Match`` header to only receive the path maps if they
+        changed.
+
         :statuscode 200: no error
+        :statuscode 304: the path maps match the ``ETag`` sent in
+                         ``If-None-Match``
         """
-        query = PathMap.query
-
+        generation = cache.generation
+        tag_ids = None
         for_agent = get_uuid_argument("for_agent")
 
         if for_agent:
-            query = query.filter(or_(PathMap.tag == None,
-                                     PathMap.tag.has(Tag.agents.any(
-                                        Agent.id == for_agent))))
-
-        logger.debug("Query: %s", str(query))
-
-        output = []
-        for map in query:
-            map_dict = map.to_dict(unpack_relationships=False)
-            if map.tag:
-                map_dict["tag"] = map.tag.tag
-            del map_dict["tag_id"]
-            output.append(map_dict)
-
-        return jsonify(output), OK
+            tag_ids = frozenset(
+                tag_id for tag_id, in db.session.query(
+                    AgentTagAssociation.c.tag_id).filter(
+                        AgentTagAssociation.c.agent_id == for_agent))
+
+        # The formatting of the output depends on the kind of request
+        key = (tag_ids, request.is_xhr)
+        entry = cache.get(key)
+        if entry is None:
+            query = PathMap.query.options(joinedload("tag")).order_by(
+                PathMap.id)
+            if tag_ids:
+                query = query.filter(or_(PathMap.tag_id == None,
+                                         PathMap.tag_id.in_(tag_ids)))
+            elif tag_ids is not None:
+                query = query.filter(PathMap.tag_id == None)
+
+            logger.debug("Query: %s", str(query))
+
+            output = []
+            for map in query:
+                map_dict = map.to_dict(unpack_relationships=False)
+                if map.tag:
+                    map_dict["tag"] = map.tag.tag
+                del map_dict["tag_id"]
+                output.append(map_dict)
+
+            body = jsonify(output).get_data()
+            entry = (sha256(body).hexdigest(), body)
+            cache.set(key, generation, *entry)
+
+        etag, body = entry
+        response = current_app.response_class(
+            body, OK, mimetype="application/json")
+        response.set_etag(etag)
+        return response.make_conditional(request)
 
 
 class SinglePathMapAPI(MethodView):
@@ -0,0 +1,123 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Statistics
+----------
+
+API endpoints for reading aggregated runtime statistics about the farm
+"""
+
+try:
+    from httplib import OK, BAD_REQUEST
+except ImportError:  # pragma: no cover
+    from http.client import OK, BAD_REQUEST
+
+from datetime import datetime, timedelta
+
+from flask import request
+from flask.views import MethodView
+
+from pyfarm.core.logger import getLogger
+from pyfarm.models.statistics.queries import task_event_counts, task_counts
+from pyfarm.master.config import config
+from pyfarm.master.utility import jsonify
+
+logger = getLogger("api.statistics")
+
+
+class TaskEventsStatisticsAPI(MethodView):
+    def get(self):
+        """
+        A ``GET`` to this endpoint will return the number of task events and
+        the average number of tasks in each state for consecutive periods of
+        time.  Every list in the response has one entry per period, starting
+        at the unix timestamp of the same index in ``timestamps``.
+
+        .. http:get:: /api/v1/statistics/task_events HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/statistics/task_events?days_back=1&minutes_resolution=60 HTTP/1.1
+                Accept: application/json
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                {
+                    "task_events": {
+                        "resolution": 3600,
+                        "timestamps": [1434186000, 1434189600],
+                        "new": [20, 0],
+                        "deleted": [0, 0],
+                        "restarted": [0, 1],
+                        "started": [12, 8],
+                        "failed": [0, 1],
+                        "done": [4, 15]
+                    },
+                    "task_counts": {
+                        "resolution": 3600,
+                        "timestamps": [1434186000, 1434189600],
+                        "queued": [8.5, 0.0],
+                        "running": [4.0, 4.5],
+                        "done": [2.5, 13.0],
+                        "failed": [0.0, 0.5]
+                    }
+                }
+
+        :query int days_back: how many days of statistics to return, defaults
+                              to 7
+        :query int minutes_resolution: the length of each period in minutes,
+                                       defaults to the consolidation interval
+                                       of task event counts
+        :query int queue: the id of a queue to limit the statistics to, may be
+                          given multiple times
+        :query bool no_queue: include tasks not in any queue
+
+        :statuscode 200: no error
+        :statuscode 400: one of the query parameters was invalid
+        """
+        resolution = int(timedelta(**config.get(
+            "task_event_count_consolidate_interval")).total_seconds())
+        try:
+            days_back = int(request.args.get("days_back", 7))
+            if "minutes_resolution" in request.args:
+                resolution = int(request.args["minutes_resolution"]) * 60
+            job_queue_ids = [int(x) for x in request.args.getlist("queue")]
+        except ValueError as e:
+            return (jsonify(error="Invalid query parameter: %s" % e),
+                    BAD_REQUEST)
+
+        if days_back < 1 or resolution < 60:
+            return (jsonify(
+                error="days_back and minutes_resolution must be positive"),
+                BAD_REQUEST)
+
+        no_queue = request.args.get("no_queue", "").lower() == "true"
+        now = datetime.utcnow()
+        time_start = now - timedelta(days=days_back)
+
+        return jsonify(
+            task_events=task_event_counts(
+                time_start, resolution, job_queue_ids, no_queue, now=now),
+            task_counts=task_counts(
+                time_start, resolution, job_queue_ids, no_queue, now=now)), OK
@@ -31,11 +31,6 @@ except ImportError:  # pragma: no cover
       OK, NOT_FOUND, CONFLICT, TEMPORARY_REDIRECT, CREATED, BAD_REQUEST,
       INTERNAL_SERVER_ERROR)
 
-from gzip import GzipFile
-from os import makedirs
-from os.path import join, realpath
-from errno import EEXIST
-
 from flask.views import MethodView
 from flask import g, redirect, send_file, request, Response
 
@@ -45,19 +40,12 @@ from pyfarm.core.logger import getLogger
 from pyfarm.master.config import config
 from pyfarm.models.tasklog import TaskLog, TaskTaskLogAssociation
 from pyfarm.models.task import Task
-from pyfarm.master.application import db
+from pyfarm.master.application import db, request_body
+from pyfarm.master.tasklog_storage import get_tasklog_storage
 from pyfarm.master.utility import jsonify, validate_with_model, isuuid
 
 logger = getLogger("api.tasklogs")
 
-LOGFILES_DIR = config.get("tasklogs_dir")
-
-try:
-    makedirs(LOGFILES_DIR)
-except OSError as e:  # pragma: no cover
-    if e.errno != EEXIST:
-        raise
-
 
 class LogsInTaskAttemptsIndexAPI(MethodView):
     def get(self, job_id, task_id, attempt):
@@ -162,8 +150,7 @@ class LogsInTaskAttemptsIndexAPI(MethodView):
             return jsonify(task_id=task_id, job_id=job_id,
                            error="Specified task not found"), NOT_FOUND
 
-        path = realpath(join(LOGFILES_DIR, g.json["identifier"]))
-        if not realpath(path).startswith(LOGFILES_DIR):
+        if not get_tasklog_storage().acceptable(g.json["identifier"]):
             return jsonify(error="Identifier is not acceptable"), BAD_REQUEST
         attempts = 0
         registered = False
@@ -384,16 +371,16 @@ class TaskLogfileAPI(MethodView):
             return jsonify(task_id=task.id, log=log.identifier,
                            error="Specified log not found in task"), NOT_FOUND
 
-        path = realpath(join(LOGFILES_DIR, log_identifier))
-        if not realpath(path).startswith(LOGFILES_DIR):
+        storage = get_tasklog_storage()
+        if not storage.acceptable(log_identifier):
             return jsonify(error="Identifier is not acceptable"), BAD_REQUEST
 
         try:
-            logfile = open(path, "rb")
+            logfile = storage.open(log_identifier)
             return send_file(logfile)
         except IOError:
             try:
-                compressed_logfile = GzipFile("%s.gz" % path, "rb")
+                compressed_logfile = storage.open_compressed(log_identifier)
                 def logfile_generator():
                     eof = False
                     while not eof:
@@ -405,12 +392,13 @@ class TaskLogfileAPI(MethodView):
                 agent = log.agent
                 if not agent:
                     return (jsonify(
-                        path=path, log=log_identifier,
+                        log=log_identifier,
                         error="Logfile is not available on master and agent "
                               "is not known"), NOT_FOUND)
                 return redirect(agent.api_url() + "/task_logs/" +
                                 log_identifier, TEMPORARY_REDIRECT)
 
+    @request_body(max_size=None, parse_json=False)
     def put(self, job_id, task_id, attempt, log_identifier):
         """
         A ``PUT`` to this endpoint will upload the request's body as the
@@ -454,21 +442,20 @@ class TaskLogfileAPI(MethodView):
             return jsonify(task_id=task_id, log=log.identifier,
                            error="Specified log not found in task"), NOT_FOUND
 
-        path = realpath(join(LOGFILES_DIR, log_identifier))
-        if not realpath(path).startswith(LOGFILES_DIR):
+        storage = get_tasklog_storage()
+        if not storage.acceptable(log_identifier):
             return jsonify(error="Identifier is not acceptable"), BAD_REQUEST
 
-        logger.info("Writing task log file for task %s, attempt %s to path %s",
-                    task_id, attempt, path)
+        logger.info("Writing task log file for task %s, attempt %s as %s",
+                    task_id, attempt, log_identifier)
 
         try:
-            with open(path, "wb+") as log_file:
-                log_file.write(request.data)
+            storage.write(log_identifier, request.stream)
         except (IOError, OSError) as e:
             logger.error("Could not write task log file: %s (%s)", e.errno,
                          e.strerror)
             return (jsonify(error="Could not write file %s to disk: %s"
-                                  % (path, e)),
+                                  % (log_identifier, e)),
                     INTERNAL_SERVER_ERROR)
 
         return "", CREATED
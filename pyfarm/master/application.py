@@ -28,17 +28,19 @@ from multiprocessing.util import register_after_fork
 from uuid import UUID
 
 try:
-    from httplib import BAD_REQUEST, UNSUPPORTED_MEDIA_TYPE
+    from httplib import (
+        BAD_REQUEST, UNSUPPORTED_MEDIA_TYPE, REQUEST_ENTITY_TOO_LARGE)
 except ImportError:
-    from http.client import BAD_REQUEST, UNSUPPORTED_MEDIA_TYPE
+    from http.client import (
+        BAD_REQUEST, UNSUPPORTED_MEDIA_TYPE, REQUEST_ENTITY_TOO_LARGE)
 
-from flask import Flask, Blueprint, request, g, abort
+from flask import Flask, Blueprint, request, g, abort, current_app, json
 from flask.ext.login import LoginManager
 from flask.ext.sqlalchemy import SQLAlchemy
 from itsdangerous import URLSafeTimedSerializer
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.routing import BaseConverter, ValidationError
 
 from pyfarm.core.enums import NOTSET, STRING_TYPES, PY3
@@ -49,6 +51,8 @@ POST_METHODS = set(("POST", "PUT"))
 IGNORED_MIMETYPES = set((
     "application/x-www-form-urlencoded", "multipart/form-data",
     "application/zip", "text/csv"))
+MAX_REQUEST_SIZE = config.get("max_request_size")
+MAX_BULK_REQUEST_SIZE = config.get("max_bulk_request_size")
 
 logger = getLogger("app")
 
@@ -223,28 +227,147 @@ def get_login_serializer(secret_key):
     return URLSafeTimedSerializer(secret_key)
 
 
+class LimitedInputStream(object):
+    """
+    Wraps the input stream of a request which was sent without a
+    ``Content-Length``, such as one using chunked transfer encoding, and
+    raises :class:`RequestEntityTooLarge` as soon as more than ``max_size``
+    bytes have been read from it.  Reading the whole stream reads at most
+    one chunk past the limit.
+
+    :param stream:
+        The ``wsgi.input`` stream of the request
+
+    :param int max_size:
+        The number of bytes which may be read from ``stream``
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.bytes_read = 0
+
+    def _count(self, data):
+        self.bytes_read += len(data)
+        if self.bytes_read > self.max_size:
+            g.error = "request body is larger than %s bytes" % self.max_size
+            raise RequestEntityTooLarge()
+        return data
+
+    def read(self, size=-1):
+        if size is not None and size >= 0:
+            return self._count(self.stream.read(size))
+
+        chunks = []
+        while True:
+            chunk = self._count(self.stream.read(self.CHUNK_SIZE))
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = self.max_size - self.bytes_read + 1
+        return self._count(self.stream.readline(size))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+def request_body(max_size=NOTSET, parse_json=True):
+    """
+    Decorator which declares how :func:`before_request` should treat the
+    body of requests to a view or to a method of a
+    :class:`flask.views.MethodView`:
+
+        >>> class LogfileAPI(MethodView):
+        ...     @request_body(max_size=None, parse_json=False)
+        ...     def put(self):
+        ...         storage.write(request.stream)
+
+    :param int max_size:
+        The largest body, in bytes, the view accepts.  Larger requests are
+        rejected with ``413 Request Entity Too Large``, before any of the
+        body is read if they declare their ``Content-Length``.  ``None``
+        disables the limit, by default ``max_request_size`` from the
+        configuration applies.
+
+    :param bool parse_json:
+        When false the body is never decoded into ``g.json`` and is left
+        unread on ``request.stream`` for the view to consume itself
+    """
+    def wrapper(func):
+        func.max_body_size = max_size
+        func.parse_json = parse_json
+        return func
+    return wrapper
+
+
+def request_view():
+    """
+    Returns the function which will handle the current request, for views
+    based on :class:`flask.views.MethodView` this is the method matching
+    the request's method.  ``None`` is returned if the url did not match
+    any view.
+    """
+    if request.url_rule is None:
+        return None
+
+    view = current_app.view_functions.get(request.url_rule.endpoint)
+    view_class = getattr(view, "view_class", None)
+    if view_class is not None:
+        return getattr(view_class, request.method.lower(), None)
+    return view
+
+
 def before_request():
     """
     Global before_request handler that will handle common problems when
-    trying to accept json data to the api.
+    trying to accept json data to the api.  Limits on the size of the
+    request and whether its body is decoded at all can be declared for each
+    view with :func:`request_body`.
     """
     g.json = NOTSET
     g.error = None
 
-    if request.method not in POST_METHODS or \
-            request.mimetype in IGNORED_MIMETYPES:
+    if request.method not in POST_METHODS:
+        return
+
+    view = request_view()
+    max_size = getattr(view, "max_body_size", NOTSET)
+    if max_size is NOTSET:
+        max_size = MAX_REQUEST_SIZE
+
+    if max_size is not None:
+        if request.content_length is None:
+            # Without a Content-Length the body can only be measured while
+            # it's read, the stream of the request is built from this
+            request.environ["wsgi.input"] = LimitedInputStream(
+                request.environ["wsgi.input"], max_size)
+        elif request.content_length > max_size:
+            g.error = "request body is larger than %s bytes" % max_size
+            abort(REQUEST_ENTITY_TOO_LARGE)
+
+    if (not getattr(view, "parse_json", True) or
+            request.mimetype in IGNORED_MIMETYPES):
         pass
 
     elif request.mimetype == "application/json":
-        # manually handle decoding errors from get_json()
-        # so we can produce a better error message
+        # The body is only needed as json, so decode it without also
+        # keeping a copy of the raw data around on the request
+        data = request.get_data(cache=False)
+
+        # manually handle decoding errors so we can produce a better
+        # error message
         try:
-            g.json = request.get_json()
-        except (ValueError, BadRequest):  # pragma: no cover
+            g.json = json.loads(data.decode(
+                request.mimetype_params.get("charset", "utf-8")))
+        except ValueError:
             g.error = "failed to decode json"
 
             # see if there just was not any data to decode
-            if not request.get_data():
+            if not data:
                 g.error = "no data to decode"
 
             abort(BAD_REQUEST)
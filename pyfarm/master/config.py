@@ -68,6 +68,7 @@ class Configuration(_Configuration):
         "agent_updates_webdir": ("PYFARM_AGENT_UPDATES_WEBDIR", read_env),
         "farm_name": ("PYFARM_FARM_NAME", read_env),
         "tasklogs_dir": ("PYFARM_LOGFILES_DIR", read_env),
+        "tasklogs_storage": ("PYFARM_LOGFILES_STORAGE", read_env),
         "dev_db_drop_all": (
             "PYFARM_DEV_APP_DB_DROP_ALL", env_bool_false),
         "dev_db_create_all": (
@@ -23,17 +23,20 @@ Contains the code which operates the Python entry point scripts as well as
 serving as a central location for the construction of the web application.
 """
 
+import sys
 from argparse import ArgumentParser
 from functools import partial
 
 try:
     from httplib import (
         responses, BAD_REQUEST, UNAUTHORIZED, NOT_FOUND, METHOD_NOT_ALLOWED,
-        INTERNAL_SERVER_ERROR, UNSUPPORTED_MEDIA_TYPE)
+        INTERNAL_SERVER_ERROR, UNSUPPORTED_MEDIA_TYPE,
+        REQUEST_ENTITY_TOO_LARGE)
 except ImportError:  # pragma: no cover
     from http.client import (
         responses, BAD_REQUEST, UNAUTHORIZED, NOT_FOUND, METHOD_NOT_ALLOWED,
-        INTERNAL_SERVER_ERROR, UNSUPPORTED_MEDIA_TYPE)
+        INTERNAL_SERVER_ERROR, UNSUPPORTED_MEDIA_TYPE,
+        REQUEST_ENTITY_TOO_LARGE)
 
 from flask import request
 
@@ -98,6 +101,9 @@ def load_error_handlers(app_instance):
         error_handler, code=UNSUPPORTED_MEDIA_TYPE,
         default=lambda:
         "%r is not a supported media type" % request.mimetype)
+    request_entity_too_large = partial(
+        error_handler, code=REQUEST_ENTITY_TOO_LARGE,
+        default=lambda: "request to %s is too large" % request.url)
 
     # apply the handlers to the application instance
     app_instance.register_error_handler(BAD_REQUEST, bad_request)
@@ -106,6 +112,8 @@ def load_error_handlers(app_instance):
     app_instance.register_error_handler(METHOD_NOT_ALLOWED, method_not_allowed)
     app_instance.register_error_handler(
         UNSUPPORTED_MEDIA_TYPE, unsupported_media_type)
+    app_instance.register_error_handler(
+        REQUEST_ENTITY_TOO_LARGE, request_entity_too_large)
     app_instance.register_error_handler(
         INTERNAL_SERVER_ERROR, internal_server_error)
 
@@ -140,7 +148,8 @@ def load_user_interface(app_instance):
         enable_multiple_agents, disable_single_agent, enable_single_agent,
         delete_multiple_agents)
     from pyfarm.master.user_interface.jobs import (
-        jobs, delete_single_job, rerun_single_job, single_job, pause_single_job,
+        jobs, delete_single_job, rerun_single_job, single_job,
+        single_job_tasks_page, pause_single_job,
         unpause_single_job, alter_frames_in_single_job,
         alter_scheduling_parameters_for_job, update_notes_for_job,
         update_tags_in_job, rerun_single_task, add_notified_user_to_job,
@@ -311,6 +320,9 @@ def load_user_interface(app_instance):
                               remove_notified_user_from_job, methods=("POST", ))
     app_instance.add_url_rule("/jobs/<int:job_id>",
                               "single_job_ui", single_job, methods=("GET", ))
+    app_instance.add_url_rule("/jobs/<int:job_id>/tasks_page",
+                              "single_job_tasks_page_ui",
+                              single_job_tasks_page, methods=("GET", ))
 
     app_instance.add_url_rule("/jobs/<int:job_id>/tasks/<int:task_id>/logs/",
                               "logs_in_task_ui", logs_in_task, methods=("GET", ))
@@ -427,6 +439,7 @@ def load_api(app_instance, api_instance):
     from pyfarm.master.api.jobgroups import (
         schema as jobgroups_schema, JobGroupIndexAPI, SingleJobGroupAPI,
         JobsInJobGroupIndexAPI)
+    from pyfarm.master.api.statistics import TaskEventsStatisticsAPI
 
     # top level types
     api_instance.add_url_rule(
@@ -454,6 +467,12 @@ def load_api(app_instance, api_instance):
         "/jobgroups/",
         view_func=JobGroupIndexAPI.as_view("jobgroup_index_api"))
 
+    # statistics
+    api_instance.add_url_rule(
+        "/statistics/task_events",
+        view_func=TaskEventsStatisticsAPI.as_view(
+            "task_events_statistics_api"))
+
     # schemas
     api_instance.add_url_rule(
         "/agents/schema",
@@ -755,6 +774,69 @@ def tables():  # pragma: no cover
             logger.info("Tables created or updated")
 
 
+def migrate_tasklogs():  # pragma: no cover
+    """
+    Moves task logs stored directly inside of ``tasklogs_dir``, the layout
+    used by older versions of PyFarm, into the sharded layout.
+    """
+    from pyfarm.master.tasklog_storage import ShardedTaskLogStorage
+
+    parser = ArgumentParser(
+        description="Moves task logs from a flat directory into the sharded "
+                    "task log layout")
+    parser.add_argument(
+        "--tasklogs-dir", default=config.get("tasklogs_dir"),
+        help="The task log directory to migrate.  Defaults to the "
+             "'tasklogs_dir' configuration value.")
+    parser.add_argument(
+        "--depth", type=int, default=config.get("tasklogs_shard_depth"),
+        help="The number of shard directory levels.  Defaults to the "
+             "'tasklogs_shard_depth' configuration value.")
+    args = parser.parse_args()
+
+    storage = ShardedTaskLogStorage(args.tasklogs_dir, depth=args.depth)
+    migrated = storage.migrate_flat_logs()
+    logger.info("Migrated %s task logs in %s", migrated, storage.root)
+
+
+def jobqueue_closure():  # pragma: no cover
+    """
+    Checks the job queue closure table and the cached paths of all job
+    queues, and optionally rebuilds them from the parent of each queue.
+    """
+    from pyfarm.models.jobqueue import JobQueue
+
+    parser = ArgumentParser(
+        description="Checks the job queue closure table and the cached "
+                    "paths of all job queues for consistency")
+    parser.add_argument(
+        "--rebuild", action="store_true",
+        help="If provided the closure table and all paths are rebuilt "
+             "from the parent of each job queue.")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rows = JobQueue.rebuild_closure()
+        db.session.commit()
+        logger.info("Rebuilt the job queue closure table with %s rows", rows)
+
+    problems = JobQueue.check_closure()
+    for ancestor_id, descendant_id, depth in problems["missing"]:
+        logger.error("Missing closure row: queue %s is %s levels below "
+                     "queue %s", descendant_id, depth, ancestor_id)
+    for ancestor_id, descendant_id, depth in problems["unexpected"]:
+        logger.error("Unexpected closure row: queue %s is not %s levels "
+                     "below queue %s", descendant_id, depth, ancestor_id)
+    for queue_id in problems["stale_paths"]:
+        logger.error("Cached path of queue %s is out of date", queue_id)
+
+    if any(problems.values()):
+        logger.error("The job queue closure table is inconsistent, run with "
+                     "--rebuild to fix it")
+        sys.exit(1)
+    logger.info("The job queue closure table is consistent")
+
+
 def run_master():  # pragma: no cover
     """Runs :func:`load_master` then runs the application"""
     from pyfarm.master.application import app, api
@@ -27,7 +27,7 @@ try:
 except ImportError:
     from http.client import UNAUTHORIZED, BAD_REQUEST
 
-from flask import request, redirect, render_template, abort
+from flask import request, redirect, render_template, abort, g
 from flask.ext.login import login_user, logout_user, current_user
 from itsdangerous import BadTimeSignature
 from wtforms import Form, TextField, PasswordField, validators, ValidationError
@@ -42,9 +42,12 @@ def load_user(user):
     callback for :func:`flask_login.LoginManager.user_loader`
 
     When the user id is is not present in the session this function
-    is used to load the user from the database directly.
+    is used to load the user, from the principal cache if possible.
     """
-    return User.get(user)
+    try:
+        return User.get_cached(user)
+    except ValueError:
+        return User.get(user)
 
 
 @login_manager.token_loader
@@ -64,10 +67,12 @@ def load_token(token):
         userid, password = login_serializer.loads(
             token,
             max_age=app.config["REMEMBER_COOKIE_DURATION"].total_seconds())
-        user = User.get(userid)
-        return user if user and user.password == password else None
+        principal = User.get_principal(userid)
+        if principal is None or principal.columns["password"] != password:
+            return None
+        return User.get_cached(userid)
 
-    except BadTimeSignature:
+    except (BadTimeSignature, ValueError):
         return None
 
 
@@ -100,9 +105,9 @@ class LoginForm(Form):
 def login_page():
     """display and process the login for or action"""
     if request.method == "POST" and request.content_type == "application/json":
-        user = User.get(request.json["username"])
+        user = User.get(g.json["username"])
 
-        if user and user.check_password(request.json["password"]):
+        if user and user.check_password(g.json["password"]):
             login_user(user, remember=True)
             return jsonify(None)
 
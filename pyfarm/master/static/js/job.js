@@ -0,0 +1,16 @@
+$(document).ready(function() {
+    $('#load-more-tasks').on('click', function(e) {
+        var button = $(this);
+        button.prop("disabled", true);
+        $.getJSON(button.data("next"), function(r) {
+            $('#task-rows').append(r["html"]);
+            if(r["next"]) {
+                button.data("next", r["next"]);
+                button.prop("disabled", false);
+            }
+            else {
+                button.remove();
+            }
+        });
+    });
+});
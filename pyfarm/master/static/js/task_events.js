@@ -1,4 +1,27 @@
-$(document).ready(function() {
+function to_series(data, column, key, sign) {
+    var values = [];
+    for(var i = 0; i < data["timestamps"].length; i++) {
+        values.push([data["timestamps"][i], sign * data[column][i]]);
+    }
+    return {values: values, key: key};
+}
+
+function draw_task_events(r) {
+    d3.select('#event_chart svg').datum([
+        to_series(r["task_events"], "new", "New Tasks", 1),
+        to_series(r["task_events"], "deleted", "Deleted Tasks", -1),
+        to_series(r["task_events"], "restarted", "Restarted Tasks", 1),
+        to_series(r["task_events"], "failed", "Failed Tasks", -1),
+        to_series(r["task_events"], "done", "Done Tasks", -1)
+        ]);
+
+    d3.select('#totals_chart svg').datum([
+        to_series(r["task_counts"], "queued", "Queued Tasks", 1),
+        to_series(r["task_counts"], "running", "Running Tasks", 1),
+        to_series(r["task_counts"], "done", "Done Tasks", 1),
+        to_series(r["task_counts"], "failed", "Failed Tasks", 1)
+        ]);
+
     nv.addGraph(function() {
         var chart = nv.models.multiBarChart()
             .margin({top: 30, right: 60, bottom: 50, left: 70})
@@ -65,5 +88,8 @@ $(document).ready(function() {
 
     return chart;
   });
+}
 
+$(document).ready(function() {
+    $.getJSON(task_events_url, draw_task_events);
 });
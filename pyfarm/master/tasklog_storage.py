@@ -0,0 +1,389 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Task Log Storage
+================
+
+Storage backends for task log files.  Both the task log api and the
+scheduler go through :func:`get_tasklog_storage` instead of touching
+``tasklogs_dir`` directly so the on-disk layout can be changed, or replaced
+entirely, without changing any of the callers.
+
+Two backends are provided:
+
+    * :class:`FlatTaskLogStorage` keeps every log in a single directory.  This
+      is the layout older versions of PyFarm used.
+    * :class:`ShardedTaskLogStorage` places each log in a subdirectory derived
+      from a hash of its identifier so no single directory grows too large.
+
+Other backends, such as an object store, can be used by subclassing
+:class:`TaskLogStorage` and setting ``tasklogs_storage`` to
+``module.path:ClassName``.
+"""
+
+from errno import EEXIST, ENOENT
+from gzip import GzipFile
+from hashlib import md5
+from importlib import import_module
+from os import makedirs, listdir, remove, rename, rmdir
+from os.path import join, realpath, isfile, isdir, dirname
+from shutil import copyfileobj
+
+from pyfarm.core.logger import getLogger
+from pyfarm.master.config import config
+
+logger = getLogger("master.tasklog_storage")
+
+COMPRESSED_SUFFIX = ".gz"
+CHUNK_SIZE = 4096  # 4096 == mempage
+
+
+def makedirs_(path):
+    """Creates ``path`` and its parents, ignoring existing directories"""
+    try:
+        makedirs(path)
+    except OSError as e:
+        if e.errno != EEXIST:
+            raise
+
+
+class TaskLogStorage(object):
+    """
+    Base class which defines the interface every task log storage
+    backend has to implement.  Identifiers are the same identifiers stored
+    in :attr:`pyfarm.models.tasklog.TaskLog.identifier`, compressed logs are
+    addressed by the same identifier as their uncompressed counterpart.
+    """
+    def acceptable(self, identifier):
+        """
+        Returns ``True`` if ``identifier`` may be used to store a log.  Backends
+        should use this to reject identifiers that would escape the storage
+        location.
+        """
+        raise NotImplementedError
+
+    def open(self, identifier):
+        """
+        Returns a file object for reading the uncompressed log stored under
+        ``identifier``.  Raises :class:`IOError` if there is no such log.
+        """
+        raise NotImplementedError
+
+    def open_compressed(self, identifier):
+        """
+        Returns a file object which yields the decompressed content of
+        the compressed log stored under ``identifier``.  Raises
+        :class:`IOError` if there is no such log.
+        """
+        raise NotImplementedError
+
+    def write(self, identifier, stream):
+        """
+        Stores the content of the file object ``stream`` as the uncompressed
+        log ``identifier``, replacing any existing content.
+        """
+        raise NotImplementedError
+
+    def compress(self, identifier):
+        """
+        Replaces the uncompressed log ``identifier`` with a compressed copy
+        """
+        raise NotImplementedError
+
+    def remove(self, identifier, compressed=False):
+        """
+        Removes the log ``identifier``.  Missing logs are silently ignored.
+        """
+        raise NotImplementedError
+
+    def iter_logs(self):
+        """
+        Iterates over all stored logs and yields tuples of
+        ``(identifier, compressed)``.
+        """
+        raise NotImplementedError
+
+
+class FlatTaskLogStorage(TaskLogStorage):
+    """
+    Stores all logs as plain files directly inside of ``root``.
+
+    :param string root:
+        The directory to store logs in, created if it does not exist yet
+    """
+    def __init__(self, root):
+        self.root = realpath(root)
+        makedirs_(self.root)
+
+    def path(self, identifier):
+        """Returns the path the uncompressed log ``identifier`` is stored at"""
+        return join(self.root, identifier)
+
+    def acceptable(self, identifier):
+        return realpath(self.path(identifier)).startswith(join(self.root, ""))
+
+    def open(self, identifier):
+        return open(self.path(identifier), "rb")
+
+    def open_compressed(self, identifier):
+        return GzipFile(self.path(identifier) + COMPRESSED_SUFFIX, "rb")
+
+    def write(self, identifier, stream):
+        path = self.path(identifier)
+        makedirs_(dirname(path))
+        with open(path, "wb+") as log_file:
+            copyfileobj(stream, log_file, CHUNK_SIZE)
+
+    def compress(self, identifier):
+        path = self.path(identifier)
+        with open(path, "rb") as logfile:
+            logger.debug("Compressing tasklog file %s", path)
+            compressed_logfile = GzipFile(path + COMPRESSED_SUFFIX, "wb")
+            try:
+                copyfileobj(logfile, compressed_logfile, CHUNK_SIZE)
+            finally:
+                compressed_logfile.close()
+        self.remove(identifier)
+
+    def remove(self, identifier, compressed=False):
+        path = self.path(identifier)
+        if compressed:
+            path += COMPRESSED_SUFFIX
+        try:
+            remove(path)
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+
+    def iter_logs(self):
+        try:
+            filenames = listdir(self.root)
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+            logger.warning("Log directory %r does not exist", self.root)
+            return
+
+        for filename in filenames:
+            if not isfile(join(self.root, filename)):
+                continue
+            if filename.endswith(COMPRESSED_SUFFIX):
+                yield filename[:-len(COMPRESSED_SUFFIX)], True
+            else:
+                yield filename, False
+
+
+class ShardedTaskLogStorage(FlatTaskLogStorage):
+    """
+    Stores logs in subdirectories of ``root`` named after the leading
+    characters of the md5 hash of the log's identifier, ``ab/cd/<identifier>``
+    for a ``depth`` of 2.  Each directory level therefore has at most 256
+    entries which keeps lookups and listings fast on large farms.
+
+    Logs which are still stored directly in ``root``, as they were by
+    :class:`FlatTaskLogStorage`, remain readable and are also returned by
+    :meth:`iter_logs` so they can be cleaned up or compressed as usual.  Use
+    :meth:`migrate` to move them into their shard.
+
+    :param string root:
+        The directory to store logs in, created if it does not exist yet
+
+    :param int depth:
+        The number of directory levels to shard logs into
+    """
+    def __init__(self, root, depth=2):
+        super(ShardedTaskLogStorage, self).__init__(root)
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+        self.depth = depth
+
+    def shard(self, identifier):
+        """Returns the shard directory, relative to the root, for a log"""
+        digest = md5(identifier.encode("utf-8")).hexdigest()
+        return join(*[digest[i * 2:i * 2 + 2] for i in range(self.depth)])
+
+    def path(self, identifier):
+        return join(self.root, self.shard(identifier), identifier)
+
+    def acceptable(self, identifier):
+        return realpath(self.path(identifier)).startswith(
+            join(self.root, self.shard(identifier), ""))
+
+    def flat_path(self, identifier):
+        """Returns the path a log would have in the flat layout"""
+        return join(self.root, identifier)
+
+    def open(self, identifier):
+        try:
+            return super(ShardedTaskLogStorage, self).open(identifier)
+        except IOError as e:
+            if e.errno != ENOENT:
+                raise
+            return open(self.flat_path(identifier), "rb")
+
+    def open_compressed(self, identifier):
+        try:
+            return super(ShardedTaskLogStorage, self).open_compressed(
+                identifier)
+        except IOError as e:
+            if e.errno != ENOENT:
+                raise
+            return GzipFile(
+                self.flat_path(identifier) + COMPRESSED_SUFFIX, "rb")
+
+    def compress(self, identifier):
+        if not isfile(self.path(identifier)):
+            self.migrate(identifier)
+        super(ShardedTaskLogStorage, self).compress(identifier)
+
+    def remove(self, identifier, compressed=False):
+        super(ShardedTaskLogStorage, self).remove(
+            identifier, compressed=compressed)
+        path = self.flat_path(identifier)
+        if compressed:
+            path += COMPRESSED_SUFFIX
+        try:
+            remove(path)
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+
+        # Prune shard directories which are now empty
+        shard_dir = dirname(self.path(identifier))
+        while shard_dir != self.root:
+            try:
+                rmdir(shard_dir)
+            except OSError:
+                break
+            shard_dir = dirname(shard_dir)
+
+    def migrate(self, identifier, compressed=False):
+        """
+        Moves a log from the flat layout into its shard.  Returns ``True``
+        if the log was moved.
+        """
+        source = self.flat_path(identifier)
+        destination = self.path(identifier)
+        if compressed:
+            source += COMPRESSED_SUFFIX
+            destination += COMPRESSED_SUFFIX
+
+        if not isfile(source):
+            return False
+
+        makedirs_(dirname(destination))
+        rename(source, destination)
+        return True
+
+    def migrate_flat_logs(self):
+        """
+        Moves every log still stored in the flat layout into its shard and
+        returns the number of logs moved.
+        """
+        migrated = 0
+        for identifier, compressed in list(self.iter_flat_logs()):
+            if self.migrate(identifier, compressed=compressed):
+                logger.debug("Migrated task log %s (compressed: %s)",
+                             identifier, compressed)
+                migrated += 1
+        return migrated
+
+    def iter_flat_logs(self):
+        """Yields ``(identifier, compressed)`` for logs not yet migrated"""
+        return super(ShardedTaskLogStorage, self).iter_logs()
+
+    def iter_logs(self):
+        for item in self.iter_flat_logs():
+            yield item
+
+        for shard_dir in self._iter_shard_dirs(self.root, self.depth):
+            for filename in listdir(shard_dir):
+                if not isfile(join(shard_dir, filename)):
+                    continue
+                if filename.endswith(COMPRESSED_SUFFIX):
+                    yield filename[:-len(COMPRESSED_SUFFIX)], True
+                else:
+                    yield filename, False
+
+    def _iter_shard_dirs(self, directory, depth):
+        try:
+            entries = listdir(directory)
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+            return
+
+        for entry in entries:
+            path = join(directory, entry)
+            if len(entry) != 2 or not isdir(path):
+                continue
+            if depth == 1:
+                yield path
+            else:
+                for shard_dir in self._iter_shard_dirs(path, depth - 1):
+                    yield shard_dir
+
+
+STORAGE_BACKENDS = {
+    "flat": FlatTaskLogStorage,
+    "sharded": ShardedTaskLogStorage}
+
+
+def load_tasklog_storage(name, root, **kwargs):
+    """
+    Constructs and returns a task log storage backend.
+
+    :param string name:
+        Either the name of one of the builtin backends (``flat`` or
+        ``sharded``) or the import path of a :class:`TaskLogStorage` subclass
+        in the form ``module.path:ClassName``
+
+    :param string root:
+        The location logs should be stored in, passed to the backend
+        as its first argument
+
+    :raises ValueError:
+        Raised if ``name`` does not refer to a known backend
+    """
+    if name in STORAGE_BACKENDS:
+        backend = STORAGE_BACKENDS[name]
+    elif ":" in name:
+        module_name, class_name = name.split(":", 1)
+        backend = getattr(import_module(module_name), class_name)
+    else:
+        raise ValueError("Unknown task log storage backend %r" % name)
+
+    return backend(root, **kwargs)
+
+
+_storage = None
+
+
+def get_tasklog_storage():
+    """
+    Returns the task log storage backend configured by ``tasklogs_storage``
+    and ``tasklogs_dir``.  The backend is only constructed once per process.
+    """
+    global _storage
+    if _storage is None:
+        name = config.get("tasklogs_storage")
+        kwargs = {}
+        if name == "sharded":
+            kwargs.update(depth=config.get("tasklogs_shard_depth"))
+        _storage = load_tasklog_storage(
+            name, config.get("tasklogs_dir"), **kwargs)
+    return _storage
@@ -26,6 +26,9 @@ import os
 import time
 import warnings
 import uuid
+from errno import ENOENT
+from gzip import GzipFile
+from io import BytesIO
 from unittest import TestCase
 
 try:
@@ -54,6 +57,7 @@ from sqlalchemy.exc import SAWarning
 from werkzeug.utils import cached_property
 
 from pyfarm.master.application import get_application, db, before_request
+from pyfarm.master.tasklog_storage import TaskLogStorage
 
 
 class JsonResponseMixin(object):
@@ -255,4 +259,120 @@ class BaseTestCase(TestCase):
         self.assert_status(response, status_code=INTERNAL_SERVER_ERROR)
 
     def assert_unsupported_media_type(self, response):
-        self.assert_status(response, status_code=UNSUPPORTED_MEDIA_TYPE)
\ No newline at end of file
+        self.assert_status(response, status_code=UNSUPPORTED_MEDIA_TYPE)
+
+
+class InMemoryTaskLogStorage(TaskLogStorage):
+    """
+    Task log storage which keeps all logs in a dictionary.  It stands in for
+    backends which do not store logs as files, such as an object store, so
+    tests can check that task logs are only handled through the interface
+    of :class:`.TaskLogStorage`.  Compressed logs are kept gzipped.
+    """
+    def __init__(self, root=None):
+        self.root = root
+        self.objects = {}
+
+    def get(self, identifier, compressed):
+        try:
+            return self.objects[(identifier, compressed)]
+        except KeyError:
+            raise IOError(ENOENT, "No such task log", identifier)
+
+    def acceptable(self, identifier):
+        return "/" not in identifier and identifier not in ("", ".", "..")
+
+    def open(self, identifier):
+        return BytesIO(self.get(identifier, False))
+
+    def open_compressed(self, identifier):
+        return GzipFile(
+            fileobj=BytesIO(self.get(identifier, True)), mode="rb")
+
+    def write(self, identifier, stream):
+        self.objects[(identifier, False)] = stream.read()
+
+    def compress(self, identifier):
+        data = self.get(identifier, False)
+        compressed = BytesIO()
+        gzip_file = GzipFile(fileobj=compressed, mode="wb")
+        try:
+            gzip_file.write(data)
+        finally:
+            gzip_file.close()
+        self.objects[(identifier, True)] = compressed.getvalue()
+        self.remove(identifier)
+
+    def remove(self, identifier, compressed=False):
+        self.objects.pop((identifier, compressed), None)
+
+    def iter_logs(self):
+        return iter(list(self.objects))
+
+
+def create_jobtype_version(name="foo"):
+    """
+    Adds a job type named ``name`` with a single version to the session
+    and returns the version.
+    """
+    from pyfarm.models.jobtype import JobType, JobTypeVersion
+
+    jobtype = JobType(name=name, description="this is a job type")
+    jobtype_version = JobTypeVersion(
+        jobtype=jobtype, version=1, classname="Foobar",
+        code=("class Foobar(JobType): pass").encode("utf-8"))
+    db.session.add(jobtype_version)
+    db.session.flush()
+    return jobtype_version
+
+
+def create_job(jobtype_version, task_states=(), state=None, **kwargs):
+    """
+    Adds a job of ``jobtype_version`` with one task per entry in
+    ``task_states`` to the session and returns it.  Keyword arguments are
+    passed on to :class:`.Job`, the title defaults to ``Test Job``.
+
+    The states of the job and its tasks are set directly in the database so
+    the listeners on ``Job.state`` and ``Task.state``, which would require
+    agents for running tasks, are not triggered.  The task counts
+    maintained on the job are updated to match.
+    """
+    from pyfarm.models.job import Job
+    from pyfarm.models.task import Task
+
+    kwargs.setdefault("title", "Test Job")
+    job = Job(jobtype_version=jobtype_version, **kwargs)
+    tasks = [Task(job=job, frame=frame) for frame in range(len(task_states))]
+    db.session.add_all([job] + tasks)
+    db.session.flush()
+
+    for task, task_state in zip(tasks, task_states):
+        if task_state is not None:
+            Task.query.filter_by(id=task.id).update(
+                {"state": task_state}, synchronize_session=False)
+    if any(task_state is not None for task_state in task_states):
+        Job.update_task_counts([job.id])
+        db.session.expire(job, ["num_active_tasks", "num_failed_tasks"])
+    if state is not None:
+        Job.query.filter_by(id=job.id).update(
+            {"state": state}, synchronize_session=False)
+    return job
+
+
+def create_agent(number=1, state=None, **kwargs):
+    """
+    Adds an agent named ``agent<number>`` to the session and returns it.
+    Keyword arguments are passed on to :class:`.Agent`.
+    """
+    from pyfarm.models.agent import Agent
+
+    values = {"hostname": "agent%s" % number, "port": 50000,
+              "remote_ip": "10.0.0.%s" % number, "ram": 1024,
+              "free_ram": 1024, "cpus": 1}
+    values.update(kwargs)
+    agent = Agent(**values)
+    if state is not None:
+        agent.state = state
+    db.session.add(agent)
+    db.session.flush()
+    return agent
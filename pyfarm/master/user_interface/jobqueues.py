@@ -20,22 +20,30 @@ except ImportError:  # pragma: no cover
     from http.client import SEE_OTHER, NOT_FOUND
 
 from flask import render_template, request, redirect, url_for, flash
-from sqlalchemy import or_
+from sqlalchemy import or_, func, distinct
 
 from pyfarm.core.logger import getLogger
-from pyfarm.core.enums import WorkState
+from pyfarm.core.enums import WorkState, AgentState
 from pyfarm.master.application import db
+from pyfarm.models.agent import Agent
 from pyfarm.models.jobqueue import JobQueue
 from pyfarm.models.job import Job
+from pyfarm.models.task import Task
 
 logger = getLogger("ui.jobqueues")
 
 def jobqueues():
-    jobqueues = JobQueue.query.filter_by(parent_jobqueue_id=None).all()
-    jobqueues = sorted(jobqueues, key=lambda x: x.num_assigned_agents(),
-                       reverse=True)
-
-    top_level_jobs_query = Job.query.filter_by(queue=None)
+    # All aggregates for the whole tree come from one query, the queues and
+    # jobs are then loaded with one query each and grouped by their parent
+    tree = JobQueue.tree()
+    child_queues = {}
+    for queue in JobQueue.query:
+        queue.assigned_agents_count = tree[queue.id]["num_assigned_agents"]
+        child_queues.setdefault(queue.parent_jobqueue_id, []).append(queue)
+    for queues in child_queues.values():
+        queues.sort(key=lambda x: x.num_assigned_agents(), reverse=True)
+
+    jobs_query = Job.query
 
     filters = {}
     if ("state_paused" not in request.args and
@@ -75,19 +83,36 @@ def jobqueues():
     if filters["state_failed"]:
         wanted_states.append(WorkState.FAILED)
     if filters["state_queued"]:
-        top_level_jobs_query = top_level_jobs_query.filter(or_(
+        jobs_query = jobs_query.filter(or_(
             Job.state == None,
             Job.state.in_(wanted_states)))
     else:
-        top_level_jobs_query = top_level_jobs_query.filter(
-            Job.state.in_(wanted_states))
-
-    top_level_jobs = sorted(top_level_jobs_query.all(),
-                            key=lambda x: x.num_assigned_agents(), reverse=True)
+        jobs_query = jobs_query.filter(Job.state.in_(wanted_states))
+
+    jobs = jobs_query.all()
+    assigned_agents_query = db.session.query(
+        Task.job_id, func.count(distinct(Task.agent_id))).\
+            join(Agent, Agent.id == Task.agent_id).\
+                filter(Task.job_id.in_([x.id for x in jobs]),
+                       or_(Task.state == None,
+                           Task.state == WorkState.RUNNING),
+                       Agent.state != AgentState.OFFLINE,
+                       Agent.state != AgentState.DISABLED).\
+                    group_by(Task.job_id)
+    assigned_agents = dict(assigned_agents_query) if jobs else {}
+
+    child_jobs = {}
+    for job in jobs:
+        job.assigned_agents_count = assigned_agents.get(job.id, 0)
+        child_jobs.setdefault(job.job_queue_id, []).append(job)
+    for queue_jobs in child_jobs.values():
+        queue_jobs.sort(key=lambda x: x.num_assigned_agents(), reverse=True)
 
     return render_template("pyfarm/user_interface/jobqueues.html",
-                           jobqueues=jobqueues, top_level_jobs=top_level_jobs,
-                           WorkState=WorkState, filters=filters)
+                           jobqueues=child_queues.get(None, []),
+                           top_level_jobs=child_jobs.get(None, []),
+                           child_queues=child_queues, child_jobs=child_jobs,
+                           tree=tree, WorkState=WorkState, filters=filters)
 
 def jobqueue_create():
     if request.method == 'POST':
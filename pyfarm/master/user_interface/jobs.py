@@ -14,6 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+from calendar import timegm
 from decimal import Decimal
 from datetime import datetime, timedelta
 
@@ -25,12 +27,14 @@ except ImportError:  # pragma: no cover
         BAD_REQUEST, NOT_FOUND, SEE_OTHER, INTERNAL_SERVER_ERROR)
 
 from flask import render_template, request, redirect, url_for, flash
-from sqlalchemy.orm import aliased
-from sqlalchemy import func, desc, asc, or_, distinct
+from sqlalchemy.orm import aliased, undefer_group
+from sqlalchemy import (
+    Integer, func, desc, asc, or_, and_, case, distinct, select, type_coerce)
 
 from pyfarm.core.logger import getLogger
-from pyfarm.core.enums import WorkState, _WorkState, AgentState
-from pyfarm.scheduler.tasks import delete_job, stop_task, assign_tasks
+from pyfarm.core.enums import WorkState, _WorkState, AgentState, NUMERIC_TYPES
+from pyfarm.scheduler.tasks import (
+    delete_job, stop_tasks_on_agent, assign_tasks)
 from pyfarm.models.job import (
     Job, JobDependency, JobTagAssociation, JobNotifiedUser)
 from pyfarm.models.tag import Tag, JobTagRequirement
@@ -39,79 +43,81 @@ from pyfarm.models.agent import Agent
 from pyfarm.models.jobqueue import JobQueue
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.user import User
+from pyfarm.models.core.functions import epoch_seconds
 from pyfarm.master.application import db
 from pyfarm.master.config import config
+from pyfarm.master.utility import jsonify
 
 logger = getLogger("ui.jobs")
 
-def jobs():
-    queued_count_query = db.session.query(
-        Task.job_id, func.count('*').label('t_queued')).\
-            filter(Task.state == None).group_by(Task.job_id).subquery()
-    running_count_query = db.session.query(
-        Task.job_id, func.count('*').label('t_running')).\
-            filter(Task.state == WorkState.RUNNING).\
-                group_by(Task.job_id).subquery()
-    done_count_query = db.session.query(
-        Task.job_id, func.count('*').label('t_done')).\
-            filter(Task.state == WorkState.DONE).\
-                group_by(Task.job_id).subquery()
-    failed_count_query = db.session.query(
-        Task.job_id, func.count('*').label('t_failed')).\
-            filter(Task.state == WorkState.FAILED).\
-                group_by(Task.job_id).subquery()
+def task_aggregates_query():
+    """
+    Returns a query for the number of queued, running and done tasks and the
+    number of agents working on each job, all computed in a single pass over
+    the tasks table.  The number of failed tasks is maintained on the job
+    itself, see :attr:`Job.num_failed_tasks`.
+    """
+    def count_state(state):
+        return func.coalesce(func.sum(case([(state, 1)], else_=0)), 0)
+
+    working = and_(or_(Task.state == None, Task.state == WorkState.RUNNING),
+                   Agent.state != AgentState.OFFLINE)
+    return db.session.query(
+        Task.job_id,
+        count_state(Task.state == None).label("t_queued"),
+        count_state(Task.state == WorkState.RUNNING).label("t_running"),
+        count_state(Task.state == WorkState.DONE).label("t_done"),
+        func.count(distinct(case([(working, Task.agent_id)]))).label(
+            "agent_count")).\
+                outerjoin(Agent, Task.agent_id == Agent.id).\
+                    group_by(Task.job_id)
+
+
+def job_aggregates(jobs):
+    """
+    Returns a dictionary mapping the id of each of ``jobs`` to its task
+    counts, agent count, number of child jobs and number of unfinished
+    parent jobs.  The number of failed tasks and of unfinished parents are
+    read from the counters maintained on each job, the rest is only
+    computed for the given jobs, so the cost depends on the size of a page
+    instead of the number of jobs in the farm.
+    """
+    aggregates = {}
+    for job in jobs:
+        aggregates[job.id] = {
+            "t_queued": 0, "t_running": 0, "t_done": 0,
+            "t_failed": job.num_failed_tasks, "agent_count": 0,
+            "child_count": 0, "blocker_count": job.num_unfinished_parents}
+    if not aggregates:
+        return aggregates
+
+    task_query = task_aggregates_query().filter(
+        Task.job_id.in_(list(aggregates)))
+    for job_id, t_queued, t_running, t_done, agent_count in task_query:
+        aggregates[job_id].update(
+            t_queued=int(t_queued), t_running=int(t_running),
+            t_done=int(t_done), agent_count=agent_count)
+
     child_count_query = db.session.query(
-        JobDependency.c.parentid, func.count('*').label('child_count')).\
-                group_by(JobDependency.c.parentid).subquery()
-    blocker_count_query = db.session.query(
-        JobDependency.c.childid, func.count('*').label('blocker_count')).\
-            join(Job, Job.id == JobDependency.c.parentid).\
-                filter(or_(Job.state == None, Job.state != WorkState.DONE)).\
-                    group_by(JobDependency.c.childid).subquery()
-    agent_count_query = db.session.query(
-        Task.job_id, func.count(distinct(Task.agent_id)).label('agent_count')).\
-            filter(Task.agent_id != None, or_(Task.state == None,
-                                              Task.state == WorkState.RUNNING),
-                   Task.agent.has(Agent.state != AgentState.OFFLINE)).\
-                group_by(Task.job_id).subquery()
+        JobDependency.c.parentid, func.count("*")).\
+            filter(JobDependency.c.parentid.in_(list(aggregates))).\
+                group_by(JobDependency.c.parentid)
+    for job_id, child_count in child_count_query:
+        aggregates[job_id]["child_count"] = child_count
+
+    return aggregates
 
+
+def jobs():
     jobs_query = db.session.query(Job,
-                                  func.coalesce(
-                                      queued_count_query.c.t_queued,
-                                      0).label('t_queued'),
-                                  func.coalesce(
-                                      running_count_query.c.t_running,
-                                      0).label('t_running'),
-                                  func.coalesce(
-                                      done_count_query.c.t_done,
-                                      0).label('t_done'),
-                                  func.coalesce(
-                                      failed_count_query.c.t_failed,
-                                      0).label('t_failed'),
                                   User.username,
                                   JobType.name.label('jobtype_name'),
                                   JobType.id.label('jobtype_id'),
-                                  JobQueue.fullpath.label('jobqueue_path'),
-                                  func.coalesce(
-                                      child_count_query.c.child_count,
-                                      0).label('child_count'),
-                                  func.coalesce(
-                                      blocker_count_query.c.blocker_count,
-                                      0).label('blocker_count'),
-                                  func.coalesce(
-                                      agent_count_query.c.agent_count,
-                                      0).label('agent_count')).\
+                                  JobQueue.fullpath.label('jobqueue_path')).\
         join(JobTypeVersion, Job.jobtype_version_id == JobTypeVersion.id).\
         join(JobType, JobTypeVersion.jobtype_id == JobType.id).\
         outerjoin(JobQueue, Job.job_queue_id == JobQueue.id).\
-        outerjoin(queued_count_query, Job.id == queued_count_query.c.job_id).\
-        outerjoin(running_count_query, Job.id == running_count_query.c.job_id).\
-        outerjoin(done_count_query, Job.id == done_count_query.c.job_id).\
-        outerjoin(failed_count_query, Job.id == failed_count_query.c.job_id).\
-        outerjoin(User, Job.user_id == User.id).\
-        outerjoin(child_count_query, Job.id == child_count_query.c.parentid).\
-        outerjoin(blocker_count_query, Job.id == blocker_count_query.c.childid).\
-        outerjoin(agent_count_query, Job.id == agent_count_query.c.job_id)
+        outerjoin(User, Job.user_id == User.id)
 
     filters = {}
     if "tags" in request.args:
@@ -192,11 +198,9 @@ def jobs():
         filters["not_blocked"] = ("not_blocked" in request.args and
                                   request.args["not_blocked"].lower() == "true")
     if not filters["blocked"]:
-        jobs_query = jobs_query.filter(
-            blocker_count_query.c.blocker_count == None)
+        jobs_query = jobs_query.filter(Job.num_unfinished_parents == 0)
     if not filters["not_blocked"]:
-        jobs_query = jobs_query.filter(
-            blocker_count_query.c.blocker_count != None)
+        jobs_query = jobs_query.filter(Job.num_unfinished_parents > 0)
 
     filters["no_user"] = ("no_user" in request.args and
                           request.args["no_user"].lower() == "true")
@@ -274,19 +278,37 @@ def jobs():
         jobs_query = jobs_query.order_by(asc(Job.priority))
     elif order_by == "priority" and order_dir == "desc":
         jobs_query = jobs_query.order_by(desc(Job.priority))
+    elif order_by == "t_failed" and order_dir == "asc":
+        jobs_query = jobs_query.order_by(asc(Job.num_failed_tasks))
+    elif order_by == "t_failed" and order_dir == "desc":
+        jobs_query = jobs_query.order_by(desc(Job.num_failed_tasks))
+    elif order_by in ("t_queued", "t_running", "t_done", "agent_count"):
+        # Only sorting by one of the aggregates requires computing it for
+        # every job, otherwise it is only computed for the current page
+        task_aggregates = task_aggregates_query().subquery()
+        order = desc if order_dir == "desc" else asc
+        jobs_query = jobs_query.outerjoin(
+            task_aggregates, Job.id == task_aggregates.c.job_id).order_by(
+                order(func.coalesce(task_aggregates.c[order_by], 0)))
     else:
         jobs_query = jobs_query.order_by("%s %s" % (order_by, order_dir))
 
     jobs_query = jobs_query.order_by(Job.id)
 
-    jobs_count = jobs_query.count()
-    queued_jobs_count = jobs_query.filter(Job.state == None).count()
-    running_jobs_count = jobs_query.filter(
-        Job.state == WorkState.RUNNING).count()
-    failed_jobs_count = jobs_query.filter(Job.state == WorkState.FAILED).count()
-    done_jobs_count = jobs_query.filter(Job.state == WorkState.DONE).count()
+    # The total and the number of jobs in each state in a single pass
+    states = jobs_query.with_entities(Job.state.label("state")).\
+        order_by(None).subquery()
 
-    jobs_subquery = jobs_query.subquery()
+    def count_state(state):
+        return func.sum(case([(state, 1)], else_=0))
+
+    (jobs_count, queued_jobs_count, running_jobs_count, failed_jobs_count,
+     done_jobs_count) = [int(x or 0) for x in db.session.query(
+        func.count(),
+        count_state(states.c.state == None),
+        count_state(states.c.state == WorkState.RUNNING),
+        count_state(states.c.state == WorkState.FAILED),
+        count_state(states.c.state == WorkState.DONE)).one()]
 
     per_page = int(request.args.get("per_page", 100))
     page = int(request.args.get("page", 1))
@@ -302,20 +324,40 @@ def jobs():
         all_pages = range(0, num_pages)
 
     jobs = jobs_query.all()
-    users_query = User.query.order_by(User.username)
+    job_ids = [job[0].id for job in jobs]
+    aggregates_by_job_id = job_aggregates([job[0] for job in jobs])
 
-    jobtypes_query = JobType.query
+    users_query = db.session.query(User.id, User.username).\
+        order_by(User.username)
 
-    tags_by_job_query = db.session.query(JobTagAssociation.c.job_id, Tag.tag).\
-        join(Tag, JobTagAssociation.c.tag_id==Tag.id).all()
-    tags_by_job_id = {}
-    for association in tags_by_job_query:
-        if association[0] not in tags_by_job_id:
-            tags_by_job_id[association[0]] = [association[1]]
-        else:
-            tags_by_job_id[association[0]] += [association[1]]
+    jobtypes_query = db.session.query(JobType.id, JobType.name)
 
-    jobqueues = JobQueue.query.order_by(JobQueue.fullpath).all()
+    tags_by_job_id = {}
+    tag_requirements_by_job_id = {}
+    if job_ids:
+        tags_by_job_query = db.session.query(
+            JobTagAssociation.c.job_id, Tag.tag).\
+                join(Tag, JobTagAssociation.c.tag_id == Tag.id).\
+                    filter(JobTagAssociation.c.job_id.in_(job_ids))
+        for job_id, tag in tags_by_job_query:
+            tags_by_job_id.setdefault(job_id, []).append(tag)
+
+        tag_requirements_query = db.session.query(
+            JobTagRequirement.job_id, JobTagRequirement.negate, Tag.tag).\
+                join(Tag, JobTagRequirement.tag_id == Tag.id).\
+                    filter(JobTagRequirement.job_id.in_(job_ids))
+        for job_id, negate, tag in tag_requirements_query:
+            tag_requirements_by_job_id.setdefault(job_id, []).append(
+                {"negate": negate, "tag": tag})
+
+    jobqueues = []
+    jobqueues_query = db.session.query(JobQueue.id, JobQueue.fullpath).\
+        order_by(JobQueue.fullpath)
+    for jobqueue_id, fullpath in jobqueues_query:
+        # Only load the queue itself if its path has not been cached yet
+        jobqueues.append({
+            "id": jobqueue_id,
+            "path": fullpath or JobQueue.query.get(jobqueue_id).path()})
 
     available_priorities = db.session.query(distinct(Job.priority)).all()
     available_priorities = set(x[0] for x in available_priorities)
@@ -332,7 +374,11 @@ def jobs():
                            no_state_filters=no_state_filters, users=users_query,
                            filters_and_order=filters_and_order,
                            jobtypes=jobtypes_query,
-                           tags_by_job_id=tags_by_job_id, jobs_count=jobs_count,
+                           tags_by_job_id=tags_by_job_id,
+                           tag_requirements_by_job_id=\
+                               tag_requirements_by_job_id,
+                           aggregates_by_job_id=aggregates_by_job_id,
+                           jobs_count=jobs_count,
                            all_pages=all_pages, num_pages=num_pages,
                            filters_and_order_wo_pagination=\
                                filters_and_order_wo_pagination,
@@ -343,62 +389,164 @@ def jobs():
                            done_jobs_count=done_jobs_count,
                            priorities=available_priorities)
 
+def task_sort_keys(order_by, now):
+    """
+    Returns the expressions tasks are ordered by for ``order_by``.  The last
+    expression is always the task id, so together they uniquely identify
+    a position in the list of tasks that a page can continue from.  None of
+    the expressions can be NULL, so comparing against them works the same
+    on every database.
+    """
+    if order_by == "frame":
+        return [Task.frame, func.coalesce(Task.tile, -1), Task.id]
+    elif order_by == "state":
+        return [func.coalesce(type_coerce(Task.state, Integer), 0), Task.id]
+    elif order_by == "runtime":
+        # Runtime in seconds, with running tasks counted up to ``now``
+        runtime = (
+            epoch_seconds(func.coalesce(Task.time_finished, now)) -
+            epoch_seconds(Task.time_started))
+        return [func.coalesce(runtime, 0), Task.id]
+    elif order_by == "failures":
+        return [Task.failures, Task.id]
+    elif order_by == "progress":
+        return [func.coalesce(Task.progress, 0.0), Task.id]
+    raise ValueError("Unknown order key %r" % order_by)
+
+
+def tasks_page(job, order_by, order_dir, now, after=None, per_page=100):
+    """
+    Returns one page of tasks in ``job`` and the position the next page
+    starts after, or ``None`` if this is the last page.
+
+    Pages are selected by comparing against the sort keys of the last task
+    on the previous page (keyset pagination) instead of using an offset,
+    so every page is equally cheap to fetch no matter how many tasks the
+    job has.  Each row is a tuple of the task and the hostname, cpus and
+    ram of its agent, which are joined in instead of lazily loaded for
+    every task.
+    """
+    keys = task_sort_keys(order_by, now)
+    order = desc if order_dir == "desc" else asc
+    query = db.session.query(
+        Task, Agent.hostname, Agent.cpus, Agent.ram, *keys).\
+            outerjoin(Agent, Task.agent_id == Agent.id).\
+                filter(Task.job_id == job.id).\
+                    order_by(*[order(key) for key in keys])
+
+    if after is not None:
+        if len(after) != len(keys):
+            raise ValueError("Invalid page position %r" % (after, ))
+        conditions = []
+        for i, key in enumerate(keys):
+            compare = key < after[i] if order_dir == "desc" else key > after[i]
+            conditions.append(and_(
+                compare, *[keys[j] == after[j] for j in range(i)]))
+        query = query.filter(or_(*conditions))
+
+    rows = query.limit(per_page + 1).all() if per_page > 0 else query.all()
+    next_after = None
+    if per_page > 0 and len(rows) > per_page:
+        rows = rows[:per_page]
+        next_after = [float(x) if isinstance(x, Decimal) else x
+                      for x in rows[-1][4:]]
+
+    return [tuple(row[:4]) for row in rows], next_after
+
+
+def parse_tasks_page_args():
+    """
+    Reads the ordering and page position of the task list on the single
+    job page from the request.  Raises :class:`ValueError` with a message
+    suitable for the user if any of them are invalid.
+    """
+    order_by = request.args.get("order_by", "frame")
+    if order_by not in ["frame", "state", "runtime", "failures", "progress"]:
+        raise ValueError(
+            "Unknown order key %r. Options are 'frame', 'state', "
+            "'runtime', 'progress', or 'failures'" % order_by)
+    order_dir = request.args.get("order_dir", "asc")
+    if order_dir not in ["asc", "desc"]:
+        raise ValueError(
+            "Unknown order direction %r. Options are 'asc' or 'desc'" %
+            order_dir)
+
+    now = datetime.utcnow()
+    if "now" in request.args:
+        try:
+            now = datetime.utcfromtimestamp(int(request.args["now"]))
+        except (ValueError, OverflowError, OSError):
+            raise ValueError(
+                "now must be a unix timestamp, not %r" % request.args["now"])
+    after = None
+    if "after" in request.args:
+        try:
+            after = json.loads(request.args["after"])
+        except ValueError:
+            after = None
+        if (not isinstance(after, list) or
+                not all(isinstance(x, NUMERIC_TYPES) and
+                        not isinstance(x, bool) for x in after)):
+            raise ValueError(
+                "after must be a list of numbers, not %r" %
+                request.args["after"])
+    try:
+        per_page = int(request.args.get("per_page", 100))
+    except ValueError:
+        raise ValueError(
+            "per_page must be an integer, not %r" % request.args["per_page"])
+
+    return order_by, order_dir, now, after, per_page
+
+
+def next_tasks_page_url(job, order_by, order_dir, now, after, per_page):
+    if after is None:
+        return None
+    return url_for("single_job_tasks_page_ui", job_id=job.id,
+                   order_by=order_by, order_dir=order_dir,
+                   now=timegm(now.utctimetuple()), per_page=per_page,
+                   after=json.dumps(after))
+
+
 def single_job(job_id):
-    job = Job.query.filter_by(id=job_id).first()
+    job = Job.query.options(undefer_group("payload")).filter_by(
+        id=job_id).first()
     if not job:
         return (render_template(
                     "pyfarm/error.html", error="Job %s not found" % job_id),
                 NOT_FOUND)
 
-    first_task = Task.query.filter_by(job=job).order_by("frame asc").first()
-    last_task = Task.query.filter_by(job=job).order_by("frame desc").first()
-
-    tasks_query = Task.query.filter(Task.job == job)
-
-    order_dir = "asc"
-    order_by = "frame"
-    if "order_by" in request.args:
-        order_by = request.args.get("order_by")
-    if order_by not in ["frame", "state", "runtime", "failures", "progress"]:
-        return (render_template(
-            "pyfarm/error.html",
-            error="Unknown order key %r. Options are 'frame', 'state', "
-                  "'runtime', 'progress', or 'failures''" % order_by),
-            BAD_REQUEST)
-    if "order_dir" in request.args:
-        order_dir = request.args.get("order_dir")
-        if order_dir not in ["asc", "desc"]:
-            return (render_template(
-            "pyfarm/error.html",
-            error="Unknown order direction %r. Options are 'asc' or 'desc'" %
-                  order_dir),
-            BAD_REQUEST)
-    if order_by == "frame" and order_dir == "desc":
-        tasks_query = tasks_query.order_by(desc(Task.frame)).\
-            order_by(desc(Task.tile))
-    elif order_by == "frame" and order_dir == "asc":
-        tasks_query = tasks_query.order_by(asc(Task.frame)).\
-            order_by(asc(Task.tile))
-    elif order_by == "state" and order_dir == "desc":
-        tasks_query = tasks_query.order_by(desc(Task.state))
-    elif order_by == "state" and order_dir == "asc":
-        tasks_query = tasks_query.order_by(asc(Task.state))
-    # Note: Those time operations do not seem to work in sqlite
-    elif order_by == "runtime" and order_dir == "asc":
-        tasks_query = tasks_query.order_by(asc(
-            func.coalesce(Task.time_finished, datetime.utcnow()) -
-            Task.time_started))
-    elif order_by == "runtime" and order_dir == "desc":
-        tasks_query = tasks_query.order_by(desc(
-            func.coalesce(Task.time_finished, datetime.utcnow()) -
-            Task.time_started))
-    else:
-        tasks_query = tasks_query.order_by("%s %s" % (order_by, order_dir))
-    tasks = tasks_query.all()
-
-    jobqueues = JobQueue.query.all()
+    try:
+        order_by, order_dir, now, after, per_page = parse_tasks_page_args()
+        tasks, next_after = tasks_page(
+            job, order_by, order_dir, now, after, per_page)
+    except ValueError as e:
+        return (render_template("pyfarm/error.html", error=str(e)),
+                BAD_REQUEST)
 
-    users_query = User.query.filter(User.email != None).order_by(User.username)
+    first_frame, last_frame = db.session.query(
+        func.min(Task.frame), func.max(Task.frame)).\
+            filter(Task.job_id == job.id).one()
+
+    task_counts = {"queued": 0, "running": 0, "done": 0, "failed": 0,
+                   "paused": 0, "total": 0}
+    task_counts_query = db.session.query(Task.state, func.count(Task.id)).\
+        filter(Task.job_id == job.id).group_by(Task.state)
+    for state, count in task_counts_query:
+        task_counts[str(state) if state else "queued"] = count
+        task_counts["total"] += count
+
+    jobqueues = []
+    jobqueues_query = db.session.query(JobQueue.id, JobQueue.fullpath).\
+        order_by(JobQueue.fullpath)
+    for jobqueue_id, fullpath in jobqueues_query:
+        # Only load the queue itself if its path has not been cached yet
+        jobqueues.append({
+            "id": jobqueue_id,
+            "path": fullpath or JobQueue.query.get(jobqueue_id).path()})
+
+    users_query = db.session.query(User.id, User.username, User.email).\
+        filter(User.email != None).order_by(User.username)
 
     latest_jobtype_version = db.session.query(JobTypeVersion.version).filter_by(
             jobtype=job.jobtype_version.jobtype).\
@@ -414,14 +562,92 @@ def single_job(job_id):
             divmod(remainder, 60)
 
     return render_template("pyfarm/user_interface/job.html", job=job,
-                           tasks=tasks, first_task=first_task,
-                           last_task=last_task, queues=jobqueues,
-                           users=users_query,
+                           tasks=tasks, first_frame=first_frame,
+                           last_frame=last_frame, task_counts=task_counts,
+                           queues=jobqueues, users=users_query,
                            latest_jobtype_version=latest_jobtype_version[0],
-                           now=datetime.utcnow(),
+                           now=now,
+                           next_tasks_page_url=next_tasks_page_url(
+                               job, order_by, order_dir, now, next_after,
+                               per_page),
                            autodelete_time=autodelete_time,
                            order_by=order_by, order_dir=order_dir)
 
+def single_job_tasks_page(job_id):
+    job = Job.query.filter_by(id=job_id).first()
+    if not job:
+        return jsonify(error="Job %s not found" % job_id), NOT_FOUND
+
+    try:
+        order_by, order_dir, now, after, per_page = parse_tasks_page_args()
+        tasks, next_after = tasks_page(
+            job, order_by, order_dir, now, after, per_page)
+    except ValueError as e:
+        return jsonify(error=str(e)), BAD_REQUEST
+
+    return jsonify(
+        tasks=[{"id": task.id,
+                "frame": task.frame,
+                "tile": task.tile,
+                "state": str(task.state) if task.state else None,
+                "agent_id": task.agent_id,
+                "agent_hostname": hostname,
+                "progress": task.progress,
+                "failures": task.failures,
+                "time_started": task.time_started,
+                "time_finished": task.time_finished,
+                "last_error": task.last_error}
+               for task, hostname, _, _ in tasks],
+        html=render_template("pyfarm/user_interface/job_task_rows.html",
+                             job=job, tasks=tasks, now=now),
+        next=next_tasks_page_url(
+            job, order_by, order_dir, now, next_after, per_page))
+
+def load_jobs(job_ids):
+    """
+    Loads all jobs in ``job_ids`` with a single query.  Returns a tuple of
+    the jobs and ``None``, or of ``None`` and an error response if any of
+    the jobs do not exist.
+    """
+    try:
+        job_ids = set(int(x) for x in job_ids)
+    except ValueError as e:
+        return None, (render_template(
+            "pyfarm/error.html", error="Invalid job id: %s" % e), BAD_REQUEST)
+
+    jobs = Job.query.filter(Job.id.in_(job_ids)).all() if job_ids else []
+    missing = job_ids - set(job.id for job in jobs)
+    if missing:
+        return None, (render_template(
+            "pyfarm/error.html", error="Job %s not found" % min(missing)),
+            NOT_FOUND)
+    return jobs, None
+
+def stop_running_tasks(job_ids):
+    """
+    Stops all running tasks in ``job_ids``, with one message for each agent
+    instead of one for each task
+    """
+    if not job_ids:
+        return
+
+    tasks_query = db.session.query(Task.agent_id, Task.id).filter(
+        Task.job_id.in_(job_ids),
+        Task.state == WorkState.RUNNING,
+        Task.agent_id != None)
+    task_ids_by_agent = {}
+    for agent_id, task_id in tasks_query:
+        task_ids_by_agent.setdefault(agent_id, []).append(task_id)
+
+    for agent_id, task_ids in task_ids_by_agent.items():
+        stop_tasks_on_agent.delay(agent_id, task_ids)
+
+def redirect_to_next():
+    if "next" in request.args:
+        return redirect(request.args.get("next"), SEE_OTHER)
+    else:
+        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+
 def delete_single_job(job_id):
     job = Job.query.filter_by(id=job_id).first()
     if not job:
@@ -453,37 +679,26 @@ def delete_single_job(job_id):
 
 
 def delete_multiple_jobs():
-    job_ids = request.form.getlist("job_id")
-
-    job_ids_to_delete = []
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
-
-        job.to_be_deleted = True
-        db.session.add(job)
-        job_ids_to_delete.append(job.id)
-
-        for child in job.children:
-            child.to_be_deleted = True
-            job_ids_to_delete.append(child.id)
-            db.session.add(child)
-
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
+
+    job_ids = set(job.id for job in jobs)
+    if job_ids:
+        job_ids.update(x for x, in db.session.query(
+            JobDependency.c.childid).filter(
+                JobDependency.c.parentid.in_(job_ids)))
+        Job.query.filter(Job.id.in_(job_ids)).update(
+            {"to_be_deleted": True}, synchronize_session=False)
     db.session.commit()
 
-    for id_ in job_ids_to_delete:
+    for id_ in sorted(job_ids):
         logger.info("Marking job %s for deletion", id_)
         delete_job.delay(id_)
 
     flash("Selected jobs will be deleted.")
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def rerun_single_job(job_id):
     job = Job.query.filter_by(id=job_id).first()
@@ -507,27 +722,21 @@ def rerun_single_job(job_id):
         return redirect(url_for("jobs_index_ui"), SEE_OTHER)
 
 def rerun_multiple_jobs():
-    job_ids = request.form.getlist("job_id")
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
 
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
-        job.rerun()
+    for job in jobs:
         logger.info("Job %s (job id: %s) is being rerun by request from %s",
                     job.title, job.id, request.remote_addr)
+    Job.rerun_jobs([job.id for job in jobs])
 
     db.session.commit()
     assign_tasks.delay()
 
     flash("Selected jobs will be run again.")
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def rerun_failed_in_job(job_id):
     job = Job.query.filter_by(id=job_id).first()
@@ -553,29 +762,22 @@ def rerun_failed_in_job(job_id):
         return redirect(url_for("jobs_index_ui"), SEE_OTHER)
 
 def rerun_failed_in_multiple_jobs():
-    job_ids = request.form.getlist("job_id")
-
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
 
+    for job in jobs:
         logger.info("Failed tasks from job %s (job id: %s) are being rerun by "
                     "request from %s",
                     job.title, job.id, request.remote_addr)
-        job.rerun_failed()
-        db.session.commit()
+    Job.rerun_jobs([job.id for job in jobs], failed_only=True)
 
+    db.session.commit()
     assign_tasks.delay()
 
     flash("Failed tasks in selected jobs will be run again.")
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def pause_single_job(job_id):
     job = Job.query.filter_by(id=job_id).first()
@@ -588,49 +790,35 @@ def pause_single_job(job_id):
     db.session.add(job)
     db.session.commit()
 
-    for task in job.tasks:
-        if task.state == WorkState.RUNNING:
-            stop_task.delay(task.id)
-
+    stop_running_tasks([job.id])
     assign_tasks.delay()
 
     flash("Job %s will be paused." % job.title)
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def pause_multiple_jobs():
-    job_ids = request.form.getlist("job_id")
-
-    task_ids_to_stop = []
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
-
-        for task in job.tasks:
-            if task.state == WorkState.RUNNING:
-                task_ids_to_stop.append(task.id)
-
-        job.state = WorkState.PAUSED
-        db.session.add(job)
-
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
+
+    # Pausing a job has no side effects, so the jobs can be updated without
+    # going through the listeners on Job.state.  Children of jobs that were
+    # done are blocked again.
+    job_ids = [job.id for job in jobs]
+    if job_ids:
+        Job.query.filter(Job.id.in_(job_ids)).update(
+            {"state": WorkState.PAUSED}, synchronize_session=False)
+        Job.update_unfinished_parents(select([JobDependency.c.childid]).where(
+            JobDependency.c.parentid.in_(job_ids)))
     db.session.commit()
 
-    for task_id in task_ids_to_stop:
-        stop_task.delay(task_id)
+    stop_running_tasks(job_ids)
     assign_tasks.delay()
 
     flash("Selected jobs will be paused.")
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def unpause_single_job(job_id):
     job = Job.query.filter_by(id=job_id).first()
@@ -654,15 +842,11 @@ def unpause_single_job(job_id):
         return redirect(url_for("jobs_index_ui"), SEE_OTHER)
 
 def unpause_multiple_jobs():
-    job_ids = request.form.getlist("job_id")
-
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
 
+    for job in jobs:
         job.state = None
         job.update_state()
         db.session.add(job)
@@ -673,10 +857,7 @@ def unpause_multiple_jobs():
 
     flash("Selected jobs are unpaused")
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def alter_frames_in_single_job(job_id):
     job = Job.query.filter_by(id=job_id).first()
@@ -748,8 +929,6 @@ def alter_scheduling_parameters_for_job(job_id):
     return redirect(url_for("single_job_ui", job_id=job.id), SEE_OTHER)
 
 def move_multiple_jobs():
-    job_ids = request.form.getlist("job_id")
-
     queue_id = int(request.form['queue'])
     queue = JobQueue.query.filter_by(id=queue_id).first()
     if not queue:
@@ -757,84 +936,70 @@ def move_multiple_jobs():
             "pyfarm/error.html", error="Queue %s not found" % queue_id),
         NOT_FOUND)
 
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
-
-        job.queue = queue
-        db.session.add(job)
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
 
+    job_ids = [job.id for job in jobs]
+    if job_ids:
+        Job.query.filter(Job.id.in_(job_ids)).update(
+            {"job_queue_id": queue.id}, synchronize_session=False)
     db.session.commit()
 
     flash("Selected jobs have been moved to queue %s" % queue.path())
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def set_prio_weight_on_jobs():
-    job_ids = request.form.getlist("job_id")
-
     prio = int(request.form["prio"])
     weight = int(request.form["weight"])
 
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
-
-        job.priority = prio
-        job.weight = weight
-        db.session.add(job)
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
 
+    job_ids = [job.id for job in jobs]
+    if job_ids:
+        Job.query.filter(Job.id.in_(job_ids)).update(
+            {"priority": prio, "weight": weight,
+             "envelope_version": Job.envelope_version + 1},
+            synchronize_session=False)
     db.session.commit()
 
     flash("Priority and weight on selected jobs have been set")
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def add_tag_on_jobs():
-    job_ids = request.form.getlist("job_id")
-
     tag_name = request.form["tag"].strip()
 
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
+
     tag = Tag.query.filter_by(tag=tag_name).first()
     if not tag:
         tag = Tag(tag=tag_name)
         db.session.add(tag)
-
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
-
-        if tag not in job.tags:
-            job.tags.append(tag)
-        db.session.add(job)
-
+        db.session.flush()
+
+    job_ids = set(job.id for job in jobs)
+    if job_ids:
+        job_ids -= set(x for x, in db.session.query(
+            JobTagAssociation.c.job_id).filter(
+                JobTagAssociation.c.tag_id == tag.id,
+                JobTagAssociation.c.job_id.in_(job_ids)))
+    if job_ids:
+        db.session.execute(JobTagAssociation.insert(), [
+            {"job_id": job_id, "tag_id": tag.id} for job_id in job_ids])
+        Job.bump_envelope_version(list(job_ids))
     db.session.commit()
 
     flash("Tag %s has been added to selected jobs." % tag_name)
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def remove_tag_from_jobs():
-    job_ids = request.form.getlist("job_id")
-
     tag_name = request.form["tag"].strip()
 
     tag = Tag.query.filter_by(tag=tag_name).first()
@@ -844,29 +1009,23 @@ def remove_tag_from_jobs():
                         error="Tag %s not found" % tag_name),
                     NOT_FOUND)
 
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
-
-        if tag in job.tags:
-            job.tags.remove(tag)
-        db.session.add(job)
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
 
+    job_ids = [job.id for job in jobs]
+    if job_ids:
+        db.session.execute(JobTagAssociation.delete().where(and_(
+            JobTagAssociation.c.tag_id == tag.id,
+            JobTagAssociation.c.job_id.in_(job_ids))))
+        Job.bump_envelope_version(job_ids)
     db.session.commit()
 
     flash("Tag %s has been removed from selected jobs." % tag_name)
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def add_tag_requirement_on_jobs():
-    job_ids = request.form.getlist("job_id")
-
     tag_name = request.form["tag"].strip()
 
     negate = False
@@ -880,39 +1039,38 @@ def add_tag_requirement_on_jobs():
             negate = True
             tag_name = tag_name[1:]
 
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
+
     tag = Tag.query.filter_by(tag=tag_name).first()
     if not tag:
         tag = Tag(tag=tag_name)
         db.session.add(tag)
-
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
-
-        tag_requirement = JobTagRequirement.query.filter_by(
-            job=job, tag=tag).first()
-        if not tag_requirement:
-            tag_requirement = JobTagRequirement(job=job, tag=tag, negate=negate)
-            db.session.add(tag_requirement)
-        elif tag_requirement.negate != negate:
-            tag_requirement.negate = negate
-            db.session.add(tag_requirement)
-
+        db.session.flush()
+
+    job_ids = set(job.id for job in jobs)
+    if job_ids:
+        requirements = JobTagRequirement.query.filter(
+            JobTagRequirement.tag_id == tag.id,
+            JobTagRequirement.job_id.in_(job_ids))
+        existing_job_ids = set(x for x, in requirements.with_entities(
+            JobTagRequirement.job_id))
+        requirements.filter(JobTagRequirement.negate != negate).update(
+            {"negate": negate}, synchronize_session=False)
+
+        new_job_ids = job_ids - existing_job_ids
+        if new_job_ids:
+            db.session.execute(JobTagRequirement.__table__.insert(), [
+                {"job_id": job_id, "tag_id": tag.id, "negate": negate}
+                for job_id in new_job_ids])
     db.session.commit()
 
     flash("Tag requirement %s has been added to selected jobs." % tag_name)
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def remove_tag_requirement_from_jobs():
-    job_ids = request.form.getlist("job_id")
-
     tag_name = request.form["tag"].strip()
 
     negate = False
@@ -933,26 +1091,22 @@ def remove_tag_requirement_from_jobs():
                         error="Tag %s not found" % tag_name),
                     NOT_FOUND)
 
-    for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
-            return (render_template(
-                        "pyfarm/error.html", error="Job %s not found" % job_id),
-                    NOT_FOUND)
-
-        tag_requirement = JobTagRequirement.query.filter_by(
-            job=job, tag=tag, negate=negate).first()
-        if tag_requirement:
-            db.session.delete(tag_requirement)
-
+    jobs, error = load_jobs(request.form.getlist("job_id"))
+    if error:
+        return error
+
+    job_ids = [job.id for job in jobs]
+    if job_ids:
+        JobTagRequirement.query.filter(
+            JobTagRequirement.tag_id == tag.id,
+            JobTagRequirement.negate == negate,
+            JobTagRequirement.job_id.in_(job_ids)).delete(
+                synchronize_session=False)
     db.session.commit()
 
     flash("Tag requirement %s has been removed from selected jobs." % tag_name)
 
-    if "next" in request.args:
-        return redirect(request.args.get("next"), SEE_OTHER)
-    else:
-        return redirect(url_for("jobs_index_ui"), SEE_OTHER)
+    return redirect_to_next()
 
 def alter_autodeletion_for_job(job_id):
     job = Job.query.filter_by(id=job_id).first()
@@ -15,41 +15,33 @@
 # limitations under the License.
 
 import json
-from calendar import timegm
 from datetime import timedelta, datetime
 
 from flask import render_template, request
 
-from pyfarm.models.statistics.agent_count import AgentCount
+from pyfarm.models.statistics.queries import (
+    agent_count_resolution, agent_counts as query_agent_counts)
 
 
 def agent_counts():
     days_back = int(request.args.get("days_back", 7))
     time_back = timedelta(days=days_back)
 
-    agent_count_query = AgentCount.query.order_by(
-        AgentCount.counted_time).filter(
-            AgentCount.counted_time > datetime.utcnow() - time_back)
-
-    online_agent_counts = []
-    running_agent_counts = []
-    offline_agent_counts = []
-    disabled_agent_counts = []
-    for sample in agent_count_query:
-        timestamp = timegm(sample.counted_time.utctimetuple())
-        online_agent_counts.append([timestamp, sample.num_online])
-        running_agent_counts.append([timestamp, sample.num_running])
-        offline_agent_counts.append([timestamp, sample.num_offline])
-        disabled_agent_counts.append([timestamp, sample.num_disabled])
+    now = datetime.utcnow()
+    counts = query_agent_counts(
+        now - time_back, agent_count_resolution(time_back), now=now)
+
+    def series(column):
+        return list(map(list, zip(counts["timestamps"], counts[column])))
 
     area_chart = ("area_chart" in request.args and
                   request.args["area_chart"].lower() == "true")
 
     return render_template(
         "pyfarm/statistics/agent_counts.html",
-        online_agent_counts_json=json.dumps(online_agent_counts),
-        running_agent_counts_json=json.dumps(running_agent_counts),
-        offline_agent_counts_json=json.dumps(offline_agent_counts),
-        disabled_agent_counts_json=json.dumps(disabled_agent_counts),
+        online_agent_counts_json=json.dumps(series("online")),
+        running_agent_counts_json=json.dumps(series("running")),
+        offline_agent_counts_json=json.dumps(series("offline")),
+        disabled_agent_counts_json=json.dumps(series("disabled")),
         area_chart=area_chart,
         days_back=days_back)
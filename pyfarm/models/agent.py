@@ -25,7 +25,7 @@ import re
 import uuid
 from datetime import datetime
 
-from sqlalchemy import or_
+from sqlalchemy import or_, distinct
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.orm import validates
 from netaddr import AddrFormatError, IPAddress
@@ -42,6 +42,7 @@ from pyfarm.models.core.types import (
     OperatingSystemEnum, AgentStateEnum, MACAddress)
 from pyfarm.models.jobtype import JobTypeVersion
 from pyfarm.models.job import Job
+from pyfarm.models.task import Task
 
 
 __all__ = ("Agent", )
@@ -156,6 +157,7 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         "id", "hostname", "port", "state", "remote_ip",
         "cpus", "ram", "free_ram")
     REPR_CONVERT_COLUMN = {"remote_ip": repr_ip}
+    DICT_CONVERT_COLUMN = {"update_requested": NotImplemented}
     URL_TEMPLATE = config.get("agent_api_url_template")
 
     MIN_PORT = config.get("agent_min_port")
@@ -250,6 +252,13 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         nullable=True,
         doc="The version this agent should upgrade to.")
 
+    update_requested = db.Column(
+        db.DateTime,
+        nullable=True,
+        doc="The last time the agent was asked to upgrade to "
+            ":attr:`upgrade_to`.  Used to limit the number of agents "
+            "downloading an update at the same time.")
+
     restart_requested = db.Column(
         db.Boolean,
         default=False, nullable=False,
@@ -356,6 +365,46 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     def is_disabled(self):
         return self.state == AgentState.DISABLED
 
+    def requeue_tasks(self):
+        """
+        Takes all tasks which are not done or failed away from this agent so
+        they can be assigned to other agents, see
+        :meth:`requeue_agent_tasks`
+        """
+        return Agent.requeue_agent_tasks([self.id])
+
+    @staticmethod
+    def requeue_agent_tasks(agent_ids):
+        """
+        Takes all tasks which are not done or failed away from the agents in
+        ``agent_ids`` with a single update and updates the state of each
+        affected job once.  Returns the ids of the affected jobs.
+
+        Tasks go from running or assigned back to queued, neither changes
+        the task counts of the jobs nor triggers the listeners on
+        :attr:`Task.state`, so the update bypasses them.
+        """
+        db.session.flush()
+
+        tasks = Task.query.filter(
+            Task.agent_id.in_(agent_ids),
+            or_(Task.state == None,
+                ~Task.state.in_([WorkState.DONE, WorkState.FAILED])))
+        job_ids = [job_id for job_id, in
+                   tasks.with_entities(distinct(Task.job_id))]
+        if not job_ids:
+            return []
+
+        tasks.update({"agent_id": None, "state": None},
+                     synchronize_session=False)
+        for instance in list(db.session.identity_map.values()):
+            if isinstance(instance, Task) and instance.job_id in job_ids:
+                db.session.expire(instance)
+
+        for job in Job.query.filter(Job.id.in_(job_ids)):
+            job.update_state()
+        return job_ids
+
     def get_supported_types(self):
         try:
             return self.support_jobtype_versions
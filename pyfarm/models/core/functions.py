@@ -23,9 +23,14 @@ Contains core functions and data for use by :mod:`pyfarm.models`
 """
 
 from uuid import UUID
-from datetime import datetime
+from datetime import datetime, timedelta
 from textwrap import dedent
 
+from sqlalchemy import Integer
+from sqlalchemy.exc import CompileError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
 from pyfarm.core.enums import STRING_TYPES
 from pyfarm.master.application import db
 from pyfarm.master.config import config
@@ -33,6 +38,7 @@ from pyfarm.models.core.types import (
     id_column, IDTypeWork, IPAddress, WorkStateEnum)
 
 DEFAULT_PRIORITY = config.get("queue_default_priority")
+EPOCH = datetime(1970, 1, 1)
 
 
 def modelfor(model, table):
@@ -192,4 +198,99 @@ def repr_enum(value, enum=None):
             return repr(key)
 
     raise KeyError(
-        "%s does not map to a key in %s" % (repr(value), enum.__class__))
\ No newline at end of file
+        "%s does not map to a key in %s" % (repr(value), enum.__class__))
+
+class time_bucket(FunctionElement):
+    """
+    SQL expression which maps a datetime column onto the number of the
+    fixed length time period, counted from the unix epoch, it falls into.
+    This allows time series to be grouped into periods of ``seconds`` length
+    by the database itself:
+
+    >>> bucket = time_bucket(TaskCount.counted_time, 900)
+    >>> db.session.query(bucket, func.count()).group_by(bucket)
+
+    Use :func:`bucket_start` to convert a bucket number back into the
+    datetime its period starts at.  Naive datetimes are treated as UTC.
+    """
+    type = Integer()
+    name = "time_bucket"
+
+    def __init__(self, column, seconds):
+        self.seconds = int(seconds)
+        if self.seconds < 1:
+            raise ValueError("seconds must be at least 1")
+        super(time_bucket, self).__init__(column)
+
+
+@compiles(time_bucket)
+def compile_time_bucket(element, compiler, **kwargs):
+    raise CompileError(
+        "time_bucket() is not supported on %s" % compiler.dialect.name)
+
+
+@compiles(time_bucket, "sqlite")
+def compile_time_bucket_sqlite(element, compiler, **kwargs):
+    return "(CAST(strftime('%%s', %s) AS INTEGER) / %d)" % (
+        compiler.process(element.clauses, **kwargs), element.seconds)
+
+
+@compiles(time_bucket, "postgresql")
+def compile_time_bucket_postgresql(element, compiler, **kwargs):
+    return "CAST(FLOOR(EXTRACT(EPOCH FROM %s) / %d) AS INTEGER)" % (
+        compiler.process(element.clauses, **kwargs), element.seconds)
+
+
+@compiles(time_bucket, "mysql")
+def compile_time_bucket_mysql(element, compiler, **kwargs):
+    # TIMESTAMPDIFF instead of UNIX_TIMESTAMP() so the session's time zone
+    # is not applied to the naive UTC datetimes we store
+    return ("FLOOR(TIMESTAMPDIFF(SECOND, '1970-01-01 00:00:00', %s) / %d)" % (
+        compiler.process(element.clauses, **kwargs), element.seconds))
+
+
+class epoch_seconds(FunctionElement):
+    """
+    SQL expression which converts a datetime column into the number of
+    whole seconds since the unix epoch.  Naive datetimes are treated as UTC.
+    The difference of two of these is the number of seconds between them on
+    every supported database:
+
+    >>> runtime = (epoch_seconds(Task.time_finished) -
+    ...            epoch_seconds(Task.time_started))
+    """
+    type = Integer()
+    name = "epoch_seconds"
+
+
+@compiles(epoch_seconds)
+def compile_epoch_seconds(element, compiler, **kwargs):
+    raise CompileError(
+        "epoch_seconds() is not supported on %s" % compiler.dialect.name)
+
+
+@compiles(epoch_seconds, "sqlite")
+def compile_epoch_seconds_sqlite(element, compiler, **kwargs):
+    return "CAST(strftime('%%s', %s) AS INTEGER)" % (
+        compiler.process(element.clauses, **kwargs))
+
+
+@compiles(epoch_seconds, "postgresql")
+def compile_epoch_seconds_postgresql(element, compiler, **kwargs):
+    return "CAST(FLOOR(EXTRACT(EPOCH FROM %s)) AS BIGINT)" % (
+        compiler.process(element.clauses, **kwargs))
+
+
+@compiles(epoch_seconds, "mysql")
+def compile_epoch_seconds_mysql(element, compiler, **kwargs):
+    # See compile_time_bucket_mysql() for why this is not UNIX_TIMESTAMP()
+    return "TIMESTAMPDIFF(SECOND, '1970-01-01 00:00:00', %s)" % (
+        compiler.process(element.clauses, **kwargs))
+
+
+def bucket_start(bucket, seconds):
+    """
+    Returns the datetime at which the period numbered ``bucket`` by
+    :class:`time_bucket` starts.
+    """
+    return EPOCH + timedelta(seconds=int(bucket) * int(seconds))
@@ -36,6 +36,7 @@ from sqlalchemy.types import (
     TypeDecorator, BigInteger, Integer, UnicodeText, TypeEngine, VARBINARY)
 from sqlalchemy.dialects.postgresql import UUID as POSTGRES_UUID
 from netaddr import AddrFormatError, IPAddress as _IPAddress
+from netaddr.strategy import ipv4 as _ipv4
 
 from pyfarm.master.application import db
 from pyfarm.core.enums import (
@@ -49,6 +50,11 @@ NoneType = type(None)  # from stdlib types module
 JSON_NONE = dumps(None)
 RESUB_GUID_CHARS = re.compile("[{}-]")
 
+# The maximum number of UUIDs :class:`UUIDType` keeps interned.  There
+# are only as many distinct agent ids as there are agents, so once the
+# cache is warm almost every row can reuse an existing object.
+UUID_CACHE_SIZE = 8192
+
 # types which our custom column types will accept via json
 try:
     # pylint: disable=undefined-variable
@@ -207,6 +213,19 @@ class IPAddress(_IPAddress):
         else:
             return super(IPAddress, self).__ne__(other)
 
+    @classmethod
+    def from_int(cls, value):
+        """
+        Produces an IPv4 address from ``value`` without going through the
+        parsing and version detection done by the constructor.  The
+        caller is responsible for ``value`` being a valid IPv4 integer,
+        the string form is only produced once it's requested.
+        """
+        address = cls.__new__(cls)
+        address._value = value
+        address._module = _ipv4
+        return address
+
 
 class IPv4Address(TypeDecorator):
     """
@@ -248,9 +267,7 @@ class IPv4Address(TypeDecorator):
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            value = IPAddress(value)
-            self.checkInteger(int(value))
-            return value
+            return IPAddress.from_int(self.checkInteger(int(value)))
 
 
 class EnumType(TypeDecorator):
@@ -274,6 +291,13 @@ class EnumType(TypeDecorator):
         super(EnumType, self).__init__(*args, **kwargs)
         assert self.enum is not NotImplemented, "`enum` not set"
 
+        # Maps both the integer and the string of each value back to
+        # the value itself so conversions don't have to scan the enum
+        self.values = {}
+        for enum_value in self.enum:
+            self.values[enum_value.int] = enum_value
+            self.values[enum_value.str] = enum_value
+
     def process_bind_param(self, value, dialect):
         """
         Takes ``value`` and maps it to the internal integer.
@@ -293,10 +317,9 @@ class EnumType(TypeDecorator):
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            for enum_value in self.enum:
-                if value == enum_value:
-                    return enum_value
-            else:
+            try:
+                return self.values[value]
+            except (KeyError, TypeError):
                 error_args = (repr(value), repr(self.enum))
                 raise ValueError(
                     "failed to map %s to an enum value in %s" % error_args)
@@ -312,16 +335,20 @@ class UUIDType(TypeDecorator):
     impl = TypeEngine
     json_types = uuid.UUID
 
+    # UUIDs loaded from the database, keyed by the value the
+    # driver returned for them
+    interned = {}
+
     def _to_uuid(self, value):
         if isinstance(value, uuid.UUID):
             return value
 
-        elif isinstance(value, INTEGER_TYPES):
-            return uuid.UUID(int=value)
-
         elif PY3 and isinstance(value, bytes):
             return uuid.UUID(bytes=value)
 
+        elif isinstance(value, INTEGER_TYPES):
+            return uuid.UUID(int=value)
+
         elif isinstance(value, STRING_TYPES):
             try:
                 return uuid.UUID(value)
@@ -354,7 +381,17 @@ class UUIDType(TypeDecorator):
         if value is None:
             return value
 
-        return self._to_uuid(value)
+        try:
+            return self.interned[value]
+        except KeyError:
+            result = self._to_uuid(value)
+            if len(self.interned) >= UUID_CACHE_SIZE:
+                self.interned.clear()
+            self.interned[value] = result
+            return result
+        except TypeError:  # pragma: no cover
+            # Unhashable types, such as the buffers some drivers return
+            return self._to_uuid(value)
 
 
 class OperatingSystemEnum(EnumType):
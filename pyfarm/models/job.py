@@ -31,11 +31,16 @@ except ImportError:  # pragma: no cover
 
 from sys import maxsize
 
-from sqlalchemy import event, distinct, or_, and_
-from sqlalchemy.orm import validates
+from sqlalchemy import (
+    event, distinct, select, func, case, or_, and_, bindparam)
+from sqlalchemy.orm import Session, validates, object_session, deferred
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.inspection import inspect
 
 from pyfarm.core.logger import getLogger
-from pyfarm.core.enums import WorkState, DBWorkState, _WorkState, AgentState
+from pyfarm.core.enums import (
+    WorkState, DBWorkState, _WorkState, AgentState, NOTSET)
 from pyfarm.master.application import db
 from pyfarm.master.config import config
 from pyfarm.models.core.functions import work_columns
@@ -146,6 +151,20 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     REPR_CONVERT_COLUMN = {"state": repr}
     STATE_ENUM = list(WorkState) + [None]
 
+    # Maintained from the parents and tasks of the job and for the
+    # scheduler, not part of its public data
+    DICT_CONVERT_COLUMN = {"num_unfinished_parents": NotImplemented,
+                           "num_active_tasks": NotImplemented,
+                           "num_failed_tasks": NotImplemented,
+                           "envelope_version": NotImplemented}
+
+    # The attributes which are sent to agents along with the tasks of the
+    # job, changing any of them increments :attr:`envelope_version`
+    ENVELOPE_ATTRIBUTES = (
+        "title", "data", "environ", "by", "batch", "ram", "ram_warning",
+        "ram_max", "cpus", "priority", "notes", "num_tiles", "user_id",
+        "user", "jobtype_version_id", "jobtype_version", "tags")
+
     # shared work columns
     id, state, priority, time_submitted, time_started, time_finished = \
         work_columns(None, "job.priority")
@@ -301,22 +320,26 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
             "to save a job for later viewing or if the jobs data "
             "is being populated in a deferred manner.")
 
-    environ = db.Column(
+    # `environ` and `data` are only needed when a job is sent to an agent
+    # or shown on its own, so they are not loaded (and parsed) along with
+    # the rest of the job.  Use ``undefer_group("payload")`` to load them
+    # up front.
+    environ = deferred(db.Column(
         JSONDict,
         doc="Dictionary containing information about the environment "
             "in which the job will execute. "
             ""
             ".. note::"
             "    Changes made directly to this object are **not** "
-            "    applied to the session.")
+            "    applied to the session."), group="payload")
 
-    data = db.Column(
+    data = deferred(db.Column(
         JSONDict,
         doc="Json blob containing additional data for a job "
             ""
             ".. note:: "
             "   Changes made directly to this object are **not** "
-            "   applied to the session.")
+            "   applied to the session."), group="payload")
 
     to_be_deleted = db.Column(
         db.Boolean,
@@ -336,6 +359,34 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         doc="If not None, this job will be automatically deleted this "
             "number of seconds after it finishes.")
 
+    num_unfinished_parents = db.Column(
+        db.Integer,
+        nullable=False, default=0, index=True,
+        doc="The number of parents of this job which are not done yet.  "
+            "The job can not run as long as this is not zero.  Maintained "
+            "by :meth:`update_unfinished_parents`.")
+
+    num_active_tasks = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of tasks in this job which are neither done nor "
+            "failed.  Maintained when tasks are flushed and by "
+            ":meth:`update_task_counts`.")
+
+    num_failed_tasks = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of failed tasks in this job.  Maintained when tasks "
+            "are flushed and by :meth:`update_task_counts`.")
+
+    envelope_version = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="Incremented whenever one of :attr:`ENVELOPE_ATTRIBUTES` or the "
+            "users notified about this job change, so copies of the job "
+            "cached for sending it to agents can be told apart.  Maintained "
+            "when jobs are flushed and by :meth:`bump_envelope_version`.")
+
     #
     # Relationships
     #
@@ -407,22 +458,24 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     def paused(self):
         return self.state == WorkState.PAUSED
 
-    def update_state(self):
+    def update_state(self, new_task_state=NOTSET):
+        """
+        Updates the state of this job from :attr:`num_active_tasks` and
+        :attr:`num_failed_tasks`, which are maintained when tasks are
+        flushed.  If the state of a task just changed, pass it as
+        ``new_task_state``, a task that started running makes looking for
+        running tasks unnecessary.
+        """
         # Import here instead of at the top of the file to avoid a circular
         # import
         from pyfarm.scheduler.tasks import send_job_completion_mail
         from pyfarm.models.agent import Agent
 
-        num_active_tasks = db.session.query(Task).\
-            filter(Task.job == self,
-                   or_(Task.state == None, and_(
-                            Task.state != WorkState.DONE,
-                            Task.state != WorkState.FAILED))).count()
-        if num_active_tasks == 0:
-            num_failed_tasks = db.session.query(Task).filter(
-                Task.job == self,
-                Task.state == WorkState.FAILED).count()
-            if num_failed_tasks == 0:
+        # The task counts are updated when tasks are flushed
+        db.session.flush()
+
+        if self.num_active_tasks == 0:
+            if self.num_failed_tasks == 0:
                 if self.state != _WorkState.DONE:
                     logger.info("Job %r (id %s): state transition %r -> 'done'",
                                 self.title, self.id, self.state)
@@ -439,15 +492,19 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
                                                          countdown=5)
             db.session.add(self)
         elif self.state != _WorkState.PAUSED:
-            num_running_tasks = db.session.query(Task).\
-                filter(Task.job == self,
-                       Task.agent_id != None,
-                       Task.agent.has(and_(Agent.state != AgentState.OFFLINE,
-                                           Agent.state != AgentState.DISABLED)),
-                       or_(
-                            Task.state == WorkState.RUNNING,
-                            Task.state == None)).count()
-            if num_running_tasks == 0:
+            if new_task_state == _WorkState.RUNNING:
+                has_running_tasks = True
+            else:
+                has_running_tasks = db.session.query(db.session.query(Task).\
+                    filter(Task.job == self,
+                           Task.agent_id != None,
+                           Task.agent.has(and_(
+                                Agent.state != AgentState.OFFLINE,
+                                Agent.state != AgentState.DISABLED)),
+                           or_(
+                                Task.state == WorkState.RUNNING,
+                                Task.state == None)).exists()).scalar()
+            if not has_running_tasks:
                 logger.debug("No running tasks in job %s (id %s), setting it "
                              "to queued", self.title, self.id)
                 self.state = None
@@ -582,63 +639,449 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
             task_event_count.time_end = datetime.utcnow()
             db.session.add(task_event_count)
 
-    def rerun(self):
+    @staticmethod
+    def descendant_ids(job_ids):
         """
-        Makes this job rerun all its task.  Tasks that are currently running are
-        left untouched.
+        Returns a set with the ids in ``job_ids`` and those of all jobs
+        depending on them, directly or indirectly.  The dependencies are
+        followed one level per query instead of through a recursive query,
+        which not all supported databases can run.
         """
-        num_restarted = 0
-        for task in self.tasks:
-            if task.state != _WorkState.RUNNING and task.state is not None:
-                task.state = None
-                task.agent = None
-                task.failures = 0
-                db.session.add(task)
-                num_restarted += 1
+        found = set(job_ids)
+        frontier = found
+        while frontier:
+            frontier = set(child_id for child_id, in db.session.query(
+                JobDependency.c.childid).filter(
+                    JobDependency.c.parentid.in_(frontier))) - found
+            found |= frontier
+        return found
+
+    @staticmethod
+    def rerun_jobs(job_ids, failed_only=False):
+        """
+        Reruns the tasks of all jobs in ``job_ids`` and of all their children
+        using bulk updates instead of loading every task.  Tasks that are
+        currently running are left untouched.  Returns the number of tasks
+        that will be run again.
+
+        The listeners on :attr:`Task.state` and :attr:`Task.agent_id` do not
+        do anything when a task is reset to queued, the updates to the state
+        of the jobs and the statistics are done here instead.
+
+        :param bool failed_only:
+            If set, only failed tasks are run again, done tasks are left
+            untouched
+        """
+        # Import here instead of at the top of the file to avoid a circular
+        # import
+        from pyfarm.models.agent import Agent
 
-        self.completion_notify_sent = False
-        self.update_state()
-        db.session.add(self)
+        if not job_ids:
+            return 0
 
-        if config.get("enable_statistics"):
-            task_event_count = TaskEventCount(job_queue_id=self.job_queue_id,
-                                              num_restarted=num_restarted)
-            task_event_count.time_start = datetime.utcnow()
-            task_event_count.time_end = datetime.utcnow()
-            db.session.add(task_event_count)
-            db.session.commit()
+        job_ids = list(Job.descendant_ids(job_ids))
 
-        for child in self.children:
-            child.rerun()
+        # Pending changes would be overwritten by the updates below
+        db.session.flush()
 
-    def rerun_failed(self):
+        if failed_only:
+            rerun = Task.state == WorkState.FAILED
+        else:
+            rerun = and_(Task.state != None, Task.state != WorkState.RUNNING)
+        tasks = Task.query.filter(Task.job_id.in_(job_ids), rerun)
+
+        restarted_per_queue = dict(tasks.join(Task.job).with_entities(
+            Job.job_queue_id, func.count(Task.id)).group_by(
+                Job.job_queue_id))
+        tasks.update({"state": None, "agent_id": None, "failures": 0},
+                     synchronize_session=False)
+        Job.update_task_counts(job_ids)
+
+        if config.get("enable_statistics"):
+            now = datetime.utcnow()
+            for job_queue_id, num_restarted in restarted_per_queue.items():
+                task_event_count = TaskEventCount(
+                    job_queue_id=job_queue_id, num_restarted=num_restarted)
+                task_event_count.time_start = now
+                task_event_count.time_end = now
+                db.session.add(task_event_count)
+
+        # The same decisions as in update_state(), for all jobs at once
+        def count(condition):
+            return func.coalesce(func.sum(case([(condition, 1)], else_=0)), 0)
+
+        active = or_(Task.state == None,
+                     ~Task.state.in_([WorkState.DONE, WorkState.FAILED]))
+        running = and_(Task.agent_id != None,
+                       or_(Task.state == None,
+                           Task.state == WorkState.RUNNING),
+                       ~Agent.state.in_([AgentState.OFFLINE,
+                                         AgentState.DISABLED]))
+        counts = dict(
+            (job_id, (num_active, num_running)) for
+            job_id, num_active, num_running in db.session.query(
+                Task.job_id, count(active), count(running)).outerjoin(
+                    Agent, Task.agent_id == Agent.id).filter(
+                        Task.job_id.in_(job_ids)).group_by(Task.job_id))
+
+        to_queue, to_run, to_finish = [], [], []
+        for job_id, state in db.session.query(Job.id, Job.state).filter(
+                Job.id.in_(job_ids)):
+            num_active, num_running = counts.get(job_id, (0, 0))
+            if num_active == 0:
+                to_finish.append(job_id)
+            elif state == _WorkState.PAUSED:
+                continue
+            elif num_running == 0:
+                if state is not None:
+                    to_queue.append(job_id)
+            elif state != _WorkState.RUNNING:
+                to_run.append(job_id)
+
+        Job.query.filter(Job.id.in_(job_ids)).update(
+            {"completion_notify_sent": False}, synchronize_session=False)
+        if to_queue:
+            Job.query.filter(Job.id.in_(to_queue)).update(
+                {"state": None}, synchronize_session=False)
+        if to_run:
+            Job.query.filter(Job.id.in_(to_run)).update(
+                {"state": WorkState.RUNNING,
+                 "time_started": datetime.utcnow(),
+                 "time_finished": None}, synchronize_session=False)
+        Job.update_unfinished_parents(job_ids)
+
+        for instance in list(db.session.identity_map.values()):
+            if ((isinstance(instance, Job) and instance.id in job_ids) or
+                (isinstance(instance, Task) and instance.job_id in job_ids)):
+                db.session.expire(instance)
+
+        # Jobs without anything left to do are finished through
+        # update_state() so the completion mails are sent
+        if to_finish:
+            for job in Job.query.filter(Job.id.in_(to_finish)):
+                job.update_state()
+
+        return sum(restarted_per_queue.values())
+
+    @staticmethod
+    def update_unfinished_parents(job_ids=None, connection=None):
         """
-        Makes this job rerun all its failed tasks.  Tasks that are done or are
-        currently running are left untouched
+        Recounts :attr:`num_unfinished_parents` for all jobs in ``job_ids``,
+        which may be a list or a select statement returning job ids, or for
+        all jobs if ``job_ids`` is ``None``.  This happens automatically
+        when jobs are flushed, it only has to be called after updating the
+        state or the parents of jobs in bulk.
         """
-        num_restarted = 0
-        for task in self.tasks:
-            if task.state == _WorkState.FAILED:
-                task.state = None
-                task.agent = None
-                task.failures = 0
-                db.session.add(task)
-                num_restarted += 1
+        # MySQL does not allow a subquery in an UPDATE to read from the
+        # table being updated, so the counts are selected first
+        jobs = Job.__table__
+        executor = connection or db.session
+        recount_all = job_ids is None
+        if recount_all:
+            job_ids = [job_id for job_id, in executor.execute(
+                select([jobs.c.id]))]
+        elif not isinstance(job_ids, (list, tuple, set, frozenset)):
+            job_ids = [job_id for job_id, in executor.execute(job_ids)]
+        else:
+            job_ids = list(job_ids)
+        if not job_ids:
+            return
+
+        parents = jobs.alias("parents")
+        num_unfinished = select(
+            [JobDependency.c.childid, func.count()]).select_from(
+                JobDependency.join(
+                    parents, parents.c.id == JobDependency.c.parentid)).where(
+                        or_(parents.c.state == None,
+                            parents.c.state != WorkState.DONE)).\
+            group_by(JobDependency.c.childid)
+        if not recount_all:
+            num_unfinished = num_unfinished.where(
+                JobDependency.c.childid.in_(job_ids))
+        counts = dict(executor.execute(num_unfinished).fetchall())
+        executor.execute(
+            jobs.update().where(jobs.c.id == bindparam("job_id")).\
+                values(num_unfinished_parents=bindparam("num_unfinished")),
+            [{"job_id": job_id, "num_unfinished": counts.get(job_id, 0)}
+             for job_id in job_ids])
+
+    @staticmethod
+    def bump_envelope_version(job_ids, connection=None):
+        """
+        Increments :attr:`envelope_version` for all jobs in ``job_ids``.
+        This happens automatically when jobs are flushed, it only has to be
+        called after updating :attr:`ENVELOPE_ATTRIBUTES` in bulk.
+        """
+        jobs = Job.__table__
+        (connection or db.session).execute(
+            jobs.update().where(jobs.c.id.in_(job_ids)).values(
+                envelope_version=jobs.c.envelope_version + 1))
+
+    @staticmethod
+    def task_counts_select(job_ids=None):
+        """
+        Returns a select statement for the actual number of active and failed
+        tasks of the jobs in ``job_ids``, or of all jobs with tasks, grouped
+        by ``job_id``
+        """
+        tasks = Task.__table__
+
+        def count(condition):
+            return func.coalesce(func.sum(case([(condition, 1)], else_=0)), 0)
+
+        statement = select([
+            tasks.c.job_id,
+            count(or_(tasks.c.state == None,
+                      ~tasks.c.state.in_([WorkState.DONE, WorkState.FAILED]))
+                  ).label("num_active_tasks"),
+            count(tasks.c.state == WorkState.FAILED).label(
+                "num_failed_tasks")]).group_by(tasks.c.job_id)
+        if job_ids is not None:
+            statement = statement.where(tasks.c.job_id.in_(job_ids))
+        return statement
+
+    @staticmethod
+    def update_task_counts(job_ids=None, connection=None):
+        """
+        Recounts :attr:`num_active_tasks` and :attr:`num_failed_tasks` for
+        all jobs in ``job_ids`` or for all jobs if ``job_ids`` is ``None``.
+        This only has to be called after updating the state of tasks in
+        bulk.
+        """
+        jobs = Job.__table__
+        tasks = Task.__table__
+
+        def count(condition):
+            return select([func.count()]).where(and_(
+                tasks.c.job_id == jobs.c.id, condition)).as_scalar()
+
+        statement = jobs.update().values(
+            num_active_tasks=count(or_(
+                tasks.c.state == None,
+                ~tasks.c.state.in_([WorkState.DONE, WorkState.FAILED]))),
+            num_failed_tasks=count(tasks.c.state == WorkState.FAILED))
+        if job_ids is not None:
+            statement = statement.where(jobs.c.id.in_(job_ids))
+        (connection or db.session).execute(statement)
+
+    @staticmethod
+    def task_count_deltas(states):
+        """
+        Returns the number of active and the number of failed tasks among
+        ``states``
+        """
+        active, failed = 0, 0
+        for state in states:
+            if state == _WorkState.FAILED:
+                failed += 1
+            # Values only implement ==, so != would always be true here
+            elif not state == _WorkState.DONE:
+                active += 1
+        return active, failed
+
+    @staticmethod
+    def loaded_job(target):
+        """Returns the job of the task ``target`` if it is loaded"""
+        job = inspect(target).dict.get("job")
+        if job is None:
+            session = object_session(target)
+            if session is not None:
+                job = session.identity_map.get(
+                    identity_key(Job, target.job_id))
+        return job
+
+    @staticmethod
+    def apply_task_count_deltas(connection, target, active, failed):
+        """
+        Adds ``active`` and ``failed`` to the task counts of the job of the
+        task ``target``, in the database and on the job if it is loaded.  If
+        either of them is ``None`` the counts of the job are recounted
+        instead.
+        """
+        if target.job_id is None or (active == 0 and failed == 0):
+            return
+
+        jobs = Job.__table__
+        if active is None or failed is None:
+            Job.update_task_counts([target.job_id], connection=connection)
+        else:
+            connection.execute(jobs.update().where(
+                jobs.c.id == target.job_id).values(
+                    num_active_tasks=jobs.c.num_active_tasks + active,
+                    num_failed_tasks=jobs.c.num_failed_tasks + failed))
+
+        job = Job.loaded_job(target)
+        if job is None:
+            return
+        job_dict = inspect(job).dict
+        if active is None or failed is None:
+            counts = connection.execute(select([
+                jobs.c.num_active_tasks, jobs.c.num_failed_tasks]).where(
+                    jobs.c.id == target.job_id)).first()
+            set_committed_value(job, "num_active_tasks", counts[0])
+            set_committed_value(job, "num_failed_tasks", counts[1])
+        else:
+            for name, delta in (("num_active_tasks", active),
+                                ("num_failed_tasks", failed)):
+                if job_dict.get(name) is not None:
+                    set_committed_value(job, name, job_dict[name] + delta)
+
+    @staticmethod
+    def task_inserted(mapper, connection, target):
+        active, failed = Job.task_count_deltas([target.state])
+        Job.apply_task_count_deltas(connection, target, active, failed)
+
+    @staticmethod
+    def task_updated(mapper, connection, target):
+        history = inspect(target).attrs.state.history
+        if not history.has_changes():
+            return
+        if not history.deleted:
+            # The old state was never loaded, so the change is not known
+            Job.apply_task_count_deltas(connection, target, None, None)
+            return
+
+        added_active, added_failed = Job.task_count_deltas(history.added)
+        removed_active, removed_failed = Job.task_count_deltas(
+            history.deleted)
+        Job.apply_task_count_deltas(
+            connection, target, added_active - removed_active,
+            added_failed - removed_failed)
+
+    @staticmethod
+    def task_deleted(mapper, connection, target):
+        state = inspect(target).dict.get("state", NOTSET)
+        if state is NOTSET:
+            # Recounted without the deleted task
+            Job.apply_task_count_deltas(connection, target, None, None)
+        else:
+            active, failed = Job.task_count_deltas([state])
+            Job.apply_task_count_deltas(connection, target, -active, -failed)
+
+    @staticmethod
+    def job_updated(mapper, connection, target):
+        attributes = inspect(target).attrs
+        if any(attributes[key].history.has_changes()
+               for key in Job.ENVELOPE_ATTRIBUTES):
+            target.envelope_version = Job.envelope_version + 1
+
+    @staticmethod
+    def notified_user_changed(mapper, connection, target):
+        Job.bump_envelope_version([target.job_id], connection=connection)
+
+    @staticmethod
+    def before_flush(session, flush_context, instances):
+        """
+        Collects the jobs whose number of unfinished parents may change with
+        this flush, so it can be recounted in :meth:`after_flush`
+        """
+        recount = session.info.setdefault("jobs_to_recount", set())
+        finished = session.info.setdefault("jobs_finished", set())
+        changed_state = session.info.setdefault(
+            "jobs_changed_state", set())
+
+        for instance in session.new | session.dirty:
+            if not isinstance(instance, Job):
+                continue
+            if inspect(instance).attrs.parents.history.has_changes():
+                recount.add(instance)
+            history = inspect(instance).attrs.state.history
+            if history.has_changes():
+                old_done = any(x == _WorkState.DONE for x in history.deleted)
+                new_done = any(x == _WorkState.DONE for x in history.added)
+                # The old state is not known if it was never loaded
+                if old_done != new_done or not history.deleted:
+                    changed_state.add(instance)
+                    if new_done:
+                        finished.add(instance)
+
+        # Deleting a job also deletes its dependencies, the children have to
+        # be collected before they are gone
+        for instance in session.deleted:
+            if isinstance(instance, Job) and instance.id is not None:
+                recount.update(instance.children)
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """
+        Recounts :attr:`num_unfinished_parents` for the jobs collected in
+        :meth:`before_flush`.  If a job finished and unblocked some of its
+        children, :func:`pyfarm.scheduler.tasks.assign_tasks` runs after the
+        transaction commits.
+        """
+        recount = session.info.pop("jobs_to_recount", set())
+        finished = session.info.pop("jobs_finished", set())
+        changed_state = session.info.pop("jobs_changed_state", set())
+        if not (recount or changed_state):
+            return
+
+        jobs = Job.__table__
+        connection = session.connection()
+        job_ids = set(job.id for job in recount if job.id is not None)
+        if changed_state:
+            job_ids.update(child_id for child_id, in connection.execute(
+                select([JobDependency.c.childid]).where(
+                    JobDependency.c.parentid.in_(
+                        [job.id for job in changed_state]))))
+        if not job_ids:
+            return
+
+        job_ids = list(job_ids)
+        Job.update_unfinished_parents(job_ids, connection=connection)
+
+        # Jobs loaded into the session and the jobs just inserted, which are
+        # not part of the identity map yet, are updated with the new counts
+        counts = dict(connection.execute(
+            select([jobs.c.id, jobs.c.num_unfinished_parents]).where(
+                jobs.c.id.in_(job_ids))).fetchall())
+        for instance in list(session.identity_map.values()) + list(recount):
+            if isinstance(instance, Job) and instance.id in counts:
+                set_committed_value(instance, "num_unfinished_parents",
+                                    counts[instance.id])
+
+        if finished:
+            children = select([JobDependency.c.childid]).where(
+                JobDependency.c.parentid.in_([job.id for job in finished]))
+            unblocked = connection.execute(
+                select([func.count()]).where(and_(
+                    jobs.c.id.in_(children),
+                    jobs.c.num_unfinished_parents == 0))).scalar()
+            if unblocked:
+                session.info["jobs_unblocked"] = True
+
+    @staticmethod
+    def after_commit(session):
+        """
+        Triggers the assignment of tasks after a transaction which unblocked
+        jobs has been committed
+        """
+        # Import here instead of at the top of the file to avoid a circular
+        # import
+        from pyfarm.scheduler.tasks import assign_tasks
 
-        self.completion_notify_sent = False
-        self.update_state()
-        db.session.add(self)
+        if session.info.pop("jobs_unblocked", False):
+            assign_tasks.delay()
 
+    @staticmethod
+    def after_rollback(session):
+        for key in ("jobs_to_recount", "jobs_finished", "jobs_changed_state",
+                    "jobs_unblocked"):
+            session.info.pop(key, None)
 
-        if config.get("enable_statistics"):
-            task_event_count = TaskEventCount(job_queue_id=self.job_queue_id,
-                                              num_restarted=num_restarted)
-            task_event_count.time_start = datetime.utcnow()
-            task_event_count.time_end = datetime.utcnow()
-            db.session.commit()
+    def rerun(self):
+        """
+        Makes this job and all jobs depending on it rerun all their tasks.
+        Tasks that are currently running are left untouched.
+        """
+        Job.rerun_jobs([self.id])
 
-        for child in self.children:
-            child.rerun_failed()
+    def rerun_failed(self):
+        """
+        Makes this job and all jobs depending on it rerun all their failed
+        tasks.  Tasks that are done or are currently running are left
+        untouched
+        """
+        Job.rerun_jobs([self.id], failed_only=True)
 
     @validates("ram", "cpus")
     def validate_resource(self, key, value):
@@ -664,3 +1107,14 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
             raise ValueError("Progress must be between 0.0 and 1.0")
 
 event.listen(Job.state, "set", Job.state_changed)
+event.listen(Task, "after_insert", Job.task_inserted)
+event.listen(Task, "after_update", Job.task_updated)
+event.listen(Task, "after_delete", Job.task_deleted)
+event.listen(Job, "before_update", Job.job_updated)
+event.listen(JobNotifiedUser, "after_insert", Job.notified_user_changed)
+event.listen(JobNotifiedUser, "after_update", Job.notified_user_changed)
+event.listen(JobNotifiedUser, "after_delete", Job.notified_user_changed)
+event.listen(Session, "before_flush", Job.before_flush)
+event.listen(Session, "after_flush", Job.after_flush)
+event.listen(Session, "after_commit", Job.after_commit)
+event.listen(Session, "after_rollback", Job.after_rollback)
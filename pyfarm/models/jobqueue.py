@@ -26,7 +26,11 @@ from sys import maxsize
 from functools import reduce
 from logging import DEBUG
 
-from sqlalchemy import event, distinct, or_, and_
+from sqlalchemy import (
+    event, distinct, or_, and_, select, func, literal, inspect, bindparam)
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.schema import UniqueConstraint
 
 from pyfarm.core.logger import getLogger
@@ -45,6 +49,31 @@ if config.get("debug_queue"):
     logger.setLevel(DEBUG)
 
 
+JobQueueClosure = db.Table(
+    config.get("table_job_queue_closure"), db.metadata,
+    db.Column(
+        "ancestor_id",
+        IDTypeWork,
+        db.ForeignKey("%s.id" % config.get("table_job_queue")),
+        primary_key=True,
+        doc="The id of the queue at the top of the path"),
+    db.Column(
+        "descendant_id",
+        IDTypeWork,
+        db.ForeignKey("%s.id" % config.get("table_job_queue")),
+        primary_key=True,
+        doc="The id of the queue at the bottom of the path"),
+    db.Column(
+        "depth",
+        db.Integer,
+        nullable=False,
+        doc="The number of levels between the two queues, 0 if both are "
+            "the same queue"),
+    db.Index("%s_descendant_depth_idx" % config.get("table_job_queue_closure"),
+             "descendant_id", "depth")
+)
+
+
 class JobQueue(db.Model, UtilityMixins, ReprMixin):
     """
     Stores information about a job queue. Used for flexible, configurable
@@ -119,19 +148,224 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
         backref=db.backref("children", lazy="dynamic"),
         doc="Relationship between this queue its parent")
 
-    def path(self):
-        # Import here instead of at the top to break circular dependency
-        from pyfarm.scheduler.tasks import cache_jobqueue_path
+    @staticmethod
+    def expected_closure():
+        """
+        Returns a set of ``(ancestor_id, descendant_id, depth)`` tuples
+        pairing every queue with itself and each queue above it, computed
+        from the parent of each queue.  This is what :data:`JobQueueClosure`
+        is supposed to contain, it is only used to rebuild and check that
+        table.  The tree is walked in Python from a single query so no
+        recursive query is needed.
+        """
+        parents = dict(db.session.query(
+            JobQueue.id, JobQueue.parent_jobqueue_id))
+        rows = set()
+        for queue_id in parents:
+            ancestor_id, depth = queue_id, 0
+            # The depth check stops at a cycle instead of looping forever
+            while ancestor_id is not None and depth <= len(parents):
+                rows.add((ancestor_id, queue_id, depth))
+                ancestor_id = parents.get(ancestor_id)
+                depth += 1
+        return rows
+
+    @staticmethod
+    def assigned_agents_query():
+        """
+        Returns a query for the number of distinct agents working on jobs in
+        or below each queue, grouped by the ``ancestor_id`` of
+        :data:`JobQueueClosure`.
+        """
+        # Import down here instead of at the top to avoid circular import
+        from pyfarm.models.task import Task
+        from pyfarm.models.job import Job
+
+        closure = JobQueueClosure
+        return select([
+            closure.c.ancestor_id,
+            func.count(distinct(Task.agent_id)).label(
+                "num_assigned_agents")]).select_from(closure.join(
+                    Job, Job.job_queue_id == closure.c.descendant_id).join(
+                        Task, Task.job_id == Job.id).join(
+                            Agent, Agent.id == Task.agent_id)).\
+                    where(and_(
+                        or_(Task.state == None,
+                            Task.state == WorkState.RUNNING),
+                        Agent.state != AgentState.OFFLINE,
+                        Agent.state != AgentState.DISABLED)).\
+                        group_by(closure.c.ancestor_id)
+
+    @staticmethod
+    def tree():
+        """
+        Returns a dictionary mapping the id of every queue to its parent's
+        id, its path, the number of agents working on jobs in or below the
+        queue and the number of queued or running jobs in or below the
+        queue.  All of the aggregates are computed by a single query.
+        """
+        # Import down here instead of at the top to avoid circular import
+        from pyfarm.models.job import Job
+
+        closure = JobQueueClosure
+        assigned_agents = JobQueue.assigned_agents_query().alias()
+        runnable_jobs = select([
+            closure.c.ancestor_id,
+            func.count(Job.id).label("num_runnable_jobs")]).\
+                select_from(closure.join(
+                    Job, Job.job_queue_id == closure.c.descendant_id)).\
+                    where(or_(Job.state == None,
+                              Job.state == WorkState.RUNNING)).\
+                        group_by(closure.c.ancestor_id).alias()
+
+        queues = JobQueue.__table__
+        tree_query = select([
+            queues.c.id, queues.c.parent_jobqueue_id, queues.c.name,
+            func.coalesce(assigned_agents.c.num_assigned_agents, 0),
+            func.coalesce(runnable_jobs.c.num_runnable_jobs, 0)]).\
+                select_from(queues.outerjoin(
+                    assigned_agents,
+                    assigned_agents.c.ancestor_id == queues.c.id).outerjoin(
+                        runnable_jobs,
+                        runnable_jobs.c.ancestor_id == queues.c.id))
+
+        tree = {}
+        for (queue_id, parent_id, name, num_assigned_agents,
+             num_runnable_jobs) in db.session.execute(tree_query):
+            tree[queue_id] = {
+                "parent_id": parent_id,
+                "name": name,
+                "num_assigned_agents": num_assigned_agents,
+                "num_runnable_jobs": num_runnable_jobs}
+
+        def path(queue_id):
+            node = tree[queue_id]
+            if "path" not in node:
+                parent_path = ("" if node["parent_id"] is None
+                               else path(node["parent_id"]))
+                node["path"] = "%s/%s" % (parent_path, node["name"] or "")
+            return node["path"]
+
+        for queue_id in tree:
+            path(queue_id)
+        return tree
+
+    @staticmethod
+    def paths(connection, queue_id=None):
+        """
+        Returns a dictionary mapping the id of ``queue_id`` and every queue
+        below it, or of all queues if ``queue_id`` is ``None``, to its path
+        as found through :data:`JobQueueClosure`.
+        """
+        closure = JobQueueClosure
+        queues = JobQueue.__table__
+        names_query = select([closure.c.descendant_id, queues.c.name]).\
+            select_from(closure.join(
+                queues, queues.c.id == closure.c.ancestor_id)).\
+                    order_by(closure.c.descendant_id, closure.c.depth.desc())
+        if queue_id is not None:
+            descendant_ids = [x for x, in connection.execute(
+                select([closure.c.descendant_id]).where(
+                    closure.c.ancestor_id == queue_id))]
+            names_query = names_query.where(
+                closure.c.descendant_id.in_(descendant_ids))
+
+        paths = {}
+        for descendant_id, name in connection.execute(names_query):
+            paths[descendant_id] = "%s/%s" % (
+                paths.get(descendant_id, ""), name or "")
+        return paths
 
+    @staticmethod
+    def update_paths(connection, queue_id=None, session=None, queue=None):
+        """
+        Writes the path of ``queue_id`` and every queue below it, or of all
+        queues if ``queue_id`` is ``None``, to their ``fullpath`` column.
+        Queues already loaded into ``session`` and ``queue``, which may not
+        be in the session's identity map yet while it is being flushed, are
+        updated as well.
+        """
+        paths = JobQueue.paths(connection, queue_id)
+        if not paths:
+            return
+
+        queues = JobQueue.__table__
+        connection.execute(
+            queues.update().where(queues.c.id == bindparam("queue_id")).\
+                values(fullpath=bindparam("new_fullpath")),
+            [{"queue_id": x, "new_fullpath": path}
+             for x, path in paths.items()])
+
+        if queue is not None and queue.id in paths:
+            set_committed_value(queue, "fullpath", paths[queue.id])
+        if session is not None:
+            for queue_id, path in paths.items():
+                loaded = session.identity_map.get(
+                    identity_key(JobQueue, queue_id))
+                if loaded is not None:
+                    set_committed_value(loaded, "fullpath", path)
+
+    @staticmethod
+    def rebuild_closure():
+        """
+        Recreates :data:`JobQueueClosure` and the ``fullpath`` of every
+        queue from the parent of each queue.  Returns the number of rows
+        written to :data:`JobQueueClosure`.
+        """
+        rows = [{"ancestor_id": ancestor_id, "descendant_id": queue_id,
+                 "depth": depth} for ancestor_id, queue_id, depth in
+                sorted(JobQueue.expected_closure())]
+
+        db.session.execute(JobQueueClosure.delete())
+        if rows:
+            db.session.execute(JobQueueClosure.insert(), rows)
+        JobQueue.update_paths(db.session.connection(), session=db.session)
+        return len(rows)
+
+    @staticmethod
+    def check_closure():
+        """
+        Compares :data:`JobQueueClosure` and the ``fullpath`` of every queue
+        to what they should be according to the parent of each queue.
+        Returns a dictionary with a list of ``(ancestor_id, descendant_id,
+        depth)`` tuples for the rows which are ``missing`` and the rows
+        which are ``unexpected``, and a list of the ids of all queues with
+        a wrong path in ``stale_paths``.  All lists are empty if the table
+        is consistent.
+        """
+        expected = JobQueue.expected_closure()
+        actual = set(tuple(x) for x in db.session.execute(select([
+            JobQueueClosure.c.ancestor_id, JobQueueClosure.c.descendant_id,
+            JobQueueClosure.c.depth])))
+
+        tree = JobQueue.tree()
+        stale_paths = [
+            queue_id for queue_id, fullpath in
+            db.session.query(JobQueue.id, JobQueue.fullpath)
+            if fullpath != tree[queue_id]["path"]]
+
+        return {"missing": sorted(expected - actual),
+                "unexpected": sorted(actual - expected),
+                "stale_paths": sorted(stale_paths)}
+
+    def path(self):
         if self.fullpath:
             return self.fullpath
-        else:
-            cache_jobqueue_path.delay(self.id)
+        elif self.id is None:
             path = "/%s" % (self.name or "")
             if self.parent:
                 return self.parent.path() + path
             else:
                 return path
+        else:
+            # The names of all parents in one indexed join instead of
+            # walking up the tree one query at a time
+            names_query = db.session.query(JobQueue.name).join(
+                JobQueueClosure,
+                JobQueueClosure.c.ancestor_id == JobQueue.id).\
+                    filter(JobQueueClosure.c.descendant_id == self.id).\
+                        order_by(JobQueueClosure.c.depth.desc())
+            return "".join("/%s" % (name or "") for name, in names_query)
 
     def child_queues_sorted(self):
         """
@@ -175,23 +409,12 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
         try:
             return self.assigned_agents_count
         except AttributeError:
-            # Import down here instead of at the top to avoid circular import
-            from pyfarm.models.task import Task
-            from pyfarm.models.job import Job
-
             self.assigned_agents_count = 0
-            for queue in self.children:
-                self.assigned_agents_count += queue.num_assigned_agents()
-            self.assigned_agents_count +=\
-                db.session.query(distinct(Task.agent_id)).\
-                    filter(Task.job.has(Job.queue == self),
-                           Task.agent_id != None,
-                           Task.agent.has(
-                               and_(Agent.state != AgentState.OFFLINE,
-                                    Agent.state != AgentState.DISABLED)),
-                           or_(Task.state == None,
-                               Task.state == WorkState.RUNNING)).count()
-
+            if self.id is not None:
+                assigned_agents_query = JobQueue.assigned_agents_query().\
+                    where(JobQueueClosure.c.ancestor_id == self.id)
+                for _, count in db.session.execute(assigned_agents_query):
+                    self.assigned_agents_count = count
             return self.assigned_agents_count
 
     def clear_assigned_counts(self):
@@ -202,7 +425,14 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
         if self.parent:
             self.parent.clear_assigned_counts()
 
-    def get_job_for_agent(self, agent, unwanted_job_ids=None):
+    def get_job_for_agent(self, agent, unwanted_job_ids=None, tree=None):
+        """
+        Returns the job in or below this queue the given agent should work
+        on next, or ``None``.  ``tree`` is the result of :meth:`tree`, it is
+        computed once for the top level call and then passed down, so the
+        agent counts of all queues are known without querying each of them
+        and subtrees without any queued or running jobs are skipped.
+        """
         # Import down here instead of at the top to avoid circular import
         from pyfarm.models.job import Job
 
@@ -210,13 +440,14 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
         if not supported_types:
             return None
 
+        if tree is None:
+            tree = JobQueue.tree()
+
         available_ram = agent.ram if USE_TOTAL_RAM else agent.free_ram
         child_jobs = Job.query.filter(or_(Job.state == WorkState.RUNNING,
                                           Job.state == None),
                                       Job.job_queue_id == self.id,
-                                      ~Job.parents.any(or_(
-                                          Job.state == None,
-                                          Job.state != WorkState.DONE)),
+                                      Job.num_unfinished_parents == 0,
                                       Job.jobtype_version_id.in_(
                                             supported_types),
                                       Job.ram <= available_ram).all()
@@ -225,8 +456,16 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
                        x.id not in unwanted_job_ids)]
         if unwanted_job_ids:
             child_jobs = [x for x in child_jobs if x.id not in unwanted_job_ids]
-        child_queues = JobQueue.query.filter(
-            JobQueue.parent_jobqueue_id == self.id).all()
+        child_queues = []
+        for queue in JobQueue.query.filter(
+                JobQueue.parent_jobqueue_id == self.id):
+            # Queues created after the tree was computed are not skipped
+            node = tree.get(queue.id)
+            if node is not None:
+                if not node["num_runnable_jobs"]:
+                    continue
+                queue.assigned_agents_count = node["num_assigned_agents"]
+            child_queues.append(queue)
 
         # Before anything else, enforce minimums
         for job in child_jobs:
@@ -243,7 +482,8 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
             if (queue.num_assigned_agents() < (queue.minimum_agents or 0) and
                 queue.num_assigned_agents() <
                     (queue.maximum_agents or maxsize)):
-                job = queue.get_job_for_agent(agent, unwanted_job_ids)
+                job = queue.get_job_for_agent(agent, unwanted_job_ids,
+                                              tree)
                 if job:
                     return job
 
@@ -298,7 +538,8 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
                 if isinstance(item, JobQueue):
                     if (item.num_assigned_agents() <
                             (item.maximum_agents or maxsize)):
-                        job = item.get_job_for_agent(agent, unwanted_job_ids)
+                        job = item.get_job_for_agent(agent, unwanted_job_ids,
+                                                     tree)
                         if job:
                             return job
             if selected_job:
@@ -315,4 +556,73 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
                 raise ValueError("Cannot have two jobqueues named %r at the "
                                  "top level" % target.name)
 
+    @staticmethod
+    def insert_closure(mapper, connection, target):
+        """
+        Adds a new queue to :data:`JobQueueClosure`, below all of its
+        parent's ancestors, and stores its path
+        """
+        closure = JobQueueClosure
+        connection.execute(closure.insert().values(
+            ancestor_id=target.id, descendant_id=target.id, depth=0))
+        if target.parent_jobqueue_id is not None:
+            connection.execute(closure.insert().from_select(
+                ["ancestor_id", "descendant_id", "depth"],
+                select([closure.c.ancestor_id, literal(target.id),
+                        closure.c.depth + 1]).where(
+                    closure.c.descendant_id == target.parent_jobqueue_id)))
+        JobQueue.update_paths(
+            connection, target.id, object_session(target), target)
+
+    @staticmethod
+    def update_closure(mapper, connection, target):
+        """
+        Moves the rows of a queue and everything below it in
+        :data:`JobQueueClosure` when the queue gets a new parent, and
+        updates their paths if the queue was moved or renamed
+        """
+        attributes = inspect(target).attrs
+        moved = attributes.parent_jobqueue_id.history.has_changes()
+        renamed = attributes.name.history.has_changes()
+
+        if moved:
+            closure = JobQueueClosure
+            subtree_ids = [x for x, in connection.execute(
+                select([closure.c.descendant_id]).where(
+                    closure.c.ancestor_id == target.id))]
+            if target.parent_jobqueue_id in subtree_ids:
+                raise ValueError("Cannot move jobqueue %r below itself" %
+                                 target.name)
+
+            # Detach the subtree from its old ancestors...
+            connection.execute(closure.delete().where(and_(
+                closure.c.descendant_id.in_(subtree_ids),
+                ~closure.c.ancestor_id.in_(subtree_ids))))
+
+            # ...and attach it below every ancestor of the new parent
+            if target.parent_jobqueue_id is not None:
+                parents = closure.alias("parents")
+                children = closure.alias("children")
+                connection.execute(closure.insert().from_select(
+                    ["ancestor_id", "descendant_id", "depth"],
+                    select([parents.c.ancestor_id, children.c.descendant_id,
+                            parents.c.depth + children.c.depth + 1]).where(
+                        and_(parents.c.descendant_id ==
+                                target.parent_jobqueue_id,
+                             children.c.ancestor_id == target.id))))
+
+        if moved or renamed:
+            JobQueue.update_paths(
+                connection, target.id, object_session(target), target)
+
+    @staticmethod
+    def delete_closure(mapper, connection, target):
+        """Removes a queue from :data:`JobQueueClosure`"""
+        connection.execute(JobQueueClosure.delete().where(or_(
+            JobQueueClosure.c.ancestor_id == target.id,
+            JobQueueClosure.c.descendant_id == target.id)))
+
 event.listen(JobQueue, "before_insert", JobQueue.top_level_unique_check)
+event.listen(JobQueue, "after_insert", JobQueue.insert_closure)
+event.listen(JobQueue, "after_update", JobQueue.update_closure)
+event.listen(JobQueue, "before_delete", JobQueue.delete_closure)
@@ -19,7 +19,8 @@ AgentCount Model
 ================
 
 Model describing the counts for agents in various states at a given point
-in time.
+in time, or their average over a period of time once older counts have been
+rolled up.
 """
 
 from pyfarm.master.application import db
@@ -37,6 +38,16 @@ class AgentCount(db.Model):
         autoincrement=False,
         doc="The point in time at which these counts were done")
 
+    resolution = db.Column(
+        db.Integer,
+        primary_key=True,
+        nullable=False,
+        autoincrement=False,
+        default=0,
+        doc="Length, in seconds, of the period starting at counted_time "
+            "these counts are the averages of.  Counts which have not been "
+            "rolled up yet have a resolution of 0.")
+
     num_online = db.Column(
         db.Integer,
         nullable=False,
@@ -0,0 +1,351 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Statistics Queries
+==================
+
+Queries which aggregate the statistics tables into fixed length periods
+for charting.  All of the grouping and summing happens in the database, the
+results are returned as columnar lists which can be passed to the browser
+as they are.
+"""
+
+from calendar import timegm
+from math import ceil
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+
+from sqlalchemy import select, func, and_, or_
+
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.models.core.functions import EPOCH, time_bucket, bucket_start
+from pyfarm.models.statistics.agent_count import AgentCount
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.models.statistics.task_count import TaskCount
+
+AGENT_COUNT_COLUMNS = ("online", "running", "offline", "disabled")
+TASK_EVENT_COLUMNS = ("new", "deleted", "restarted", "started", "failed",
+                      "done")
+TASK_COUNT_COLUMNS = ("queued", "running", "done", "failed")
+
+
+class CompletedPeriodCache(object):
+    """
+    Least recently used cache for the results of periods which have ended.
+    Such periods do not receive new samples anymore, so only the current
+    period has to be queried again on the next request.
+
+    :param int max_entries:
+        The maximum number of queries to keep results for
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        """
+        Returns a tuple of ``(first_period, last_period, rows)`` for ``key``
+        or ``None``.  ``rows`` maps the number of each cached period to its
+        values.
+        """
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                return None
+            self.entries[key] = entry
+            return entry[0], entry[1], dict(entry[2])
+
+    def set(self, key, first_period, last_period, rows):
+        """
+        Caches ``rows`` for all periods from ``first_period`` up to and
+        including ``last_period``
+        """
+        if self.max_entries < 1:
+            return
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (first_period, last_period, dict(
+                (period, values) for period, values in rows.items()
+                if first_period <= period <= last_period))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = CompletedPeriodCache(config.get("statistics_cache_size"))
+
+
+def queue_filter(column, job_queue_ids=None, no_queue=False):
+    """
+    Returns an expression limiting ``column`` to the given queues, or
+    ``None`` if neither ``job_queue_ids`` nor ``no_queue`` are set.
+
+    :param list job_queue_ids:
+        The ids of the queues to include
+
+    :param bool no_queue:
+        If set, samples which do not belong to any queue are included
+    """
+    if no_queue:
+        if job_queue_ids:
+            return or_(column.in_(job_queue_ids), column == None)
+        return column == None
+    elif job_queue_ids:
+        return column.in_(job_queue_ids)
+    return None
+
+
+def where(*clauses):
+    """Combines all ``clauses`` which are not ``None``"""
+    return and_(*[clause for clause in clauses if clause is not None])
+
+
+def period_of(time, resolution):
+    """Returns the number of the period ``time`` falls into"""
+    return int((time - EPOCH).total_seconds()) // resolution
+
+
+def rollup_tiers(rollups, tiers=None):
+    """
+    Converts a list of rollups from the configuration, each with a
+    ``resolution`` and an ``after`` timedelta, into ``(resolution, after)``
+    tuples in seconds and appends them to ``tiers``.
+
+    :raises ValueError:
+        Raised if a resolution is not a multiple of the one before it
+    """
+    tiers = list(tiers or [])
+    for rollup in rollups or []:
+        resolution = int(timedelta(**rollup["resolution"]).total_seconds())
+        after = int(timedelta(**rollup["after"]).total_seconds())
+        if tiers and resolution % tiers[-1][0] != 0:
+            raise ValueError(
+                "Rollup resolution of %ss is not a multiple of the previous "
+                "resolution of %ss" % (resolution, tiers[-1][0]))
+        tiers.append((resolution, after))
+    return tiers
+
+
+def task_event_count_tiers():
+    """
+    Returns a list of ``(resolution, after)`` tuples, both in seconds, for
+    every tier task event counts are consolidated into, ordered from the
+    shortest to the longest resolution.
+    """
+    consolidate_interval = int(timedelta(**config.get(
+        "task_event_count_consolidate_interval")).total_seconds())
+    return rollup_tiers(config.get("task_event_count_rollups"),
+                        [(consolidate_interval, 0)])
+
+
+def agent_count_tiers():
+    """
+    Returns a list of ``(resolution, after)`` tuples, both in seconds, for
+    every tier agent counts are rolled up into, ordered from the shortest
+    to the longest resolution.
+    """
+    return rollup_tiers(config.get("agent_count_rollups"))
+
+
+def cached_periods(name, statement_for, mapper, resolution, time_start,
+                   now, key):
+    """
+    Runs the statement returned by ``statement_for(start)`` for all periods
+    not cached yet and returns a dictionary mapping the number of each
+    period to its row.  ``statement_for`` has to return a statement whose
+    first column is the period number, ``mapper`` selects the database
+    it is run against.
+    """
+    first_period = period_of(time_start, resolution)
+    current_period = period_of(now, resolution)
+    # Not keyed on the first period, which moves along with the current
+    # one, so the periods both requests have in common are reused
+    key = (name, resolution, key)
+
+    rows = {}
+    query_start = first_period
+    cached = cache.get(key)
+    if cached is not None:
+        cached_first, cached_last, cached_rows = cached
+        if (cached_first <= first_period <= cached_last + 1 and
+                cached_last < current_period):
+            rows = dict((period, values)
+                        for period, values in cached_rows.items()
+                        if period >= first_period)
+            query_start = cached_last + 1
+
+    statement = statement_for(bucket_start(query_start, resolution))
+    for row in db.session.execute(statement, mapper=mapper):
+        rows[int(row[0])] = tuple(row[1:])
+
+    cache.set(key, first_period, current_period - 1, rows)
+    return rows
+
+
+def to_columns(rows, resolution, columns, fill=None):
+    """
+    Converts the rows returned by :func:`cached_periods` into a dictionary
+    of lists, one for the timestamp of each period and one for each of
+    ``columns``.  If ``fill`` is set periods without any rows between the
+    first and the last row are filled in with that value.
+    """
+    out = {"resolution": resolution, "timestamps": []}
+    for column in columns:
+        out[column] = []
+
+    if not rows:
+        return out
+
+    if fill is None:
+        periods = sorted(rows)
+    else:
+        periods = range(min(rows), max(rows) + 1)
+
+    empty = (fill, ) * len(columns)
+    for period in periods:
+        out["timestamps"].append(timegm(
+            bucket_start(period, resolution).utctimetuple()))
+        for column, value in zip(columns, rows.get(period, empty)):
+            out[column].append(value)
+    return out
+
+
+def task_event_counts(time_start, resolution, job_queue_ids=None,
+                      no_queue=False, now=None):
+    """
+    Returns the number of task events per period of ``resolution`` seconds
+    from ``time_start`` until now, for the queues selected by
+    ``job_queue_ids`` and ``no_queue`` (see :func:`queue_filter`).
+    """
+    now = now or datetime.utcnow()
+    period = time_bucket(TaskEventCount.time_start, resolution).label("period")
+    queues = queue_filter(TaskEventCount.job_queue_id, job_queue_ids, no_queue)
+
+    def statement_for(start):
+        return select([
+            period,
+            func.sum(TaskEventCount.num_new),
+            func.sum(TaskEventCount.num_deleted),
+            func.sum(TaskEventCount.num_restarted),
+            func.sum(TaskEventCount.num_started),
+            func.sum(TaskEventCount.num_failed),
+            func.sum(TaskEventCount.num_done)]).where(
+                where(TaskEventCount.time_start >= start, queues)).\
+                    group_by(period)
+
+    rows = cached_periods(
+        "task_event_counts", statement_for, TaskEventCount.__mapper__,
+        resolution, time_start, now,
+        (tuple(sorted(job_queue_ids or [])), no_queue))
+    rows = dict((key, tuple(int(x) for x in values))
+                for key, values in rows.items())
+    return to_columns(rows, resolution, TASK_EVENT_COLUMNS, fill=0)
+
+
+def task_counts(time_start, resolution, job_queue_ids=None,
+                no_queue=False, now=None):
+    """
+    Returns the average number of queued, running, done and failed tasks per
+    period of ``resolution`` seconds from ``time_start`` until now.  The
+    samples of each queue are averaged first and then summed up across the
+    queues selected by ``job_queue_ids`` and ``no_queue``
+    (see :func:`queue_filter`).
+    """
+    now = now or datetime.utcnow()
+    period = time_bucket(TaskCount.counted_time, resolution).label("period")
+    queues = queue_filter(TaskCount.job_queue_id, job_queue_ids, no_queue)
+
+    def statement_for(start):
+        by_queue = select([
+            period,
+            func.avg(TaskCount.total_queued).label("queued"),
+            func.avg(TaskCount.total_running).label("running"),
+            func.avg(TaskCount.total_done).label("done"),
+            func.avg(TaskCount.total_failed).label("failed")]).where(
+                where(TaskCount.counted_time >= start, queues)).group_by(
+                    period, TaskCount.job_queue_id).alias("by_queue")
+        return select([
+            by_queue.c.period,
+            func.sum(by_queue.c.queued),
+            func.sum(by_queue.c.running),
+            func.sum(by_queue.c.done),
+            func.sum(by_queue.c.failed)]).group_by(by_queue.c.period)
+
+    rows = cached_periods(
+        "task_counts", statement_for, TaskCount.__mapper__, resolution,
+        time_start, now,
+        (tuple(sorted(job_queue_ids or [])), no_queue))
+    rows = dict((key, tuple(float(x) for x in values))
+                for key, values in rows.items())
+    return to_columns(rows, resolution, TASK_COUNT_COLUMNS)
+
+
+def agent_count_resolution(time_range):
+    """
+    Returns the resolution, in seconds, agent counts covering ``time_range``
+    should be charted at.  This is the shortest of the sampling interval
+    and the rollup resolutions which does not produce more than
+    ``statistics_max_points`` periods, so the size of a chart stays about
+    the same no matter how far back it goes.
+    """
+    max_points = config.get("statistics_max_points")
+    resolutions = [resolution for resolution, _ in agent_count_tiers()]
+    resolutions.append(int(timedelta(**config.get(
+        "agent_count_interval")).total_seconds()))
+    resolutions.sort()
+
+    seconds = time_range.total_seconds()
+    for resolution in resolutions:
+        if seconds / resolution <= max_points:
+            return resolution
+
+    # Even the longest rollup is too fine, use a multiple of it
+    longest = resolutions[-1]
+    return longest * int(ceil(seconds / longest / max_points))
+
+
+def agent_counts(time_start, resolution, now=None):
+    """
+    Returns the average number of agents in each state per period of
+    ``resolution`` seconds from ``time_start`` until now.
+    """
+    now = now or datetime.utcnow()
+    period = time_bucket(AgentCount.counted_time, resolution).label("period")
+
+    def statement_for(start):
+        return select([
+            period,
+            func.avg(AgentCount.num_online),
+            func.avg(AgentCount.num_running),
+            func.avg(AgentCount.num_offline),
+            func.avg(AgentCount.num_disabled)]).where(
+                AgentCount.counted_time >= start).group_by(period)
+
+    rows = cached_periods(
+        "agent_counts", statement_for, AgentCount.__mapper__, resolution,
+        time_start, now, None)
+    rows = dict((key, tuple(float(x) for x in values))
+                for key, values in rows.items())
+    return to_columns(rows, resolution, AGENT_COUNT_COLUMNS)
@@ -33,6 +33,9 @@ from pyfarm.models.core.types import id_column
 class TaskEventCount(db.Model):
     __bind_key__ = 'statistics'
     __tablename__ = config.get("table_statistics_task_event_count")
+    __table_args__ = (
+        db.Index("%s_resolution_time_start_idx" % __tablename__,
+                 "resolution", "time_start"), )
 
     id = id_column(db.Integer)
 
@@ -46,6 +49,14 @@ class TaskEventCount(db.Model):
         nullable=False,
         default=datetime.utcnow)
 
+    resolution = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        doc="Length, in seconds, of the period this count has been "
+            "consolidated into.  Counts which have not been consolidated yet "
+            "have a resolution of 0.")
+
     # No foreign key reference, because this table is stored in a separate db
     # Code reading it will have to check for referential integrity manually.
     job_queue_id = db.Column(
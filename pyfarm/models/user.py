@@ -21,10 +21,15 @@ User and Role Models
 Stores users and their roles in the database.
 """
 
+from collections import OrderedDict, namedtuple
 from hashlib import sha256
 from datetime import datetime
+from threading import Lock
+from time import time
 
 from flask.ext.login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload, make_transient_to_detached
 
 from pyfarm.core.enums import STRING_TYPES, PY3
 from pyfarm.master.application import app, db, login_serializer
@@ -32,10 +37,15 @@ from pyfarm.master.config import config
 from pyfarm.models.core.mixins import ReprMixin
 from pyfarm.models.core.functions import split_and_extend
 
-__all__ = ("User", "Role")
+__all__ = ("User", "Role", "PendingNotification")
 
 SHA256_ASCII_LENGTH = 64  # static length of a sha256 string
 
+# The authentication related state of a user.  ``columns`` maps the names
+# of the user's columns to their values and ``roles`` is a tuple of
+# ``(name, active, expiration)`` for each role of the user.
+Principal = namedtuple("Principal", ("columns", "roles"))
+
 # roles the user is a member of
 UserRole = db.Table(
     config.get("table_user_role"),
@@ -50,6 +60,96 @@ UserRole = db.Table(
 )
 
 
+def is_active_at(active, expiration, now):
+    """
+    Returns True if something with the given ``active`` flag and
+    ``expiration`` is active at ``now``
+    """
+    return active and (expiration is None or now < expiration)
+
+
+class PrincipalCache(object):
+    """
+    Least recently used cache for the :class:`Principal` of users, so
+    authenticating a request does not have to query the user and its roles
+    each time.
+
+    Commits changing users or roles clear the cache right away.  Entries
+    expire after ``max_age`` seconds so changes made through other
+    processes are picked up as well.
+
+    :param int max_entries:
+        The maximum number of users to keep principals for
+
+    :param int max_age:
+        The number of seconds an entry may be used for
+    """
+    def __init__(self, max_entries, max_age):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = Lock()
+
+    def get(self, user_id):
+        """Returns the principal of ``user_id`` or ``None``"""
+        with self.lock:
+            entry = self.entries.pop(user_id, None)
+            if entry is None or entry[0] < time() - self.max_age:
+                return None
+            self.entries[user_id] = entry
+            return entry[1]
+
+    def set(self, user_id, generation, principal):
+        """
+        Caches ``principal`` unless the cache was cleared since
+        ``generation`` was read, in which case it may be outdated
+        """
+        if self.max_entries < 1:
+            return
+
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries.pop(user_id, None)
+            self.entries[user_id] = (time(), principal)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """Notes when users, roles or the roles of users were changed"""
+        for instance in session.new | session.dirty | session.deleted:
+            if isinstance(instance, (User, Role)):
+                session.info["principals_changed"] = True
+                return
+
+    @staticmethod
+    def after_commit(session):
+        if session.info.pop("principals_changed", False):
+            principals.clear()
+
+    @staticmethod
+    def after_rollback(session):
+        # Principals may have been cached from the changes which were
+        # rolled back
+        if session.info.pop("principals_changed", False):
+            principals.clear()
+
+
+principals = PrincipalCache(config.get("auth_cache_size"),
+                            config.get("auth_cache_max_age"))
+
+event.listen(Session, "after_flush", PrincipalCache.after_flush)
+event.listen(Session, "after_commit", PrincipalCache.after_commit)
+event.listen(Session, "after_rollback", PrincipalCache.after_rollback)
+
+
 class User(db.Model, UserMixin, ReprMixin):
     """
     Stores information about a user including the roles they belong to
@@ -95,6 +195,13 @@ class User(db.Model, UserMixin, ReprMixin):
         db.DateTime,
         doc="The last date that this user was logged in.")
 
+    mail_digest = db.Column(
+        db.Boolean,
+        nullable=False, default=False,
+        doc="If True, job notifications for this user are collected and "
+            "sent as a single digest mail every `mail_digest_interval` "
+            "instead of one mail each.")
+
     #
     # Relationships
     #
@@ -139,6 +246,63 @@ class User(db.Model, UserMixin, ReprMixin):
         else:
             raise TypeError("string or integer required for User.get()")
 
+    @classmethod
+    def get_principal(cls, user_id):
+        """
+        Returns the :class:`Principal` of the user with the id ``user_id``
+        or ``None`` if there is no such user
+        """
+        user_id = int(user_id)
+        principal = principals.get(user_id)
+        if principal is not None:
+            return principal
+
+        generation = principals.generation
+        user = cls.query.options(joinedload("roles")).filter_by(
+            id=user_id).first()
+        if user is None:
+            return None
+
+        principal = Principal(
+            dict((column.key, getattr(user, column.key))
+                 for column in cls.__mapper__.column_attrs),
+            tuple((role.name, role.active, role.expiration)
+                  for role in user.roles))
+        principals.set(user_id, generation, principal)
+        return principal
+
+    @classmethod
+    def get_cached(cls, user_id):
+        """
+        Like :meth:`get` but only accepts ids and returns the user from the
+        principal cache without querying the database if possible.  The
+        roles of the returned user are loaded when accessed.
+        """
+        principal = cls.get_principal(user_id)
+        if principal is None:
+            return None
+
+        user = cls(**principal.columns)
+        make_transient_to_detached(user)
+        user = db.session.merge(user, load=False)
+        user._principal = principal
+        return user
+
+    def _roles(self):
+        """
+        Returns a tuple of ``(name, active, expiration)`` for each role of
+        this user, preferring roles which are loaded already over the
+        principal cache
+        """
+        if "roles" in self.__dict__ or self.id is None:
+            return [(role.name, role.active, role.expiration)
+                    for role in self.roles]
+
+        principal = getattr(self, "_principal", None)
+        if principal is None:
+            principal = self._principal = User.get_principal(self.id)
+        return principal.roles if principal is not None else ()
+
     @classmethod
     def hash_password(cls, value):
         value = app.secret_key + value
@@ -171,8 +335,8 @@ class User(db.Model, UserMixin, ReprMixin):
         if self.expiration is not None and now > self.expiration:
             return False
 
-        # TODO: there's probably some way to cache this information
-        return all(role.is_active() for role in self.roles)
+        return all(is_active_at(active, expiration, now)
+                   for _, active, expiration in self._roles())
 
     def has_roles(self, allowed=None, required=None):
         """checks the provided arguments against the roles assigned"""
@@ -181,25 +345,13 @@ class User(db.Model, UserMixin, ReprMixin):
 
         allowed = split_and_extend(allowed)
         required = split_and_extend(required)
+        role_names = set(name for name, _, _ in self._roles())
 
         if allowed:
-            # Ask the database if the user has any of the allowed roles.  For
-            # smaller numbers of roles this is very slightly slower with
-            # SQLite in :memory: but is a good amount faster over the network
-            # or with large role sets.
-            return bool(
-                User.query.filter(
-                    User.roles.any(
-                        Role.name.in_(allowed))
-                ).filter(User.id == self.id).count())
+            return not role_names.isdisjoint(allowed)
 
         if required:
-            # Ask the database for all roles matching ``required``.  In order
-            # for this to return True is the number of entries found must
-            # be equal to len(required).
-            count = Role.query.filter(
-                Role.name.in_(required)).filter(User.id == self.id).count()
-            return count == len(required)
+            return role_names.issuperset(required)
 
 
 class Role(db.Model):
@@ -255,6 +407,41 @@ class Role(db.Model):
         return role
 
     def is_active(self):
-        if self.expiration is None:
-            return self.active
-        return self.active and datetime.utcnow() < self.expiration
+        return is_active_at(self.active, self.expiration, datetime.utcnow())
+
+
+class PendingNotification(db.Model):
+    """
+    A job notification which is waiting to be sent to a user as part of
+    the next digest mail
+    """
+    __tablename__ = config.get("table_pending_notification")
+
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("%s.id" % config.get("table_user"), ondelete="CASCADE"),
+        nullable=False,
+        doc="The id of the user the notification is for")
+
+    time_queued = db.Column(
+        db.DateTime,
+        nullable=False, default=datetime.utcnow,
+        doc="The time the notification would have been sent without "
+            "the digest")
+
+    subject = db.Column(
+        db.Text,
+        nullable=False,
+        doc="The subject line of the notification")
+
+    body = db.Column(
+        db.Text,
+        nullable=False,
+        doc="The text of the notification")
+
+    user = db.relationship(
+        "User",
+        backref=db.backref("pending_notifications", lazy="dynamic",
+                           passive_deletes=True))
@@ -41,6 +41,14 @@ celery_app.conf.CELERYBEAT_SCHEDULE = {
         "task": "pyfarm.scheduler.tasks.poll_agents",
         "schedule": timedelta(**config.get("agent_poll_interval"))
     },
+    "periodically_sweep_silent_agents": {
+        "task": "pyfarm.scheduler.tasks.sweep_silent_agents",
+        "schedule": timedelta(**config.get("agent_sweep_interval"))
+    },
+    "periodically_dispatch_agent_updates": {
+        "task": "pyfarm.scheduler.tasks.dispatch_agent_updates",
+        "schedule": timedelta(**config.get("agent_update_dispatch_interval"))
+    },
     "periodical_scheduler": {
         "task": "pyfarm.scheduler.tasks.assign_tasks",
         "schedule": timedelta(**config.get("agent_poll_interval"))
@@ -60,6 +68,15 @@ celery_app.conf.CELERYBEAT_SCHEDULE = {
     "periodically_execute_deletions": {
         "task": "pyfarm.scheduler.tasks.delete_to_be_deleted_jobs",
         "schedule": timedelta(**config.get("delete_job_interval")),
+    },
+    "periodically_verify_job_task_counts": {
+        "task": "pyfarm.scheduler.tasks.verify_job_task_counts",
+        "schedule": timedelta(
+            **config.get("verify_job_task_counts_interval")),
+    },
+    "periodically_send_mail_digests": {
+        "task": "pyfarm.scheduler.tasks.send_mail_digests",
+        "schedule": timedelta(**config.get("mail_digest_interval")),
     }
 }
 
@@ -68,6 +85,11 @@ if config.get("enable_statistics"):
         "task": "pyfarm.scheduler.statistics_tasks.count_agents",
         "schedule": timedelta(**config.get("agent_count_interval"))
         }
+    celery_app.conf.CELERYBEAT_SCHEDULE\
+        ["periodically_consolidate_agent_counts"] = {
+        "task": "pyfarm.scheduler.statistics_tasks.consolidate_agent_counts",
+        "schedule": timedelta(**config.get("agent_count_rollup_interval"))
+        }
     celery_app.conf.CELERYBEAT_SCHEDULE\
         ["periodically_consolidate_task_events"] = {
         "task": "pyfarm.scheduler.statistics_tasks.consolidate_task_events",
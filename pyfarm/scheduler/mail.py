@@ -0,0 +1,143 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Mail
+----
+
+Delivery of the notification mails sent by the scheduler.
+"""
+
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected
+from threading import Lock
+from time import time
+
+from jinja2 import Template
+
+from pyfarm.core.logger import getLogger
+
+logger = getLogger("pf.scheduler.mail")
+
+# The maximum number of templates from job types kept compiled by
+# :func:`compiled_template`
+TEMPLATE_CACHE_SIZE = 128
+
+_templates = {}
+
+
+def compiled_template(source):
+    """
+    Returns ``source`` compiled into a :class:`Template`.  Compiling a
+    template is much more expensive than rendering it, so the templates of
+    each job type are only compiled once.
+    """
+    try:
+        return _templates[source]
+    except KeyError:
+        template = Template(source)
+        if len(_templates) >= TEMPLATE_CACHE_SIZE:
+            _templates.clear()
+        _templates[source] = template
+        return template
+
+
+class MailDispatcher(object):
+    """
+    Sends mail over a single SMTP connection which stays open between
+    messages, so a batch of notifications only pays for one handshake and
+    login.  A connection which has been idle for longer than ``max_idle``
+    seconds is replaced before it's used again, one the server has closed
+    in the meantime is reopened.
+
+    :param str server:
+        The smtp server to connect to
+
+    :param int port:
+        The port to connect to, 0 for the default smtp port
+
+    :param str user:
+        The user to log in as, ``None`` if the server does not require
+        a login
+
+    :param str password:
+        The password of ``user``
+
+    :param int max_idle:
+        The number of seconds a connection may be idle before it's
+        considered to have been dropped by the server
+    """
+    def __init__(self, server, port=0, user=None, password=None,
+                 max_idle=60):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.max_idle = max_idle
+        self.smtp = None
+        self.last_used = None
+        self.lock = Lock()
+
+    def connect(self):
+        smtp = SMTP(self.server, port=self.port)
+
+        # Password could be blank in some cases
+        if self.user is not None:
+            smtp.login(self.user, self.password)
+
+        self.smtp = smtp
+        self.last_used = time()
+
+    def close(self):
+        """Closes the connection to the server, if there is one"""
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (SMTPException, IOError):
+                # The server already closed the connection
+                pass
+            finally:
+                self.smtp = None
+
+    def send(self, from_address, to, message):
+        """
+        Sends ``message`` to the addresses in ``to``, opening a connection
+        to the server if necessary
+        """
+        with self.lock:
+            if (self.smtp is not None and
+                    time() - self.last_used > self.max_idle):
+                self._close()
+
+            reconnected = self.smtp is None
+            if reconnected:
+                self.connect()
+
+            try:
+                self.smtp.sendmail(from_address, to, message)
+            except SMTPServerDisconnected:
+                self.smtp = None
+                if reconnected:
+                    raise
+                logger.debug("Connection to the smtp server was closed, "
+                             "reconnecting")
+                self.connect()
+                self.smtp.sendmail(from_address, to, message)
+
+            self.last_used = time()
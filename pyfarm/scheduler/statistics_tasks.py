@@ -24,10 +24,16 @@ about the farm.
 
 from datetime import datetime, timedelta
 from logging import DEBUG
+from math import floor
+
+from sqlalchemy import func
 
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import AgentState, WorkState
 
+from pyfarm.models.core.functions import time_bucket, bucket_start
+from pyfarm.models.statistics.queries import (
+    period_of, task_event_count_tiers, agent_count_tiers)
 from pyfarm.models.agent import Agent
 from pyfarm.models.jobqueue import JobQueue
 from pyfarm.models.task import Task
@@ -49,16 +55,24 @@ logger.setLevel(DEBUG)
 @celery_app.task(ignore_result=True)
 def count_agents():
     logger.debug("Counting known agents now")
-    num_online = Agent.query.filter_by(state=AgentState.ONLINE).count()
-    num_offline = Agent.query.filter_by(state=AgentState.OFFLINE).count()
-    num_running = Agent.query.filter_by(state=AgentState.RUNNING).count()
-    num_disabled = Agent.query.filter_by(state=AgentState.DISABLED).count()
-
     agent_count = AgentCount(counted_time=datetime.utcnow(),
-                             num_online=num_online,
-                             num_offline=num_offline,
-                             num_running=num_running,
-                             num_disabled=num_disabled)
+                             num_online=0,
+                             num_offline=0,
+                             num_running=0,
+                             num_disabled=0)
+
+    counts_query = db.session.query(Agent.state, func.count(Agent.id)).\
+        group_by(Agent.state)
+    for state, count in counts_query:
+        if state == AgentState.ONLINE:
+            agent_count.num_online = count
+        elif state == AgentState.OFFLINE:
+            agent_count.num_offline = count
+        elif state == AgentState.RUNNING:
+            agent_count.num_running = count
+        elif state == AgentState.DISABLED:
+            agent_count.num_disabled = count
+
     logger.info("Counted agents at %s: Online: %s, Offline: %s, Running: %s, "
                 "Disabled: %s",
                 agent_count.counted_time,
@@ -70,117 +84,209 @@ def count_agents():
     db.session.add(agent_count)
     db.session.commit()
 
+@celery_app.task(ignore_result=True)
+def consolidate_agent_counts():
+    logger.debug("Rolling up agent counts now")
+    rollup_agent_counts()
+
 @celery_app.task(ignore_result=True)
 def consolidate_task_events():
     logger.debug("Consolidating task events now")
-
-    queues_query = JobQueue.query
-
-    for job_queue in queues_query:
-        consolidate_task_events_for_queue.delay(job_queue.id)
-    consolidate_task_events_for_queue.delay(None)
+    consolidate_task_event_counts()
 
 @celery_app.task(ignore_result=True)
 def count_tasks():
     logger.debug("Counting tasks in all queues now")
 
-    job_queues_ids = db.session.query(JobQueue.id).all()
-
-    for job_queue_id in job_queues_ids + [None]:
-        task_count = TaskCount(job_queue_id=job_queue_id)
-        task_count.total_queued = Task.query.filter(
-            Task.job.has(Job.job_queue_id == job_queue_id),
-            Task.state == None).count()
-        task_count.total_running = Task.query.filter(
-            Task.job.has(Job.job_queue_id == job_queue_id),
-            Task.state == WorkState.RUNNING).count()
-        task_count.total_done = Task.query.filter(
-            Task.job.has(Job.job_queue_id == job_queue_id),
-            Task.state == WorkState.DONE).count()
-        task_count.total_failed = Task.query.filter(
-            Task.job.has(Job.job_queue_id == job_queue_id),
-            Task.state == WorkState.FAILED).count()
-
-        db.session.add(task_count)
+    counted_time = datetime.utcnow()
+
+    def empty_count(job_queue_id):
+        return {"counted_time": counted_time,
+                "job_queue_id": job_queue_id,
+                "total_queued": 0,
+                "total_running": 0,
+                "total_done": 0,
+                "total_failed": 0}
 
+    task_counts = {None: empty_count(None)}
+    for job_queue_id, in db.session.query(JobQueue.id):
+        task_counts[job_queue_id] = empty_count(job_queue_id)
+
+    # A single pass over the tasks table instead of four correlated
+    # counts per queue
+    counts_query = db.session.query(
+        Job.job_queue_id, Task.state, func.count(Task.id)).\
+            join(Task, Task.job_id == Job.id).\
+                group_by(Job.job_queue_id, Task.state)
+
+    for job_queue_id, state, count in counts_query:
+        # The queue may have been created after we listed all queues
+        if job_queue_id not in task_counts:
+            task_counts[job_queue_id] = empty_count(job_queue_id)
+        task_count = task_counts[job_queue_id]
+        if state is None:
+            task_count["total_queued"] += count
+        elif state == WorkState.RUNNING:
+            task_count["total_running"] += count
+        elif state == WorkState.DONE:
+            task_count["total_done"] += count
+        elif state == WorkState.FAILED:
+            task_count["total_failed"] += count
+
+    db.session.execute(
+        TaskCount.__table__.insert(), list(task_counts.values()),
+        mapper=TaskCount.__mapper__)
     db.session.commit()
 
 @celery_app.task(ignore_result=True)
 def consolidate_task_events_for_queue(job_queue_id):
     logger.debug("Consolidating task events for queue %s now", job_queue_id)
+    consolidate_task_event_counts(
+        filters=[TaskEventCount.job_queue_id == job_queue_id])
+
+
+def rollup_task_event_counts(resolution, cutoff, filters=None):
+    """
+    Merges all task event counts with a resolution below ``resolution`` that
+    started before ``cutoff`` into one count per queue and period of
+    ``resolution`` seconds.  Summing up happens in the database, only the
+    merged counts are transferred.
+
+    Counts which have reached ``resolution`` already are never touched
+    again, so the cost of this depends on the number of new counts instead
+    of the size of the table.  Returns the number of counts inserted.
+    """
+    bucket = time_bucket(TaskEventCount.time_start, resolution)
+    source_filters = [TaskEventCount.resolution < resolution,
+                      TaskEventCount.time_start < cutoff]
+    source_filters.extend(filters or [])
+
+    rollup_query = db.session.query(
+        TaskEventCount.job_queue_id, bucket,
+        func.sum(TaskEventCount.num_new),
+        func.sum(TaskEventCount.num_deleted),
+        func.sum(TaskEventCount.num_restarted),
+        func.sum(TaskEventCount.num_started),
+        func.sum(TaskEventCount.num_failed),
+        func.sum(TaskEventCount.num_done)).filter(*source_filters).\
+            group_by(TaskEventCount.job_queue_id, bucket)
+
+    rollups = []
+    for (job_queue_id, period, num_new, num_deleted, num_restarted,
+         num_started, num_failed, num_done) in rollup_query:
+        time_start = bucket_start(period, resolution)
+        rollups.append({
+            "time_start": time_start,
+            "time_end": time_start + timedelta(seconds=resolution),
+            "resolution": resolution,
+            "job_queue_id": job_queue_id,
+            "num_new": num_new,
+            "num_deleted": num_deleted,
+            "num_restarted": num_restarted,
+            "num_started": num_started,
+            "num_failed": num_failed,
+            "num_done": num_done})
+
+    if rollups:
+        db.session.query(TaskEventCount).filter(*source_filters).delete(
+            synchronize_session=False)
+        db.session.execute(
+            TaskEventCount.__table__.insert(), rollups,
+            mapper=TaskEventCount.__mapper__)
+
+    return len(rollups)
+
+
+def consolidate_task_event_counts(now=None, filters=None):
+    """
+    Consolidates task event counts into each tier from
+    :func:`task_event_count_tiers` and deletes counts older than
+    ``task_event_count_retention``.  Only complete periods are consolidated,
+    counts in the current period are left for the next run.
+    """
+    now = now or datetime.utcnow()
+
+    for resolution, after in task_event_count_tiers():
+        # Align the cutoff to the start of a period so only periods no new
+        # counts can be added to anymore are rolled up
+        cutoff = bucket_start(
+            period_of(now - timedelta(seconds=after), resolution), resolution)
+        inserted = rollup_task_event_counts(resolution, cutoff, filters)
+        logger.debug("Rolled up task event counts before %s into %s periods "
+                     "of %ss", cutoff, inserted, resolution)
+
+    retention = config.get("task_event_count_retention")
+    if retention is not None:
+        retention_filters = [
+            TaskEventCount.time_end < now - timedelta(**retention)]
+        retention_filters.extend(filters or [])
+        deleted = db.session.query(TaskEventCount).filter(
+            *retention_filters).delete(synchronize_session=False)
+        logger.debug("Deleted %s expired task event counts", deleted)
+
+    db.session.commit()
+
+
+def round_half_up(value):
+    """
+    Rounds the average ``value`` to the nearest integer, halves are rounded
+    up.  :func:`round` rounds halves away from zero on Python 2 but to the
+    nearest even number on Python 3, and averages may be returned as
+    :class:`Decimal` by some databases.
+    """
+    return int(floor(float(value) + 0.5))
+
+
+def rollup_agent_counts(now=None):
+    """
+    Replaces the agent counts older than the ``after`` of each tier in
+    ``agent_count_rollups`` with one count per period of the tier's
+    resolution, holding the averages of the counts replaced.  Counts older
+    than ``agent_count_retention`` are deleted.
+    """
+    now = now or datetime.utcnow()
+
+    for resolution, after in agent_count_tiers():
+        cutoff = bucket_start(
+            period_of(now - timedelta(seconds=after), resolution), resolution)
+        bucket = time_bucket(AgentCount.counted_time, resolution).label(
+            "bucket")
+        source_filters = [AgentCount.resolution < resolution,
+                          AgentCount.counted_time < cutoff]
+
+        rollup_query = db.session.query(
+            bucket,
+            func.avg(AgentCount.num_online),
+            func.avg(AgentCount.num_running),
+            func.avg(AgentCount.num_offline),
+            func.avg(AgentCount.num_disabled)).filter(*source_filters).\
+                group_by(bucket)
+
+        rollups = []
+        for (period, num_online, num_running, num_offline,
+             num_disabled) in rollup_query:
+            rollups.append({
+                "counted_time": bucket_start(period, resolution),
+                "resolution": resolution,
+                "num_online": round_half_up(num_online),
+                "num_running": round_half_up(num_running),
+                "num_offline": round_half_up(num_offline),
+                "num_disabled": round_half_up(num_disabled)})
+
+        if rollups:
+            db.session.query(AgentCount).filter(*source_filters).delete(
+                synchronize_session=False)
+            db.session.execute(
+                AgentCount.__table__.insert(), rollups,
+                mapper=AgentCount.__mapper__)
+        logger.debug("Rolled up agent counts before %s into %s periods of "
+                     "%ss", cutoff, len(rollups), resolution)
 
-    consolidate_interval = timedelta(**config.get(
-        "task_event_count_consolidate_interval"))
-
-    def add_task_count(consolidation_count, event_count, last_count):
-        consolidation_count.num_new += event_count.num_new
-        consolidation_count.num_deleted += event_count.num_deleted
-        consolidation_count.num_restarted += event_count.num_restarted
-        consolidation_count.num_started += event_count.num_started
-        consolidation_count.num_failed += event_count.num_failed
-        consolidation_count.num_done += event_count.num_done
-
-    event_counts_query = TaskEventCount.query.filter_by(
-        job_queue_id=job_queue_id).order_by(TaskEventCount.time_start)
-
-    last_count = None
-    open_consolidation_count = None
-    for event_count in event_counts_query:
-        # If current count is not consolidated yet
-        if event_count.time_end - event_count.time_start < consolidate_interval:
-            if not open_consolidation_count:
-                open_consolidation_count = TaskEventCount(
-                    job_queue_id=job_queue_id,
-                    num_new=0,
-                    num_deleted=0,
-                    num_restarted=0,
-                    num_started=0,
-                    num_failed=0,
-                    num_done=0)
-                open_consolidation_count.time_start = event_count.time_start
-                open_consolidation_count.time_end = (event_count.time_start +
-                                                     consolidate_interval)
-                add_task_count(open_consolidation_count, event_count,
-                               last_count)
-                db.session.delete(event_count)
-            else:
-                # We know the event count does not fall into the period of the
-                # next already existing consolidated count, because we sorted
-                # the query by time_start, so the other consolidated count
-                # would have come up before this unconsolidated one.
-                while (event_count.time_start >
-                       open_consolidation_count.time_end):
-                    db.session.add(open_consolidation_count)
-                    new_consolidation_count = TaskEventCount(
-                        job_queue_id=job_queue_id,
-                        num_new=0,
-                        num_deleted=0,
-                        num_restarted=0,
-                        num_started=0,
-                        num_failed=0,
-                        num_done=0)
-                    new_consolidation_count.time_start = (
-                        open_consolidation_count.time_end)
-                    new_consolidation_count.time_end = (
-                        new_consolidation_count.time_start +
-                        consolidate_interval)
-                    open_consolidation_count = new_consolidation_count
-                add_task_count(open_consolidation_count, event_count,
-                               last_count)
-                db.session.delete(event_count)
-        else:
-            if not open_consolidation_count:
-                open_consolidation_count = event_count
-            else:
-                if event_count.time_start < open_consolidation_count.time_end:
-                    add_task_count(open_consolidation_count, event_count,
-                               last_count)
-                    db.session.delete(event_count)
-                else:
-                    db.session.add(open_consolidation_count)
-                    open_consolidation_count = event_count
-
-    if open_consolidation_count:
-        db.session.add(open_consolidation_count)
+    retention = config.get("agent_count_retention")
+    if retention is not None:
+        deleted = db.session.query(AgentCount).filter(
+            AgentCount.counted_time < now - timedelta(**retention)).delete(
+                synchronize_session=False)
+        logger.debug("Deleted %s expired agent counts", deleted)
 
     db.session.commit()
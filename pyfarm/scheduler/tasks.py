@@ -22,20 +22,18 @@ Tasks
 This module contains various asynchronous tasks to be run by celery.
 """
 
+from collections import OrderedDict
 from datetime import timedelta, datetime
 from logging import DEBUG
 from json import dumps
-from smtplib import SMTP
 from email.mime.text import MIMEText
+from threading import Lock
 from time import time, sleep
-from os.path import isfile, join
-from os import remove, listdir
-from errno import ENOENT
-from gzip import GzipFile
 from uuid import UUID
 
-from sqlalchemy import or_, desc
+from sqlalchemy import or_, and_, desc, func, select
 from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import undefer_group, joinedload
 
 import requests
 from requests.exceptions import ConnectionError, Timeout
@@ -56,19 +54,21 @@ from pyfarm.models.software import (
 from pyfarm.models.tag import Tag
 from pyfarm.models.task import Task
 from pyfarm.models.tasklog import TaskLog, TaskTaskLogAssociation
-from pyfarm.models.job import Job, JobNotifiedUser
+from pyfarm.models.job import Job, JobNotifiedUser, JobTagAssociation
 from pyfarm.models.jobqueue import JobQueue
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.gpu import GPU
 from pyfarm.models.disk import AgentDisk
 from pyfarm.models.agent import Agent, AgentTagAssociation
-from pyfarm.models.user import User, Role
+from pyfarm.models.user import User, Role, PendingNotification
 from pyfarm.models.jobgroup import JobGroup
 from pyfarm.master.application import db
+from pyfarm.master.tasklog_storage import get_tasklog_storage
 from pyfarm.master.utility import default_json_encoder
 from pyfarm.master.config import config
 
 from pyfarm.scheduler.celery_app import celery_app
+from pyfarm.scheduler.mail import MailDispatcher, compiled_template
 
 
 try:
@@ -85,8 +85,11 @@ POLL_BUSY_AGENTS_INTERVAL = timedelta(**config.get("poll_busy_agents_interval"))
 POLL_IDLE_AGENTS_INTERVAL = timedelta(**config.get("poll_idle_agents_interval"))
 POLL_OFFLINE_AGENTS_INTERVAL = \
     timedelta(**config.get("poll_offline_agents_interval"))
+AGENT_HEARTBEAT_DEADLINE = \
+    timedelta(**config.get("agent_heartbeat_deadline"))
 SCHEDULER_LOCKFILE_BASE = config.get("scheduler_lockfile_base")
-LOGFILES_DIR = config.get("tasklogs_dir")
+AGENT_UPDATE_MAX_CONCURRENT = config.get("agent_update_max_concurrent")
+AGENT_UPDATE_TIMEOUT = timedelta(**config.get("agent_update_timeout"))
 TRANSACTION_RETRIES = config.get("transaction_retries")
 AGENT_REQUEST_TIMEOUT = config.get("agent_request_timeout")
 BASE_URL = config.get("base_url")
@@ -96,29 +99,185 @@ SMTP_SERVER = config.get("smtp_server")
 SMTP_PORT = config.get("smtp_port")
 SMTP_USER, SMTP_PASSWORD = config.get("smtp_login")
 FROM_ADDRESS = config.get("from_email")
+SMTP_MAX_IDLE = config.get("smtp_max_idle")
+MAX_FAILED_TASKS_IN_MAIL = config.get("max_failed_tasks_in_mail")
 DEFAULT_SUCCESS_SUBJECT = Template(config.get("success_subject"))
 DEFAULT_SUCCESS_BODY = Template(config.get("success_body"))
 DEFAULT_FAIL_SUBJECT = Template(config.get("failed_subject"))
 DEFAULT_FAIL_BODY = Template(config.get("failed_body"))
 DEFAULT_DELETE_SUBJECT = Template(config.get("deleted_subject"))
 DEFAULT_DELETE_BODY = Template(config.get("deleted_body"))
+DEFAULT_DIGEST_SUBJECT = Template(config.get("digest_subject"))
+DEFAULT_DIGEST_BODY = Template(config.get("digest_body"))
 OUR_FARM_NAME = config.get("farm_name")
 
+mailer = MailDispatcher(SMTP_SERVER, port=SMTP_PORT, user=SMTP_USER,
+                        password=SMTP_PASSWORD, max_idle=SMTP_MAX_IDLE)
+
+
 def send_email(to, message):
     """
-    Configures and instance of :class:`SMTP` and sends a message to the
-    given address.
+    Sends a message to the given addresses over the connection to the smtp
+    server shared by all mails sent from this process.
     """
-    smtp = SMTP(SMTP_SERVER, port=SMTP_PORT)
+    mailer.send(FROM_ADDRESS, to, message)
 
-    # Password could be blank in some cases
-    if SMTP_USER is not None:
-        smtp.login(SMTP_USER, SMTP_PASSWORD)
 
-    try:
-        smtp.sendmail(FROM_ADDRESS, to, message)
-    finally:
-        smtp.quit()
+def notify_users(users, subject, body, addresses=()):
+    """
+    Sends a notification with ``subject`` and ``body`` to ``users`` and to
+    the plain email ``addresses``.  Users who opted into
+    :attr:`.User.mail_digest` get it with their next digest instead, the
+    caller has to commit the session for that.  Returns the addresses the
+    notification has been sent to right away.
+    """
+    to = list(addresses)
+    for user in users:
+        if not user.email:
+            continue
+        if user.mail_digest:
+            db.session.add(PendingNotification(
+                user=user, subject=subject, body=body))
+        else:
+            to.append(user.email)
+
+    if to:
+        message = MIMEText(body)
+        message["Subject"] = subject
+        message["From"] = FROM_ADDRESS
+        message["To"] = ",".join(to)
+        send_email(to, message.as_string())
+
+    return to
+
+
+class JobEnvelopeCache(object):
+    """
+    Least recently used cache for the serialized "envelope" of jobs, the
+    part of the message sent to agents which is the same for every batch of
+    tasks from a job.  Each envelope is stored along with the
+    :attr:`.Job.envelope_version` it was built from and is only returned
+    for that version.
+
+    :param int max_entries:
+        The maximum number of jobs to keep envelopes for
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, job_id, version):
+        """
+        Returns the envelope of ``job_id`` if one has been cached for
+        ``version``, ``None`` otherwise
+        """
+        with self.lock:
+            entry = self.entries.pop(job_id, None)
+            if entry is None or entry[0] != version:
+                return None
+            self.entries[job_id] = entry
+            return entry[1]
+
+    def set(self, job_id, version, envelope):
+        """Caches ``envelope`` for ``version`` of ``job_id``"""
+        if self.max_entries < 1:
+            return
+
+        with self.lock:
+            self.entries.pop(job_id, None)
+            self.entries[job_id] = (version, envelope)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+envelope_cache = JobEnvelopeCache(config.get("job_envelope_cache_size"))
+
+
+def load_job_envelopes(job_ids):
+    """
+    Returns a dictionary mapping each of ``job_ids`` to its serialized
+    envelope.  Only the envelopes which are not cached yet for the current
+    :attr:`.Job.envelope_version` are built, with one query each for the
+    jobs, their tags and their notified users.
+    """
+    envelopes = {}
+    for job_id, version in db.session.query(
+            Job.id, Job.envelope_version).filter(Job.id.in_(job_ids)):
+        envelope = envelope_cache.get(job_id, version)
+        if envelope is not None:
+            envelopes[job_id] = envelope
+
+    missing = [job_id for job_id in job_ids if job_id not in envelopes]
+    if not missing:
+        return envelopes
+
+    tags = {}
+    for job_id, tag in db.session.query(
+            JobTagAssociation.c.job_id, Tag.tag).join(
+                Tag, JobTagAssociation.c.tag_id == Tag.id).filter(
+                    JobTagAssociation.c.job_id.in_(missing)):
+        tags.setdefault(job_id, []).append(tag)
+
+    notified_users = {}
+    for notified_user, username in db.session.query(
+            JobNotifiedUser, User.username).join(
+                User, JobNotifiedUser.user_id == User.id).filter(
+                    JobNotifiedUser.job_id.in_(missing)):
+        notified_users.setdefault(notified_user.job_id, []).append(
+            {"username": username,
+             "on_success": notified_user.on_success,
+             "on_failure": notified_user.on_failure,
+             "on_deletion": notified_user.on_deletion})
+
+    jobs = Job.query.filter(Job.id.in_(missing)).options(
+        undefer_group("payload"), joinedload("user"),
+        joinedload("jobtype_version").joinedload("jobtype"))
+    for job in jobs:
+        message = {"job": {"id": job.id,
+                           "title": job.title,
+                           "data": job.data if job.data else {},
+                           "environ": job.environ if job.environ else {},
+                           "by": job.by,
+                           "batch": job.batch,
+                           "ram": job.ram,
+                           "ram_warning": job.ram_warning,
+                           "ram_max": job.ram_max,
+                           "cpus": job.cpus,
+                           "notified_users": notified_users.get(job.id, []),
+                           "priority": job.priority,
+                           "notes": job.notes,
+                           "tags": tags.get(job.id, []),
+                           "num_tiles": job.num_tiles
+                           },
+                   "jobtype": {"name": job.jobtype_version.jobtype.name,
+                               "version": job.jobtype_version.version}}
+
+        if job.user:
+            message["job"]["user"] = job.user.username
+
+        envelope = dumps(message, default=default_json_encoder)
+        envelope_cache.set(job.id, job.envelope_version, envelope)
+        envelopes[job.id] = envelope
+
+    return envelopes
+
+
+def assignment_message(envelope, tasks):
+    """
+    Returns the message assigning ``tasks`` to an agent, consisting of
+    the ``envelope`` of their job and the tasks themselves
+    """
+    return "%s, \"tasks\": %s}" % (envelope[:-1], dumps(
+        [{"id": task.id,
+          "frame": task.frame,
+          "attempt": task.attempts,
+          "tile": task.tile} for task in tasks],
+        default=default_json_encoder))
 
 
 @celery_app.task(ignore_result=True, bind=True)
@@ -154,53 +313,14 @@ def send_tasks_to_agent(self, agent_id):
                      agent.id)
         return
 
+    envelopes = load_job_envelopes(list(tasks_in_jobs))
     for job_id, tasks in tasks_in_jobs.items():
-        job = Job.query.filter_by(id=job_id).first()
-        message = {"job": {"id": job.id,
-                           "title": job.title,
-                           "data": job.data if job.data else {},
-                           "environ": job.environ if job.environ else {},
-                           "by": job.by,
-                           "batch": job.batch,
-                           "ram": job.ram,
-                           "ram_warning": job.ram_warning,
-                           "ram_max": job.ram_max,
-                           "cpus": job.cpus,
-                           "notified_users": [],
-                           "priority": job.priority,
-                           "notes": job.notes,
-                           "tags": [],
-                           "num_tiles": job.num_tiles
-                           },
-                   "jobtype": {"name": job.jobtype_version.jobtype.name,
-                               "version": job.jobtype_version.version},
-                   "tasks": []}
-
-        if job.user:
-            message["job"]["user"] = job.user.username
-
-        for notified_user in job.notified_users:
-            message["job"]["notified_users"].append(
-                {"username": notified_user.user.username,
-                 "on_success": notified_user.on_success,
-                 "on_failure": notified_user.on_failure,
-                 "on_deletion": notified_user.on_deletion})
-
-        for tag in job.tags:
-            message["job"]["tags"].append(tag.tag)
-
-        for task in tasks:
-            message["tasks"].append({"id": task.id,
-                                     "frame": task.frame,
-                                     "attempt": task.attempts,
-                                     "tile": task.tile})
-
-        logger.info("Sending a batch of %s tasks for job %s (%s) to agent %s",
-                    len(tasks), job.title, job.id, agent.hostname)
+        logger.info("Sending a batch of %s tasks for job %s to agent %s",
+                    len(tasks), job_id, agent.hostname)
         try:
             response = requests.post(agent.api_url() + "/assign",
-                                     data=dumps(message,
-                                                default=default_json_encoder),
+                                     data=assignment_message(
+                                         envelopes[job_id], tasks),
                                      headers={
                                          "Content-Type": "application/json",
                                          "User-Agent": USERAGENT},
@@ -252,7 +372,7 @@ def send_tasks_to_agent(self, agent_id):
                             task.attempts -= 1
                             db.session.add(task)
                     db.session.flush()
-                    job.update_state()
+                    tasks[0].job.update_state()
                     db.session.commit()
                 else:
                     logger.error("CONFLICT response from agent %s (id %s) did "
@@ -599,20 +719,11 @@ def poll_agent(self, agent_id):
                          "offline", agent.hostname, agent.id)
             agent.state = AgentState.OFFLINE
             agent.last_polled = datetime.utcnow()
-            tasks_query = Task.query.filter(
-                Task.agent == agent,
-                Task.state == WorkState.RUNNING)
-            jobs_to_check = set()
-            for task in tasks_query:
-                task.state = None
-                db.session.add(task)
-                jobs_to_check.add(task.job)
             db.session.add(agent)
+            requeued_job_ids = agent.requeue_tasks()
             db.session.commit()
-            for job in jobs_to_check:
-                job.update_state()
-                db.session.add(job)
-            db.session.commit()
+            if requeued_job_ids:
+                assign_tasks.delay()
 
     else:
         present_task_ids = [x["id"] for x in tasks_json]
@@ -691,6 +802,133 @@ def poll_agents():
         poll_agent.delay(agent.id)
 
 
+@celery_app.task(ignore_results=True)
+def sweep_silent_agents():
+    """
+    Marks all agents which have not been heard from within
+    ``agent_heartbeat_deadline`` as offline with a single update and
+    requeues their tasks.  Agents which keep sending updates to the master
+    are never touched, so only the agents that went silent have to be
+    polled by :func:`poll_agents`.
+    """
+    db.session.rollback()
+    deadline = datetime.utcnow() - AGENT_HEARTBEAT_DEADLINE
+    silent = and_(Agent.state != AgentState.OFFLINE,
+                  Agent.state != AgentState.DISABLED,
+                  Agent.last_heard_from < deadline)
+
+    # Lock the rows so an update from an agent arriving now waits until
+    # this transaction is done instead of the agent being marked offline
+    # after it was heard from
+    agent_ids = [agent_id for agent_id, in db.session.query(Agent.id).filter(
+        silent).with_for_update()]
+    if not agent_ids:
+        return
+
+    # Databases which can't lock rows may have seen an update from an agent
+    # since the select, so the conditions are checked again and only the
+    # agents which were actually marked offline lose their tasks
+    updated = Agent.query.filter(Agent.id.in_(agent_ids), silent).update(
+        {"state": AgentState.OFFLINE}, synchronize_session=False)
+    if updated != len(agent_ids):
+        agent_ids = [
+            agent_id for agent_id, in db.session.query(Agent.id).filter(
+                Agent.id.in_(agent_ids),
+                Agent.state == AgentState.OFFLINE,
+                Agent.last_heard_from < deadline)]
+        if not agent_ids:
+            db.session.commit()
+            return
+
+    logger.warning("Marking %s agents as offline which have not been heard "
+                   "from in %s: %s", len(agent_ids), AGENT_HEARTBEAT_DEADLINE,
+                   agent_ids)
+    requeued_job_ids = Agent.requeue_agent_tasks(agent_ids)
+    db.session.commit()
+
+    if requeued_job_ids:
+        assign_tasks.delay()
+
+
+def supports_window_functions(engine):
+    """
+    Returns True if the database behind ``engine`` supports window functions
+    such as ``ROW_NUMBER() OVER (...)``, which MySQL before 8.0 and SQLite
+    before 3.25 do not.
+    """
+    dialect = engine.dialect
+    if dialect.name == "sqlite":
+        return dialect.dbapi.sqlite_version_info >= (3, 25)
+    elif dialect.name == "mysql":
+        version = dialect.server_version_info or ()
+        return "MariaDB" not in version and version >= (8, 0)
+    return True
+
+
+def failed_task_logs(job_id, limit=None):
+    """
+    Returns a list of ``(task_id, frame, attempt, log_identifier)`` tuples
+    for the failed tasks of ``job_id``, ordered by descending frame.  Each
+    task is listed once along with the log of its last attempt, or with
+    ``None`` for the attempt and the identifier if it has no logs.
+
+    :param int limit:
+        The maximum number of tasks to return, all of them if ``None``
+    """
+    failed = and_(Task.job_id == job_id, Task.state == WorkState.FAILED)
+    failed_associations = TaskTaskLogAssociation.__table__.join(
+        Task.__table__, Task.id == TaskTaskLogAssociation.task_id)
+
+    if supports_window_functions(db.engine):
+        ranked_logs = select([
+            TaskTaskLogAssociation.task_id,
+            TaskTaskLogAssociation.attempt,
+            TaskTaskLogAssociation.task_log_id,
+            func.row_number().over(
+                partition_by=TaskTaskLogAssociation.task_id,
+                order_by=[desc(TaskTaskLogAssociation.attempt),
+                          TaskTaskLogAssociation.task_log_id]).label(
+                              # RANK is a reserved word in MySQL 8.0
+                              "log_position")]).\
+                select_from(failed_associations).where(failed).\
+                    alias("ranked_logs")
+        last_logs = select([ranked_logs]).where(
+            ranked_logs.c.log_position == 1).alias("last_logs")
+    else:
+        # Without window functions the last attempt of each task is found
+        # by grouping, then the first log of that attempt by grouping again
+        last_attempts = select([
+            TaskTaskLogAssociation.task_id,
+            func.max(TaskTaskLogAssociation.attempt).label("attempt")]).\
+                select_from(failed_associations).where(failed).\
+                    group_by(TaskTaskLogAssociation.task_id).\
+                        alias("last_attempts")
+        last_logs = select([
+            TaskTaskLogAssociation.task_id,
+            TaskTaskLogAssociation.attempt,
+            func.min(TaskTaskLogAssociation.task_log_id).label(
+                "task_log_id")]).\
+                select_from(TaskTaskLogAssociation.__table__.join(
+                    last_attempts, and_(
+                        last_attempts.c.task_id ==
+                            TaskTaskLogAssociation.task_id,
+                        last_attempts.c.attempt ==
+                            TaskTaskLogAssociation.attempt))).\
+                    group_by(TaskTaskLogAssociation.task_id,
+                             TaskTaskLogAssociation.attempt).\
+                        alias("last_logs")
+
+    query = db.session.query(
+        Task.id, Task.frame, last_logs.c.attempt, TaskLog.identifier).\
+            outerjoin(last_logs, last_logs.c.task_id == Task.id).\
+                outerjoin(TaskLog, TaskLog.id == last_logs.c.task_log_id).\
+                    filter(failed).order_by(desc(Task.frame))
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query.all()
+
+
 @celery_app.task(ignore_results=True)
 def send_job_completion_mail(job_id, successful=True):
     if not SMTP_SERVER:
@@ -715,26 +953,26 @@ def send_job_completion_mail(job_id, successful=True):
                 job.url += "/"
             job.url+= "jobs/%s" % job.id
 
-            failed_tasks = Task.query.filter(Task.job == job,
-                                             Task.state == WorkState.FAILED).\
-                                                 order_by(desc(Task.frame))
             failed_log_urls = []
-            for task in failed_tasks:
-                last_log_assoc = TaskTaskLogAssociation.query.filter_by(
-                    task=task).order_by(desc(
-                        TaskTaskLogAssociation.attempt)).limit(1).first()
-                if last_log_assoc:
-                    log = last_log_assoc.log
+            num_omitted_failed_tasks = 0
+            if not successful:
+                failed_tasks = failed_task_logs(
+                    job.id, limit=MAX_FAILED_TASKS_IN_MAIL)
+                for task_id, frame, attempt, identifier in failed_tasks:
+                    if identifier is None:
+                        continue
                     log_url = BASE_URL
                     if not log_url.endswith("/"):
                         log_url += "/"
                     log_url += ("api/v1/jobs/%s/tasks/%s/attempts/%s/"
                                 "logs/%s/logfile" %
-                                (job.id, task.id, last_log_assoc.attempt,
-                                 log.identifier))
+                                (job.id, task_id, attempt, identifier))
                     failed_log_urls.append(log_url)
+                num_omitted_failed_tasks = max(
+                    0, job.num_failed_tasks - len(failed_tasks))
 
-            notified_users_query = JobNotifiedUser.query.filter_by(job=job)
+            notified_users_query = JobNotifiedUser.query.options(
+                joinedload("user")).filter_by(job=job)
             if successful:
                 notified_users_query = notified_users_query.filter_by(
                     on_success=True)
@@ -745,41 +983,29 @@ def send_job_completion_mail(job_id, successful=True):
             if not notified_users:
                 return
 
-            body_template = None
-            subject_template = None
+            jobtype = job.jobtype_version.jobtype
             if successful:
-                if job.jobtype_version.jobtype.success_body:
-                    body_template = Template(
-                        job.jobtype_version.jobtype.success_body)
-                else:
-                    body_template = DEFAULT_SUCCESS_BODY
-                if job.jobtype_version.jobtype.success_subject:
-                    subject_template = Template(
-                        job.jobtype_version.jobtype.success_subject)
-                else:
-                    subject_template = DEFAULT_SUCCESS_SUBJECT
+                body_template = (compiled_template(jobtype.success_body)
+                                 if jobtype.success_body
+                                 else DEFAULT_SUCCESS_BODY)
+                subject_template = (compiled_template(jobtype.success_subject)
+                                    if jobtype.success_subject
+                                    else DEFAULT_SUCCESS_SUBJECT)
             else:
-                if job.jobtype_version.jobtype.fail_body:
-                    body_template = Template(
-                        job.jobtype_version.jobtype.fail_body)
-                else:
-                    body_template = DEFAULT_FAIL_BODY
-                if job.jobtype_version.jobtype.fail_subject:
-                    subject_template = Template(
-                        job.jobtype_version.jobtype.fail_subject)
-                else:
-                    subject_template = DEFAULT_FAIL_SUBJECT
-
-            message = MIMEText(
-                body_template.render(job=job, failed_log_urls=failed_log_urls))
-            message["Subject"] = subject_template.render(job=job)
-            message["From"] = FROM_ADDRESS
-
-            to = [x.user.email for x in notified_users if x.user.email]
-            message["To"] = ",".join(to)
-
+                body_template = (compiled_template(jobtype.fail_body)
+                                 if jobtype.fail_body
+                                 else DEFAULT_FAIL_BODY)
+                subject_template = (compiled_template(jobtype.fail_subject)
+                                    if jobtype.fail_subject
+                                    else DEFAULT_FAIL_SUBJECT)
+
+            to = notify_users(
+                [x.user for x in notified_users],
+                subject_template.render(job=job),
+                body_template.render(
+                    job=job, failed_log_urls=failed_log_urls,
+                    num_omitted_failed_tasks=num_omitted_failed_tasks))
             if to:
-                send_email(to, message.as_string())
                 logger.info("Job completion mail for job %s (id %s) sent to %s",
                             job.title, job.id, to)
 
@@ -823,21 +1049,121 @@ def send_job_completion_mail(job_id, successful=True):
 def send_job_deletion_mail(job_id, jobtype_name, job_title, to):
     logger.debug("In send_job_deletion_mail(), job_id: %s, jobtype_name: %s, "
                  "job_title: %s, to: %s", job_id, jobtype_name, job_title, to)
-    message_text = DEFAULT_DELETE_BODY.render(
-        job_title=job_title,
-        jobtype_name=jobtype_name,
-        job_id=job_id
-    )
+    if not to:
+        return
 
-    message = MIMEText(message_text)
-    message["Subject"] = DEFAULT_DELETE_SUBJECT.render(job_title=job_title)
-    message["From"] = FROM_ADDRESS
-    message["To"] = ",".join(to)
+    db.session.rollback()
+    users = User.query.filter(User.email.in_(to)).all()
+    known_addresses = set(user.email for user in users)
+
+    sent_to = notify_users(
+        users,
+        DEFAULT_DELETE_SUBJECT.render(job_title=job_title),
+        DEFAULT_DELETE_BODY.render(
+            job_title=job_title,
+            jobtype_name=jobtype_name,
+            job_id=job_id),
+        addresses=[x for x in to if x not in known_addresses])
+    db.session.commit()
 
-    if to:
-        send_email(to, message.as_string())
+    if sent_to:
         logger.info("Job deletion mail for job %s (id %s) sent to %s",
-                    job_title, job_id, to)
+                    job_title, job_id, sent_to)
+
+
+@celery_app.task(ignore_results=True)
+def send_mail_digests():
+    """
+    Sends every user with pending notifications a single mail containing
+    all of them.  The notifications are deleted once the digest has been
+    sent.
+    """
+    if not SMTP_SERVER:
+        return
+
+    db.session.rollback()
+    pending = OrderedDict()
+    for notification in PendingNotification.query.options(
+            joinedload("user")).order_by(
+                PendingNotification.user_id, PendingNotification.time_queued):
+        pending.setdefault(notification.user, []).append(notification)
+
+    for user, notifications in pending.items():
+        if user.email:
+            message = MIMEText(
+                DEFAULT_DIGEST_BODY.render(notifications=notifications))
+            message["Subject"] = DEFAULT_DIGEST_SUBJECT.render(
+                notifications=notifications)
+            message["From"] = FROM_ADDRESS
+            message["To"] = user.email
+            send_email([user.email], message.as_string())
+            logger.info("Digest of %s notifications sent to %s",
+                        len(notifications), user.email)
+
+        # Committed per user so digests which have been sent already are
+        # not sent again if a later one fails
+        PendingNotification.query.filter(PendingNotification.id.in_(
+            [x.id for x in notifications])).delete(synchronize_session=False)
+        db.session.commit()
+
+
+@celery_app.task(ignore_results=True)
+def dispatch_agent_updates():
+    """
+    Asks agents which should upgrade to a new version to do so, while
+    keeping the number of agents with an update in progress below
+    ``agent_update_max_concurrent``.  An update is in progress from the
+    time the agent was asked to update until it reports the new version or
+    ``agent_update_timeout`` has passed.  Agents left over are asked on a
+    later run, once earlier ones have finished.
+    """
+    db.session.rollback()
+    now = datetime.utcnow()
+    cutoff = now - AGENT_UPDATE_TIMEOUT
+    outdated = and_(Agent.upgrade_to != None,
+                    or_(Agent.version == None,
+                        Agent.version != Agent.upgrade_to),
+                    Agent.state != AgentState.OFFLINE)
+
+    in_progress = Agent.query.filter(
+        outdated, Agent.update_requested >= cutoff).count()
+    slots = AGENT_UPDATE_MAX_CONCURRENT - in_progress
+    if slots <= 0:
+        logger.debug("%s agent updates are in progress, not starting more",
+                     in_progress)
+        return
+
+    agent_ids = [agent_id for agent_id, in db.session.query(Agent.id).filter(
+        outdated,
+        or_(Agent.update_requested == None,
+            Agent.update_requested < cutoff)).order_by(
+                # Agents which have not been asked yet go first
+                Agent.update_requested != None, Agent.update_requested,
+                Agent.id).limit(slots)]
+    if not agent_ids:
+        return
+
+    # Only claims agents which no concurrent run has claimed in the
+    # meantime.  Each agent is claimed on its own so the number of updated
+    # rows tells which claims succeeded, the time written can't be compared
+    # against afterwards because some databases drop its microseconds.
+    claimed_ids = []
+    for agent_id in agent_ids:
+        if Agent.query.filter(
+                Agent.id == agent_id,
+                or_(Agent.update_requested == None,
+                    Agent.update_requested < cutoff)).update(
+                        {"update_requested": now},
+                        synchronize_session=False):
+            claimed_ids.append(agent_id)
+    db.session.commit()
+    agent_ids = claimed_ids
+    if not agent_ids:
+        return
+
+    logger.info("Asking %s agents to update: %s", len(agent_ids), agent_ids)
+    for agent_id in agent_ids:
+        update_agent.delay(agent_id)
 
 
 @celery_app.task(ignore_results=True, bind=True)
@@ -1051,6 +1377,113 @@ def stop_task(self, task_id, agent_id=None, dissociate_agent=True):
     db.session.commit()
 
 
+@celery_app.task(ignore_results=True, bind=True)
+def stop_tasks_on_agent(self, agent_id, task_ids, dissociate_agent=True):
+    """
+    Stops all of ``task_ids`` on the agent ``agent_id``.  This is a single
+    message no matter how many tasks are stopped, all requests share one
+    connection to the agent and the tasks are released with one update
+    instead of one :func:`stop_task` for every task.
+    """
+    db.session.rollback()
+    agent = Agent.query.filter_by(id=agent_id).first()
+    if agent is None:
+        logger.warning("Not stopping %s tasks on agent %s, the agent does "
+                       "not exist anymore", len(task_ids), agent_id)
+        return
+
+    # Some of the tasks may have finished or moved to another agent since
+    # this was queued
+    task_ids = [task_id for task_id, in db.session.query(Task.id).filter(
+        Task.id.in_(task_ids),
+        Task.agent_id == agent_id,
+        or_(Task.state == None,
+            ~Task.state.in_([WorkState.DONE, WorkState.FAILED]))).\
+                order_by(Task.id)]
+
+    logger.info("Stopping %s tasks on agent %s (id %s)",
+                len(task_ids), agent.hostname, agent.id)
+    stopped = []
+    remaining = list(task_ids)
+    session = requests.Session()
+    session.headers["User-Agent"] = USERAGENT
+    try:
+        while remaining:
+            task_id = remaining[0]
+            response = session.delete(
+                "%s/tasks/%s" % (agent.api_url(), task_id),
+                timeout=AGENT_REQUEST_TIMEOUT)
+            remaining.pop(0)
+            if response.status_code not in [requests.codes.accepted,
+                                            requests.codes.ok,
+                                            requests.codes.no_content,
+                                            requests.codes.not_found]:
+                logger.error("Unexpected return code on stopping task %s on "
+                             "agent %s: %s",
+                             task_id, agent.id, response.status_code)
+            else:
+                stopped.append(task_id)
+    # Catching ProtocolError here is a work around for
+    # https://github.com/kennethreitz/requests/issues/2204
+    except (ConnectionError, ProtocolError, Timeout) as e:
+        if self.request.retries < self.max_retries:
+            logger.warning("Caught %s while trying to stop %s tasks on agent "
+                           "%s (id %s), retry %s of %s: %s",
+                           type(e).__name__, len(remaining), agent.hostname,
+                           agent.id, self.request.retries,
+                           self.max_retries, e)
+        else:
+            # The tasks stay assigned to the agent, it's expected to report
+            # what it's actually running once it can be reached again
+            logger.error("Giving up on stopping %s tasks on agent %s (id %s) "
+                         "after %s retries, they are still assigned to the "
+                         "agent: %s (%s: %s)", len(remaining),
+                         agent.hostname, agent.id, self.max_retries,
+                         remaining, type(e).__name__, e)
+            remaining = []
+    finally:
+        session.close()
+
+    if dissociate_agent and stopped:
+        Task.query.filter(Task.id.in_(stopped)).update(
+            {"agent_id": None, "state": None}, synchronize_session=False)
+    db.session.commit()
+
+    if remaining:
+        self.retry(args=[agent_id, remaining, dissociate_agent])
+
+
+@celery_app.task(ignore_results=True)
+def verify_job_task_counts():
+    """
+    Compares the number of active and failed tasks kept on each job to its
+    tasks and corrects the jobs whose counts have drifted, along with their
+    state.  Returns the number of jobs that were corrected.
+    """
+    db.session.rollback()
+
+    jobs = Job.__table__
+    counts = Job.task_counts_select().alias("counts")
+    drifted_query = select([jobs.c.id]).select_from(
+        jobs.outerjoin(counts, counts.c.job_id == jobs.c.id)).where(or_(
+            jobs.c.num_active_tasks !=
+                func.coalesce(counts.c.num_active_tasks, 0),
+            jobs.c.num_failed_tasks !=
+                func.coalesce(counts.c.num_failed_tasks, 0)))
+    drifted_job_ids = [job_id for job_id, in db.session.execute(drifted_query)]
+    if not drifted_job_ids:
+        logger.debug("Task counts of all jobs are correct")
+        return 0
+
+    logger.warning("Correcting the task counts of %s jobs: %s",
+                   len(drifted_job_ids), drifted_job_ids)
+    Job.update_task_counts(drifted_job_ids)
+    for job in Job.query.filter(Job.id.in_(drifted_job_ids)):
+        job.update_state()
+    db.session.commit()
+    return len(drifted_job_ids)
+
+
 @celery_app.task(ignore_results=True)
 def delete_to_be_deleted_jobs():
     db.session.rollback()
@@ -1128,28 +1561,14 @@ def clean_up_orphaned_task_logs():
         db.session.delete(log)
     db.session.commit()
 
-    try:
-        tasklog_files = [f for f in listdir(LOGFILES_DIR)\
-                         if isfile(join(LOGFILES_DIR, f))]
-
-        for filepath in tasklog_files:
-            uncompressed_name = filepath
-            if filepath.endswith(".gz"):
-                uncompressed_name = filepath[0:-3]
-            referencing_count = TaskLog.query.filter(
-                or_(TaskLog.identifier == filepath,
-                    TaskLog.identifier == uncompressed_name)).count()
-            if not referencing_count:
-                logger.info("Deleting log file %s", join(LOGFILES_DIR, filepath))
-                try:
-                    remove(join(LOGFILES_DIR, filepath))
-                except OSError as e:
-                    if e.errno != ENOENT:
-                        raise
-    except OSError as e:
-        if e.errno != ENOENT:
-            raise
-        logger.warning("Log directory %r does not exist", LOGFILES_DIR)
+    storage = get_tasklog_storage()
+    for identifier, compressed in storage.iter_logs():
+        referencing_count = TaskLog.query.filter(
+            TaskLog.identifier == identifier).count()
+        if not referencing_count:
+            logger.info("Deleting log file %s (compressed: %s)",
+                        identifier, compressed)
+            storage.remove(identifier, compressed=compressed)
 
 
 @celery_app.task(ignore_results=True)
@@ -1185,17 +1604,9 @@ def autodelete_old_jobs():
 def compress_task_logs():
     db.session.rollback()
 
-    try:
-        uncompressed_tasklogs = [f for f in listdir(LOGFILES_DIR)\
-                                 if (isfile(join(LOGFILES_DIR, f)) and
-                                     not f.endswith(".gz"))]
-
-        for tasklog in uncompressed_tasklogs:
-            compress_task_log.delay(tasklog)
-    except OSError as e:
-        if e.errno != ENOENT:
-            raise
-        logger.warning("Log directory %r does not exist", LOGFILES_DIR)
+    for identifier, compressed in get_tasklog_storage().iter_logs():
+        if not compressed:
+            compress_task_log.delay(identifier)
 
 
 @celery_app.task(ignore_results=True)
@@ -1203,16 +1614,7 @@ def compress_task_log(tasklog_name):
     db.session.rollback()
 
     try:
-        path = join(LOGFILES_DIR, tasklog_name)
-        with open(path, "rb") as logfile:
-            logger.debug("Compressing tasklog file %s", path)
-            compressed_logfile = GzipFile("%s.gz" % path, "wb")
-            compressed_logfile.write(logfile.read())
-        try:
-            remove(join(LOGFILES_DIR, path))
-        except OSError as e:
-            if e.errno != ENOENT:
-                raise
+        get_tasklog_storage().compress(tasklog_name)
     except IOError as e:
         logger.error("Could not compress tasklog file %s: %s: %s",
                      tasklog_name, type(e).__name__, e)
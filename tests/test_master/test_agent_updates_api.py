@@ -0,0 +1,141 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from hashlib import sha256
+from io import BytesIO
+from os import listdir, remove
+from os.path import join, isfile
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import get_api_blueprint
+from pyfarm.master.entrypoints import load_api
+from pyfarm.master.api import agent_updates
+
+DATA = b"PK" + bytes(bytearray(range(256))) * 1024
+CHECKSUM = sha256(DATA).hexdigest()
+
+
+class DisconnectingStream(BytesIO):
+    """Stream which fails like a client disconnecting during an upload"""
+    def read(self, size=-1):
+        if self.tell():
+            raise IOError("client disconnected")
+        return BytesIO.read(self, size)
+
+
+class TestAgentUpdatesAPI(BaseTestCase):
+    version = "0.0.1-dev1"
+    url = "/api/v1/agents/updates/0.0.1-dev1"
+
+    def setup_app(self):
+        super(TestAgentUpdatesAPI, self).setup_app()
+        self.api = get_api_blueprint()
+        self.app.register_blueprint(self.api)
+        load_api(self.app, self.api)
+
+    def tearDown(self):
+        path = join(agent_updates.UPDATES_DIR,
+                    "pyfarm-agent-%s.zip" % self.version)
+        if isfile(path):
+            remove(path)
+        super(TestAgentUpdatesAPI, self).tearDown()
+
+    def put(self, data=DATA, **headers):
+        return self.client.put(self.url, data=data, headers=headers,
+                               content_type="application/zip")
+
+    def test_put_and_get(self):
+        response1 = self.put(**{"X-Checksum-SHA256": CHECKSUM})
+        self.assert_created(response1)
+
+        response2 = self.client.get(self.url)
+        self.assert_ok(response2)
+        self.assertEqual(response2.data, DATA)
+        self.assertEqual(response2.headers["X-Checksum-SHA256"], CHECKSUM)
+        self.assertEqual(response2.headers["ETag"], '"%s"' % CHECKSUM)
+        self.assertEqual(response2.headers["Accept-Ranges"], "bytes")
+
+        response3 = self.client.get(
+            self.url, headers={"If-None-Match": '"%s"' % CHECKSUM})
+        self.assertEqual(response3.status_code, 304)
+
+    def test_put_checksum_mismatch(self):
+        self.assert_created(self.put())
+        response1 = self.put(data=b"PK broken",
+                             **{"X-Checksum-SHA256": CHECKSUM})
+        self.assert_bad_request(response1)
+
+        # The previous upload was left in place
+        response2 = self.client.get(self.url)
+        self.assertEqual(response2.data, DATA)
+
+    def test_put_disconnected(self):
+        response = self.client.put(
+            self.url, input_stream=DisconnectingStream(DATA),
+            content_type="application/zip")
+        self.assert_bad_request(response)
+
+        self.assertEqual(
+            [name for name in listdir(agent_updates.UPDATES_DIR)
+             if name.startswith(".upload-")], [])
+        self.assert_not_found(self.client.get(self.url))
+
+    def test_get_range(self):
+        self.assert_created(self.put())
+
+        response1 = self.client.get(self.url, headers={"Range": "bytes=100-"})
+        self.assertEqual(response1.status_code, 206)
+        self.assertEqual(response1.data, DATA[100:])
+        self.assertEqual(response1.headers["Content-Range"],
+                         "bytes 100-%s/%s" % (len(DATA) - 1, len(DATA)))
+
+        response2 = self.client.get(
+            self.url, headers={"Range": "bytes=10-19",
+                               "If-Range": '"%s"' % CHECKSUM})
+        self.assertEqual(response2.status_code, 206)
+        self.assertEqual(response2.data, DATA[10:20])
+
+        # The file changed since the first part was downloaded
+        response3 = self.client.get(
+            self.url, headers={"Range": "bytes=10-19",
+                               "If-Range": '"outdated"'})
+        self.assert_ok(response3)
+        self.assertEqual(response3.data, DATA)
+
+        response4 = self.client.get(
+            self.url, headers={"Range": "bytes=%s-" % len(DATA)})
+        self.assertEqual(response4.status_code, 416)
+
+    def test_get_sendfile(self):
+        self.assert_created(self.put())
+        original = agent_updates.UPDATES_SENDFILE
+        agent_updates.UPDATES_SENDFILE = "x-accel-redirect"
+        try:
+            response = self.client.get(self.url)
+        finally:
+            agent_updates.UPDATES_SENDFILE = original
+
+        self.assert_ok(response)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(response.headers["X-Accel-Redirect"],
+                         "/pyfarm-updates/pyfarm-agent-%s.zip" % self.version)
+        self.assertEqual(response.headers["X-Checksum-SHA256"], CHECKSUM)
+
+    def test_get_not_found(self):
+        self.assert_not_found(self.client.get(self.url))
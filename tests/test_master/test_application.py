@@ -16,26 +16,33 @@
 
 import os
 import uuid
+from json import loads
 
 try:
-    from httplib import BAD_REQUEST, UNSUPPORTED_MEDIA_TYPE
+    from httplib import (
+        BAD_REQUEST, UNSUPPORTED_MEDIA_TYPE, REQUEST_ENTITY_TOO_LARGE)
 except ImportError:
-    from http.client import BAD_REQUEST, UNSUPPORTED_MEDIA_TYPE
+    from http.client import (
+        BAD_REQUEST, UNSUPPORTED_MEDIA_TYPE, REQUEST_ENTITY_TOO_LARGE)
 
-from flask import Flask, Blueprint, g
+from flask import Flask, Blueprint, g, request
+from flask.views import MethodView
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.login import LoginManager
 from itsdangerous import URLSafeTimedSerializer
 from werkzeug.routing import BaseConverter, ValidationError
+from werkzeug.test import EnvironBuilder, run_wsgi_app
 
 # test class must be loaded first
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
+from pyfarm.core.enums import NOTSET
 from pyfarm.master.utility import jsonify
+from pyfarm.master import application
 from pyfarm.master.application import (
     UUIDConverter, get_application, get_api_blueprint,
-    get_sqlalchemy, get_login_manager, get_login_serializer)
+    get_sqlalchemy, get_login_manager, get_login_serializer, request_body)
 
 
 class TestApplicationFunctions(BaseTestCase):
@@ -83,6 +90,89 @@ class TestApplicationFunctions(BaseTestCase):
         self.assertEqual(response.json, {"success": True})
         self.assertIsNotNone(g.json)
 
+    def test_request_body_size(self):
+        class TestAPI(MethodView):
+            @request_body(max_size=16)
+            def post(self):
+                return jsonify(g.json)
+
+            def put(self):
+                return jsonify(g.json)
+
+        self.app.add_url_rule("/", view_func=TestAPI.as_view("test_api"))
+
+        response1 = self.client.post(
+            "/", content_type="application/json", data='{"a": 1}')
+        self.assert_ok(response1)
+        self.assertEqual(response1.json, {"a": 1})
+
+        response2 = self.client.post(
+            "/", content_type="application/json", data='{"a": "%s"}' % (
+                "x" * 16))
+        self.assertEqual(response2.status_code, REQUEST_ENTITY_TOO_LARGE)
+
+        # Methods without a declaration use the configured limit
+        original_size = application.MAX_REQUEST_SIZE
+        application.MAX_REQUEST_SIZE = 4
+        try:
+            response3 = self.client.put(
+                "/", content_type="application/json", data='{"a": 1}')
+        finally:
+            application.MAX_REQUEST_SIZE = original_size
+        self.assertEqual(response3.status_code, REQUEST_ENTITY_TOO_LARGE)
+
+    def test_request_body_size_chunked(self):
+        @self.app.route("/", methods=("POST", ))
+        @request_body(max_size=16)
+        def test_api():
+            return jsonify(g.json)
+
+        def post(data):
+            # Like a request using chunked transfer encoding, which does
+            # not declare its length up front
+            environ = EnvironBuilder(
+                path="/", method="POST", content_type="application/json",
+                data=data).get_environ()
+            del environ["CONTENT_LENGTH"]
+            environ["wsgi.input_terminated"] = True
+            app_iter, status, _ = run_wsgi_app(self.app, environ)
+            body = b"".join(app_iter)
+            return int(status.split()[0]), body
+
+        status, body = post('{"a": 1}')
+        self.assertEqual(status, 200)
+        self.assertEqual(loads(body.decode("utf-8")), {"a": 1})
+
+        status, _ = post('{"a": "%s"}' % ("x" * 1024))
+        self.assertEqual(status, REQUEST_ENTITY_TOO_LARGE)
+
+    def test_request_body_not_parsed(self):
+        @self.app.route("/", methods=("PUT", ))
+        @request_body(max_size=None, parse_json=False)
+        def test_api():
+            self.assertIs(g.json, NOTSET)
+            return jsonify(data=request.stream.read().decode("utf-8"))
+
+        response = self.client.put(
+            "/", content_type="text/plain", data="x" * 1024)
+        self.assert_ok(response)
+        self.assertEqual(response.json, {"data": "x" * 1024})
+
+    def test_request_body_invalid_json(self):
+        @self.app.route("/", methods=("POST", ))
+        def test_api():
+            return jsonify(success=True)
+
+        response1 = self.client.post(
+            "/", content_type="application/json", data="{")
+        self.assert_bad_request(response1)
+        self.assertEqual(g.error, "failed to decode json")
+
+        response2 = self.client.post(
+            "/", content_type="application/json", data="")
+        self.assert_bad_request(response2)
+        self.assertEqual(g.error, "no data to decode")
+
 
 class TestUUIDConverter(BaseTestCase):
     def test_instance(self):
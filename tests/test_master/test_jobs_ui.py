@@ -0,0 +1,310 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+# test class must be loaded first
+from pyfarm.master.testutil import (
+    BaseTestCase, create_jobtype_version, create_job)
+BaseTestCase.build_environment()
+
+from sqlalchemy import event
+
+from pyfarm.core.enums import WorkState, DBWorkState
+from pyfarm.master.application import db
+from pyfarm.master.entrypoints import load_user_interface
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.core.functions import DEFAULT_PRIORITY
+from pyfarm.models.tag import Tag
+from pyfarm.models.task import Task
+
+# The number of statements rendering the jobs index may take, no matter
+# how many jobs there are
+JOBS_INDEX_QUERY_BUDGET = 12
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(
+            db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+class JobsUITestCase(BaseTestCase):
+    def setup_app(self):
+        super(JobsUITestCase, self).setup_app()
+        self.app.config["LOGIN_DISABLED"] = True
+        load_user_interface(self.app)
+
+    def setUp(self):
+        super(JobsUITestCase, self).setUp()
+        self.jobtype_version = create_jobtype_version()
+
+    def create_job(self, title, states, state=None, **kwargs):
+        return create_job(self.jobtype_version, states, state, title=title,
+                          tags=[Tag(tag="tag-%s" % title)], **kwargs)
+
+
+class TestJobsIndex(JobsUITestCase):
+    def get_index(self, query_string=""):
+        db.session.commit()
+        db.session.expunge_all()
+        with count_queries() as statements:
+            response = self.client.get("/jobs/" + query_string)
+        self.assert_ok(response)
+        return response.data.decode("utf-8"), statements
+
+    def test_counts(self):
+        first = self.create_job(
+            "first", [None, WorkState.RUNNING, WorkState.DONE],
+            state=WorkState.RUNNING)
+        second = self.create_job("second", [WorkState.DONE],
+                                 state=WorkState.DONE)
+        self.create_job("third", [WorkState.FAILED, None],
+                        parents=[first, second])
+
+        data, _ = self.get_index()
+        self.assertIn(
+            "Jobs: 3 (Queued: 1, Running: 1, Failed: 0, Done: 1 )", data)
+        # queued/running/failed/done tasks of the first job
+        self.assertIn("1/1/0/1", data)
+        self.assertIn("1/0/1/0", data)
+        self.assertIn("tag-third", data)
+        self.assertIn("blocked by 1 parent job", data)
+
+    def test_tags_limited_to_page(self):
+        self.create_job("first", [None])
+        self.create_job("second", [None])
+
+        data, _ = self.get_index("?per_page=1&order_by=title&order_dir=asc")
+        self.assertIn("tag-first", data)
+        self.assertNotIn("tag-second", data)
+
+    def test_query_budget(self):
+        self.create_job("first", [None])
+        _, statements = self.get_index()
+        self.assertLessEqual(len(statements), JOBS_INDEX_QUERY_BUDGET)
+
+        for i in range(10):
+            self.create_job("job%s" % i, [None, WorkState.DONE])
+        _, more_statements = self.get_index()
+        self.assertEqual(len(more_statements), len(statements))
+
+        _, statements = self.get_index("?order_by=t_done")
+        self.assertLessEqual(len(statements), JOBS_INDEX_QUERY_BUDGET)
+
+    def test_order_by_failed(self):
+        self.create_job("none_failed", [WorkState.DONE])
+        self.create_job("two_failed", [WorkState.FAILED] * 2)
+        self.create_job("one_failed", [WorkState.FAILED, None])
+
+        data, _ = self.get_index("?order_by=t_failed&order_dir=desc")
+        self.assertLess(data.index("tag-two_failed"),
+                        data.index("tag-one_failed"))
+        self.assertLess(data.index("tag-one_failed"),
+                        data.index("tag-none_failed"))
+        self.assertIn("0/0/2/0", data)
+
+
+class TestTasksPage(JobsUITestCase):
+    # The unix timestamp of 2015-03-01 10:00:00 UTC
+    NOW = 1425204000
+
+    def setUp(self):
+        super(TestTasksPage, self).setUp()
+        now = datetime.utcfromtimestamp(self.NOW)
+        job = create_job(self.jobtype_version)
+        self.job_id = job.id
+
+        # frame, tile, state, seconds since started and finished before
+        # ``NOW``, failures, progress.  Every order has ties.
+        self.rows = []
+        for frame, tile, state, started, finished, failures, progress in [
+                (1, None, None, None, None, 0, 0.0),
+                (1, 0, WorkState.DONE, 300, 100, 1, 1.0),
+                (1, 1, WorkState.RUNNING, 200, None, 0, 0.5),
+                (2, None, WorkState.FAILED, 500, 400, 2, 0.5),
+                (3, None, WorkState.DONE, 1000, 900, 1, 1.0),
+                (4, None, None, None, None, 0, 0.0),
+                (5, None, WorkState.RUNNING, 50, None, 2, 0.25)]:
+            task = Task(job=job, frame=frame, tile=tile)
+            db.session.add(task)
+            db.session.flush()
+            # Set the columns directly so the listeners on Task.state are
+            # not triggered
+            Task.query.filter_by(id=task.id).update(
+                {"state": state, "failures": failures, "progress": progress,
+                 "time_started":
+                     now - timedelta(seconds=started)
+                     if started is not None else None,
+                 "time_finished":
+                     now - timedelta(seconds=finished)
+                     if finished is not None else None},
+                synchronize_session=False)
+            self.rows.append({
+                "id": task.id,
+                "frame": (frame, -1 if tile is None else tile),
+                "state": getattr(DBWorkState, str(state).upper(), 0),
+                "runtime":
+                    started - (finished or 0) if started is not None else 0,
+                "failures": failures,
+                "progress": progress})
+        db.session.commit()
+
+    def expected_ids(self, order_by, order_dir):
+        rows = sorted(self.rows, key=lambda row: (row[order_by], row["id"]),
+                      reverse=order_dir == "desc")
+        return [row["id"] for row in rows]
+
+    def get_all_pages(self, query_string):
+        task_ids = []
+        url = "/jobs/%s/tasks_page?%s" % (self.job_id, query_string)
+        while url is not None:
+            response = self.client.get(url)
+            self.assert_ok(response)
+            task_ids.extend(task["id"] for task in response.json["tasks"])
+            url = response.json["next"]
+            self.assertLessEqual(len(task_ids), len(self.rows))
+        return task_ids
+
+    def test_orders(self):
+        for order_by in ("frame", "state", "runtime", "failures", "progress"):
+            for order_dir in ("asc", "desc"):
+                for per_page in (2, 100):
+                    self.assertEqual(
+                        self.get_all_pages(
+                            "order_by=%s&order_dir=%s&per_page=%s&now=%s" % (
+                                order_by, order_dir, per_page, self.NOW)),
+                        self.expected_ids(order_by, order_dir),
+                        "%s %s, %s per page" % (order_by, order_dir, per_page))
+
+    def test_single_job_page(self):
+        response = self.client.get(
+            "/jobs/%s?order_by=frame&per_page=2" % self.job_id)
+        self.assert_ok(response)
+        self.assertIn("tasks_page", response.data.decode("utf-8"))
+
+    def test_now_pinned(self):
+        response = self.client.get(
+            "/jobs/%s/tasks_page?order_by=runtime&per_page=2&now=%s" % (
+                self.job_id, self.NOW))
+        self.assert_ok(response)
+        self.assertIn("now=%s" % self.NOW, response.json["next"])
+
+        # The running tasks would be the longest running ones by now, but
+        # every page is ordered the same way as the first one
+        self.assertEqual(
+            self.get_all_pages("order_by=runtime&per_page=2&now=%s" % (
+                self.NOW)),
+            self.expected_ids("runtime", "asc"))
+        self.assertNotEqual(
+            self.get_all_pages("order_by=runtime&per_page=2"),
+            self.expected_ids("runtime", "asc"))
+
+    def test_invalid_arguments(self):
+        for query_string in ["order_by=foo", "order_dir=sideways",
+                             "now=yesterday", "now=%s" % (10 ** 20),
+                             "after=[", "after={}", "after=[\"a\", 1]",
+                             "after=[true, 1]", "after=[1, 2, 3, 4]",
+                             "per_page=many"]:
+            for url in ["/jobs/%s/tasks_page?%s", "/jobs/%s?%s"]:
+                response = self.client.get(url % (self.job_id, query_string))
+                self.assert_bad_request(response)
+
+
+class TestMultipleJobActions(JobsUITestCase):
+    def post(self, url, jobs, **form):
+        db.session.commit()
+        form["job_id"] = [str(job.id) for job in jobs]
+        with count_queries() as statements:
+            response = self.client.post(url, data=form)
+        self.assertEqual(response.status_code, 303)
+        db.session.expire_all()
+        return statements
+
+    def test_set_prio_weight_and_move(self):
+        jobs = [self.create_job("job%s" % i, [None]) for i in range(3)]
+        statements = self.post("/jobs/set_prio_weight_multiple", jobs[:1],
+                               prio="5", weight="3")
+        more_statements = self.post("/jobs/set_prio_weight_multiple", jobs,
+                                    prio="7", weight="2")
+        self.assertEqual(len(more_statements), len(statements))
+        self.assertEqual(
+            [(job.priority, job.weight) for job in jobs], [(7, 2)] * 3)
+
+        queue = JobQueue(name="queue")
+        db.session.add(queue)
+        db.session.flush()
+        self.post("/jobs/move_multiple", jobs, queue=str(queue.id))
+        self.assertEqual([job.job_queue_id for job in jobs], [queue.id] * 3)
+
+    def test_tags(self):
+        jobs = [self.create_job("job%s" % i, [None]) for i in range(3)]
+        jobs[0].tags.append(Tag(tag="shared"))
+
+        statements = self.post("/jobs/add_tag_multiple", jobs[:2],
+                               tag="shared")
+        more_statements = self.post("/jobs/add_tag_multiple", jobs,
+                                    tag="shared")
+        self.assertEqual(len(more_statements), len(statements))
+        self.assertEqual(
+            [[tag.tag for tag in job.tags if tag.tag == "shared"]
+             for job in jobs], [["shared"]] * 3)
+
+        self.post("/jobs/remove_tag_multiple", jobs[1:], tag="shared")
+        self.assertEqual(
+            ["shared" in [tag.tag for tag in job.tags] for job in jobs],
+            [True, False, False])
+
+        self.post("/jobs/add_tag_requirement_multiple", jobs, tag="linux")
+        self.post("/jobs/add_tag_requirement_multiple", jobs[:2],
+                  tag="-linux")
+        self.assertEqual(
+            [[x.negate for x in job.tag_requirements] for job in jobs],
+            [[True], [True], [False]])
+
+        self.post("/jobs/remove_tag_requirement_multiple", jobs,
+                  tag="-linux")
+        self.assertEqual(
+            [[x.negate for x in job.tag_requirements] for job in jobs],
+            [[], [], [False]])
+
+    def test_pause(self):
+        jobs = [self.create_job("job%s" % i, [None, WorkState.DONE])
+                for i in range(3)]
+        self.post("/jobs/pause_multiple", jobs[1:])
+        self.assertEqual([job.state for job in jobs],
+                         [None, WorkState.PAUSED, WorkState.PAUSED])
+
+    def test_missing_job(self):
+        job = self.create_job("job", [None])
+        db.session.commit()
+        response = self.client.post(
+            "/jobs/set_prio_weight_multiple",
+            data={"job_id": [str(job.id), "424242"], "prio": "5",
+                  "weight": "3"})
+        self.assert_not_found(response)
+        db.session.expire_all()
+        self.assertEqual(job.priority, DEFAULT_PRIORITY)
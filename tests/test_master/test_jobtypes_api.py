@@ -17,12 +17,14 @@
 
 from json import dumps
 
+from sqlalchemy import event
 
 # test class must be loaded first
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
-from pyfarm.master.application import get_api_blueprint
+from pyfarm.master.application import db, get_api_blueprint
+from pyfarm.master.api.jobtypes import JobTypeCodeCache, code_cache
 from pyfarm.master.entrypoints import load_api
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 
@@ -44,6 +46,10 @@ class TestJobTypeAPI(BaseTestCase):
         self.app.register_blueprint(self.api)
         load_api(self.app, self.api)
 
+    def setUp(self):
+        super(TestJobTypeAPI, self).setUp()
+        code_cache.clear()
+
     def test_jobtype_schema(self):
         response = self.client.get("/api/v1/jobtypes/schema")
         self.assert_ok(response)
@@ -1044,6 +1050,76 @@ class TestJobTypeAPI(BaseTestCase):
             "/api/v1/jobtypes/UnknownJobType/versions/1/code")
         self.assert_not_found(response1)
 
+    def test_jobtype_get_code_cached(self):
+        response1 = self.client.put(
+            "/api/v1/jobtypes/TestJobType",
+            content_type="application/json",
+            data=dumps({
+                    "name": "TestJobType",
+                    "description": "Jobtype for testing inserts and queries",
+                    "code": code
+                    }))
+        self.assert_created(response1)
+
+        response2 = self.client.get(
+            "/api/v1/jobtypes/TestJobType/versions/1/code")
+        self.assert_ok(response2)
+        etag = response2.headers["ETag"]
+        self.assertNotIn("immutable", response2.headers["Cache-Control"])
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response3 = self.client.get(
+                "/api/v1/jobtypes/TestJobType/versions/1/code")
+            response4 = self.client.get(
+                "/api/v1/jobtypes/TestJobType/versions/1/code",
+                headers={"If-None-Match": etag})
+        finally:
+            event.remove(
+                db.engine, "before_cursor_execute", before_cursor_execute)
+
+        # Only the id of the version is looked up, the code is cached
+        self.assertEqual(len(statements), 2)
+        self.assertNotIn("code", statements[0].split("FROM")[0])
+        self.assert_ok(response3)
+        self.assertEqual(response3.data.decode(), code)
+        self.assertEqual(response3.headers["ETag"], etag)
+        self.assertEqual(response4.status_code, 304)
+        self.assertEqual(response4.data, b"")
+
+        # Deleting the version drops it from the cache
+        response5 = self.client.delete(
+            "/api/v1/jobtypes/TestJobType/versions/1")
+        self.assert_no_content(response5)
+        response6 = self.client.get(
+            "/api/v1/jobtypes/TestJobType/versions/1/code")
+        self.assert_not_found(response6)
+
+    def test_jobtype_code_cache_size(self):
+        cache = JobTypeCodeCache(10)
+        first = cache.set(1, 1, u"1234")
+        cache.set(2, 2, u"5678")
+        self.assertIs(cache.get(1), first)
+
+        # Evicts the least recently used entry
+        cache.set(3, 3, u"901")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.size, 7)
+
+        # Too large to be cached at all
+        entry = cache.set(4, 4, u"x" * 11)
+        self.assertEqual(entry[2], b"x" * 11)
+        self.assertIsNone(cache.get(4))
+
+        cache.discard(1)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.size, 3)
+
     def test_jobtype_list_requirements(self):
         response1 = self.client.post(
             "/api/v1/software/",
@@ -65,6 +65,18 @@ class TestLogin(BaseTestCase):
         # commit the changes to the database
         db.session.commit()
 
+    def test_load_token(self):
+        token = self.normal_user.get_auth_token()
+        with self.app.test_request_context():
+            user = load_token(token)
+            self.assertEqual(user.id, self.normal_user.id)
+            self.assertEqual(load_user(str(self.admin_user.id)).username,
+                             self.admin_username)
+
+            self.normal_user.password = User.hash_password("changed")
+            db.session.commit()
+            self.assertIsNone(load_token(token))
+
     def test_login_bad_content_type(self):
         response = self.client.get(
             "/login/", method="GET",
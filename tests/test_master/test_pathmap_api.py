@@ -17,12 +17,15 @@
 
 import uuid
 
+from sqlalchemy import event
+
 # test class must be loaded first
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
 from pyfarm.master.utility import dumps
-from pyfarm.master.application import get_api_blueprint
+from pyfarm.master.application import db, get_api_blueprint
+from pyfarm.master.api.pathmaps import cache
 from pyfarm.master.entrypoints import load_api
 from pyfarm.models.pathmap import PathMap
 
@@ -34,6 +37,10 @@ class TestPathMapAPI(BaseTestCase):
         self.app.register_blueprint(self.api)
         load_api(self.app, self.api)
 
+    def setUp(self):
+        super(TestPathMapAPI, self).setUp()
+        cache.clear()
+
     def test_pathmap_schema(self):
         response = self.client.get("/api/v1/pathmaps/schema")
         self.assert_ok(response)
@@ -142,6 +149,76 @@ class TestPathMapAPI(BaseTestCase):
                     }
                 ])
 
+    def test_pathmap_list_cached(self):
+        for tag in ("testtag1", "testtag2"):
+            response = self.client.post(
+                "/api/v1/pathmaps/",
+                content_type="application/json",
+                data=dumps({"path_linux": "/%s" % tag,
+                            "path_windows": "c:\\%s" % tag,
+                            "path_osx": "/%s" % tag,
+                            "tag": tag}))
+            self.assert_created(response)
+        pathmap_id = response.json["id"]
+
+        agent_id = uuid.uuid4()
+        response1 = self.client.post(
+            "/api/v1/agents/",
+            content_type="application/json",
+            data=dumps({
+                "id": agent_id,
+                "cpus": 16,
+                "free_ram": 133,
+                "hostname": "testagent1",
+                "remote_ip": "10.0.200.1",
+                "port": 64994,
+                "ram": 2048}))
+        self.assert_created(response1)
+        url = "/api/v1/pathmaps/?for_agent=%s" % agent_id
+
+        response2 = self.client.get(url)
+        self.assert_ok(response2)
+        self.assertEqual(response2.json, [])
+        etag = response2.headers["ETag"]
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response3 = self.client.get(url, headers={"If-None-Match": etag})
+        finally:
+            event.remove(
+                db.engine, "before_cursor_execute", before_cursor_execute)
+
+        # Only the tags of the agent were looked up
+        self.assertEqual(response3.status_code, 304)
+        self.assertEqual(len(statements), 1)
+
+        # Tagging the agent changes the path maps applying to it
+        response4 = self.client.post(
+            "/api/v1/tags/testtag2/agents/",
+            content_type="application/json",
+            data=dumps({"agent_id": agent_id}))
+        self.assert_created(response4)
+        response5 = self.client.get(url, headers={"If-None-Match": etag})
+        self.assert_ok(response5)
+        self.assertEqual([x["tag"] for x in response5.json], ["testtag2"])
+
+        # So does editing the path map
+        response6 = self.client.post(
+            "/api/v1/pathmaps/%s" % pathmap_id,
+            content_type="application/json",
+            data=dumps({"path_linux": "/edited"}))
+        self.assert_ok(response6)
+        response7 = self.client.get(url)
+        self.assertEqual([x["path_linux"] for x in response7.json],
+                         ["/edited"])
+        self.assertNotEqual(response7.headers["ETag"],
+                            response5.headers["ETag"])
+
     def test_pathmap_get_unknown(self):
         response1 = self.client.get("/api/v1/pathmaps/10")
         self.assert_not_found(response1)
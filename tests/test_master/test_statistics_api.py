@@ -0,0 +1,209 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from calendar import timegm
+from datetime import datetime, timedelta
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import db, get_api_blueprint
+from pyfarm.master.entrypoints import load_api
+from pyfarm.models.statistics.agent_count import AgentCount
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.models.statistics.task_count import TaskCount
+from pyfarm.models.statistics.queries import (
+    cache, task_event_counts, task_counts, agent_counts,
+    agent_count_resolution)
+
+
+def timestamp(time):
+    return timegm(time.utctimetuple())
+
+
+class TestStatisticsQueries(BaseTestCase):
+    now = datetime(2015, 6, 10, 12, 5)
+
+    def setUp(self):
+        super(TestStatisticsQueries, self).setUp()
+        cache.clear()
+
+    def add_event_count(self, time_start, job_queue_id=None, **counts):
+        event_count = TaskEventCount(job_queue_id=job_queue_id, **counts)
+        event_count.time_start = time_start
+        event_count.time_end = time_start
+        db.session.add(event_count)
+
+    def add_task_count(self, counted_time, job_queue_id=None, queued=0):
+        db.session.add(TaskCount(
+            counted_time=counted_time, job_queue_id=job_queue_id,
+            total_queued=queued, total_running=0, total_done=0,
+            total_failed=0))
+
+    def test_task_event_counts(self):
+        self.add_event_count(datetime(2015, 6, 10, 10, 10), num_new=1)
+        self.add_event_count(datetime(2015, 6, 10, 10, 50), num_new=2,
+                             num_done=1)
+        self.add_event_count(datetime(2015, 6, 10, 12, 1), job_queue_id=1,
+                             num_failed=4)
+        # Too old to be included
+        self.add_event_count(datetime(2015, 6, 10, 9, 59), num_new=8)
+        db.session.commit()
+
+        events = task_event_counts(
+            datetime(2015, 6, 10, 10), 3600, now=self.now)
+        self.assertEqual(events["resolution"], 3600)
+        self.assertEqual(events["timestamps"], [
+            timestamp(datetime(2015, 6, 10, 10)),
+            timestamp(datetime(2015, 6, 10, 11)),
+            timestamp(datetime(2015, 6, 10, 12))])
+        self.assertEqual(events["new"], [3, 0, 0])
+        self.assertEqual(events["done"], [1, 0, 0])
+        self.assertEqual(events["failed"], [0, 0, 4])
+
+        events = task_event_counts(
+            datetime(2015, 6, 10, 10), 3600, no_queue=True, now=self.now)
+        self.assertEqual(events["failed"], [0])
+        events = task_event_counts(
+            datetime(2015, 6, 10, 10), 3600, job_queue_ids=[1], now=self.now)
+        self.assertEqual(events["failed"], [4])
+
+    def test_task_counts(self):
+        self.add_task_count(datetime(2015, 6, 10, 11), queued=4)
+        self.add_task_count(datetime(2015, 6, 10, 11, 30), queued=2)
+        self.add_task_count(datetime(2015, 6, 10, 11), job_queue_id=1,
+                            queued=10)
+        db.session.commit()
+
+        counts = task_counts(datetime(2015, 6, 10, 10), 3600, now=self.now)
+        self.assertEqual(
+            counts["timestamps"], [timestamp(datetime(2015, 6, 10, 11))])
+        self.assertEqual(counts["queued"], [13.0])
+        self.assertEqual(counts["running"], [0.0])
+
+    def test_completed_periods_cached(self):
+        self.add_event_count(datetime(2015, 6, 10, 11, 10), num_new=1)
+        self.add_event_count(datetime(2015, 6, 10, 12, 1), num_new=2)
+        db.session.commit()
+        task_event_counts(datetime(2015, 6, 10, 10), 3600, now=self.now)
+
+        # Only the current period is read again
+        self.add_event_count(datetime(2015, 6, 10, 11, 20), num_new=4)
+        self.add_event_count(datetime(2015, 6, 10, 12, 2), num_new=8)
+        db.session.commit()
+        events = task_event_counts(
+            datetime(2015, 6, 10, 10), 3600, now=self.now)
+        self.assertEqual(events["new"], [1, 10])
+
+        cache.clear()
+        events = task_event_counts(
+            datetime(2015, 6, 10, 10), 3600, now=self.now)
+        self.assertEqual(events["new"], [5, 10])
+
+    def test_cached_periods_move_along(self):
+        self.add_event_count(datetime(2015, 6, 10, 10, 10), num_new=1)
+        self.add_event_count(datetime(2015, 6, 10, 11, 10), num_new=2)
+        self.add_event_count(datetime(2015, 6, 10, 12, 1), num_new=4)
+        db.session.commit()
+        events = task_event_counts(
+            datetime(2015, 6, 10, 10), 3600, now=self.now)
+        self.assertEqual(events["new"], [1, 2, 4])
+
+        # One period later the window starts one period later as well.  The
+        # period it has in common with the first request comes from the
+        # cache, only the periods from the one that was current before are
+        # read again.
+        self.add_event_count(datetime(2015, 6, 10, 10, 20), num_new=8)
+        self.add_event_count(datetime(2015, 6, 10, 11, 20), num_new=16)
+        self.add_event_count(datetime(2015, 6, 10, 12, 2), num_new=32)
+        self.add_event_count(datetime(2015, 6, 10, 13, 1), num_new=64)
+        db.session.commit()
+        events = task_event_counts(
+            datetime(2015, 6, 10, 11), 3600,
+            now=self.now + timedelta(hours=1))
+        self.assertEqual(events["timestamps"], [
+            timestamp(datetime(2015, 6, 10, 11)),
+            timestamp(datetime(2015, 6, 10, 12)),
+            timestamp(datetime(2015, 6, 10, 13))])
+        self.assertEqual(events["new"], [2, 36, 64])
+        self.assertEqual(len(cache.entries), 1)
+
+        # A window starting before the cached periods is read entirely
+        events = task_event_counts(
+            datetime(2015, 6, 10, 10), 3600,
+            now=self.now + timedelta(hours=1))
+        self.assertEqual(events["new"], [9, 18, 36, 64])
+
+    def test_agent_counts(self):
+        for counted_time, num_online in (
+                (datetime(2015, 6, 10, 11, 1), 2),
+                (datetime(2015, 6, 10, 11, 2), 3),
+                (datetime(2015, 6, 10, 12, 1), 5)):
+            db.session.add(AgentCount(
+                counted_time=counted_time, num_online=num_online,
+                num_running=1, num_offline=0, num_disabled=0))
+        db.session.commit()
+
+        counts = agent_counts(datetime(2015, 6, 10, 10), 3600, now=self.now)
+        self.assertEqual(counts["timestamps"], [
+            timestamp(datetime(2015, 6, 10, 11)),
+            timestamp(datetime(2015, 6, 10, 12))])
+        self.assertEqual(counts["online"], [2.5, 5.0])
+        self.assertEqual(counts["running"], [1.0, 1.0])
+
+    def test_agent_count_resolution(self):
+        self.assertEqual(agent_count_resolution(timedelta(hours=1)), 60)
+        self.assertEqual(agent_count_resolution(timedelta(days=1)), 300)
+        self.assertEqual(agent_count_resolution(timedelta(days=7)), 3600)
+        self.assertEqual(
+            agent_count_resolution(timedelta(days=365)), 18 * 3600)
+
+
+class TestStatisticsAPI(BaseTestCase):
+    def setup_app(self):
+        super(TestStatisticsAPI, self).setup_app()
+        self.api = get_api_blueprint()
+        self.app.register_blueprint(self.api)
+        load_api(self.app, self.api)
+
+    def setUp(self):
+        super(TestStatisticsAPI, self).setUp()
+        cache.clear()
+
+    def test_task_events(self):
+        time_start = datetime.utcnow() - timedelta(hours=2)
+        event_count = TaskEventCount(num_new=3, num_done=1)
+        event_count.time_start = time_start
+        event_count.time_end = time_start
+        db.session.add(event_count)
+        db.session.commit()
+
+        response = self.client.get(
+            "/api/v1/statistics/task_events?days_back=1&minutes_resolution=60")
+        self.assert_ok(response)
+        self.assertEqual(response.json["task_events"]["resolution"], 3600)
+        self.assertEqual(response.json["task_events"]["new"], [3])
+        self.assertEqual(response.json["task_events"]["done"], [1])
+        self.assertEqual(response.json["task_counts"]["timestamps"], [])
+
+    def test_task_events_invalid_arguments(self):
+        response = self.client.get(
+            "/api/v1/statistics/task_events?days_back=foo")
+        self.assert_bad_request(response)
+        response = self.client.get(
+            "/api/v1/statistics/task_events?minutes_resolution=0")
+        self.assert_bad_request(response)
@@ -18,9 +18,10 @@
 import uuid
 
 # test class must be loaded first
-from pyfarm.master.testutil import BaseTestCase
+from pyfarm.master.testutil import BaseTestCase, InMemoryTaskLogStorage
 BaseTestCase.build_environment()
 
+from pyfarm.master import tasklog_storage
 from pyfarm.master.utility import dumps
 from pyfarm.master.application import get_api_blueprint
 from pyfarm.master.entrypoints import load_api
@@ -402,3 +403,15 @@ class TestTaskLogsAPI(BaseTestCase):
             "/api/v1/jobs/%s/tasks/%s/attempts/1/logs/"
             "testlogidentifier-neveruploaded/logfile" % (job_id, task_id))
         self.assert_not_found(response2)
+
+
+class TestTaskLogsAPIInMemoryStorage(TestTaskLogsAPI):
+    """Runs the same tests with logs kept outside of the filesystem"""
+    def setUp(self):
+        super(TestTaskLogsAPIInMemoryStorage, self).setUp()
+        self.original_storage = tasklog_storage._storage
+        tasklog_storage._storage = InMemoryTaskLogStorage()
+
+    def tearDown(self):
+        tasklog_storage._storage = self.original_storage
+        super(TestTaskLogsAPIInMemoryStorage, self).tearDown()
@@ -0,0 +1,161 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from io import BytesIO
+from os import listdir, makedirs, sep
+from os.path import isfile, dirname, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from pyfarm.master.testutil import InMemoryTaskLogStorage
+from pyfarm.master.tasklog_storage import (
+    FlatTaskLogStorage, ShardedTaskLogStorage, load_tasklog_storage)
+
+
+dummy_log = b"1,test log entry\n2,another test log entry\n"
+
+
+class TestFlatTaskLogStorage(TestCase):
+    storage_class = FlatTaskLogStorage
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.addCleanup(rmtree, self.root)
+        self.storage = self.storage_class(self.root)
+
+    def test_write_and_open(self):
+        self.storage.write("testlog.csv", BytesIO(dummy_log))
+        with self.storage.open("testlog.csv") as logfile:
+            self.assertEqual(logfile.read(), dummy_log)
+
+    def test_open_missing(self):
+        with self.assertRaises(IOError):
+            self.storage.open("missing.csv")
+        with self.assertRaises(IOError):
+            self.storage.open_compressed("missing.csv")
+
+    def test_acceptable(self):
+        self.assertTrue(self.storage.acceptable("testlog.csv"))
+        self.assertFalse(self.storage.acceptable("../../../etc/passwd"))
+
+    def test_compress(self):
+        self.storage.write("testlog.csv", BytesIO(dummy_log))
+        self.storage.compress("testlog.csv")
+        with self.assertRaises(IOError):
+            self.storage.open("testlog.csv")
+        logfile = self.storage.open_compressed("testlog.csv")
+        self.assertEqual(logfile.read(), dummy_log)
+        logfile.close()
+        self.assertEqual(list(self.storage.iter_logs()),
+                         [("testlog.csv", True)])
+
+    def test_remove(self):
+        self.storage.write("testlog.csv", BytesIO(dummy_log))
+        self.storage.remove("testlog.csv")
+        self.storage.remove("testlog.csv")
+        self.assertEqual(list(self.storage.iter_logs()), [])
+
+    def test_iter_logs(self):
+        self.storage.write("a.csv", BytesIO(dummy_log))
+        self.storage.write("b.csv", BytesIO(dummy_log))
+        self.storage.compress("b.csv")
+        self.assertEqual(sorted(self.storage.iter_logs()),
+                         [("a.csv", False), ("b.csv", True)])
+
+
+class TestShardedTaskLogStorage(TestFlatTaskLogStorage):
+    storage_class = ShardedTaskLogStorage
+
+    def test_sharded_path(self):
+        self.storage.write("testlog.csv", BytesIO(dummy_log))
+        path = self.storage.path("testlog.csv")
+        self.assertTrue(isfile(path))
+        self.assertEqual(dirname(dirname(dirname(path))), self.storage.root)
+        self.assertNotIn("testlog.csv", listdir(self.root))
+
+    def test_depth(self):
+        storage = ShardedTaskLogStorage(self.root, depth=3)
+        self.assertEqual(len(storage.shard("testlog.csv").split(sep)), 3)
+        with self.assertRaises(ValueError):
+            ShardedTaskLogStorage(self.root, depth=0)
+
+    def test_iter_logs_skips_directories(self):
+        self.storage.write("testlog.csv", BytesIO(dummy_log))
+        makedirs(join(dirname(self.storage.path("testlog.csv")), "stray"))
+        self.assertEqual(list(self.storage.iter_logs()),
+                         [("testlog.csv", False)])
+
+    def test_remove_prunes_shards(self):
+        self.storage.write("testlog.csv", BytesIO(dummy_log))
+        self.storage.remove("testlog.csv")
+        self.assertEqual(listdir(self.root), [])
+
+    def test_reads_flat_layout(self):
+        flat = FlatTaskLogStorage(self.root)
+        flat.write("old.csv", BytesIO(dummy_log))
+        flat.write("old_compressed.csv", BytesIO(dummy_log))
+        flat.compress("old_compressed.csv")
+
+        with self.storage.open("old.csv") as logfile:
+            self.assertEqual(logfile.read(), dummy_log)
+        logfile = self.storage.open_compressed("old_compressed.csv")
+        self.assertEqual(logfile.read(), dummy_log)
+        logfile.close()
+        self.assertEqual(
+            sorted(self.storage.iter_logs()),
+            [("old.csv", False), ("old_compressed.csv", True)])
+
+    def test_migrate_flat_logs(self):
+        flat = FlatTaskLogStorage(self.root)
+        flat.write("old.csv", BytesIO(dummy_log))
+        flat.write("old_compressed.csv", BytesIO(dummy_log))
+        flat.compress("old_compressed.csv")
+
+        self.assertEqual(self.storage.migrate_flat_logs(), 2)
+        self.assertEqual(list(self.storage.iter_flat_logs()), [])
+        self.assertTrue(isfile(self.storage.path("old.csv")))
+        self.assertTrue(isfile(self.storage.path("old_compressed.csv") + ".gz"))
+        self.assertEqual(
+            sorted(self.storage.iter_logs()),
+            [("old.csv", False), ("old_compressed.csv", True)])
+        self.assertEqual(self.storage.migrate_flat_logs(), 0)
+
+
+class TestInMemoryTaskLogStorage(TestFlatTaskLogStorage):
+    storage_class = InMemoryTaskLogStorage
+
+
+class TestLoadTaskLogStorage(TestCase):
+    def setUp(self):
+        self.root = mkdtemp()
+        self.addCleanup(rmtree, self.root)
+
+    def test_builtin(self):
+        self.assertIsInstance(
+            load_tasklog_storage("flat", self.root), FlatTaskLogStorage)
+        storage = load_tasklog_storage("sharded", self.root, depth=1)
+        self.assertIsInstance(storage, ShardedTaskLogStorage)
+        self.assertEqual(storage.depth, 1)
+
+    def test_import_path(self):
+        storage = load_tasklog_storage(
+            "pyfarm.master.testutil:InMemoryTaskLogStorage", self.root)
+        self.assertIsInstance(storage, InMemoryTaskLogStorage)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            load_tasklog_storage("foobar", self.root)
@@ -15,16 +15,18 @@
 # limitations under the License.
 
 from uuid import uuid4
+from datetime import datetime
 
-from sqlalchemy import Column, Integer, DateTime
+from sqlalchemy import Column, Integer, DateTime, literal
 
 # test class must be loaded first
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
+from pyfarm.master.application import db
 from pyfarm.models.core.types import IDTypeWork, WorkStateEnum
 from pyfarm.models.core.functions import (
-    modelfor, getuuid, work_columns, split_and_extend)
+    modelfor, getuuid, work_columns, split_and_extend, epoch_seconds)
 
 
 class Foo(object):
@@ -80,3 +82,13 @@ class TestFunctionsModule(BaseTestCase):
             set(["a", "a.b", "a.b.c", "a.b.c.d"]))
         self.assertIsNone(split_and_extend(None))
 
+
+    def test_epoch_seconds(self):
+        start = datetime(2015, 3, 1, 10, 0, 0)
+        finish = datetime(2015, 3, 1, 11, 2, 3, 500000)
+        seconds, runtime = db.session.query(
+            epoch_seconds(literal(start, DateTime)),
+            epoch_seconds(literal(finish, DateTime)) -
+            epoch_seconds(literal(start, DateTime))).one()
+        self.assertEqual(seconds, 1425204000)
+        self.assertEqual(runtime, 3723)
@@ -14,8 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import uuid
 from random import randint, choice
+from timeit import repeat
 from unittest import skipUnless
 
 from sqlalchemy.types import BigInteger, VARBINARY
@@ -26,13 +28,19 @@ from sqlalchemy.dialects.postgresql import UUID
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
-from pyfarm.core.enums import AgentState, DBAgentState, STRING_TYPES
+from pyfarm.core.enums import (
+    AgentState, DBAgentState, STRING_TYPES, _AgentState, _WorkState)
 from pyfarm.master.application import db
 from pyfarm.master.config import config
 from pyfarm.models.core.types import (
     IPv4Address, MACAddress, UseAgentAddressEnum, JSONDict, JSONList,
     JSONSerializable, id_column, AgentStateEnum,
-    IDTypeWork, IDTypeAgent, IDTypeTag, IPAddress, WorkStateEnum, UUIDType)
+    IDTypeWork, IDTypeAgent, IDTypeTag, IPAddress, WorkStateEnum, UUIDType,
+    UUID_CACHE_SIZE)
+
+# Timings are only compared when asked for, they are not reliable on shared
+# machines or when the tests run under coverage
+RUN_BENCHMARKS = os.environ.get("PYFARM_RUN_BENCHMARKS") == "1"
 
 
 class TypeModel(db.Model):
@@ -174,6 +182,17 @@ class TestIPAddressType(BaseTestCase):
         self.assertIsInstance(result.ipv4, IPAddress)
         self.assertEqual(result.ipv4, ipvalue)
 
+    def test_from_int(self):
+        value = IPAddress.from_int(int(IPAddress("192.168.1.1")))
+        self.assertIsInstance(value, IPAddress)
+        self.assertEqual(value, "192.168.1.1")
+        self.assertEqual(value.version, 4)
+
+    def test_result_out_of_range(self):
+        with self.assertRaises(ValueError):
+            IPv4Address().process_result_value(
+                IPv4Address.MAX_INT + 1, db.engine.dialect)
+
     def test_insert_float(self):
         ipvalue = 3.14
         model = TypeModel(ipv4=ipvalue)
@@ -256,6 +275,19 @@ class TestAgentStateEnumTypes(BaseTestCase):
             result = TypeModel.query.filter_by(id=model_id).first()
             self.assertEqual(result.agent_state, i)
 
+    def test_lookup(self):
+        column_type = AgentStateEnum()
+        for value in _AgentState:
+            self.assertIs(column_type.process_result_value(
+                value.int, db.engine.dialect), value)
+            self.assertIs(column_type.process_result_value(
+                value.str, db.engine.dialect), value)
+            self.assertEqual(column_type.process_bind_param(
+                value.str, db.engine.dialect), value.int)
+
+        with self.assertRaises(ValueError):
+            column_type.process_result_value([], db.engine.dialect)
+
     def test_string(self):
         for i in AgentState:
             model = TypeModel(agent_state=i)
@@ -298,6 +330,21 @@ class TestUUIDType(BaseTestCase):
         with self.assertRaises(TypeError):
             UUIDType()._to_uuid(None)
 
+    def test_result_interned(self):
+        value = uuid.uuid4()
+        type_ = UUIDType()
+        first = type_.process_result_value(value.bytes, db.engine.dialect)
+        self.assert_uuid_equal(first, value)
+        self.assertIs(
+            type_.process_result_value(value.bytes, db.engine.dialect),
+            first)
+
+    def test_result_cache_bounded(self):
+        type_ = UUIDType()
+        for _ in range(UUID_CACHE_SIZE + 1):
+            type_.process_result_value(uuid.uuid4().bytes, db.engine.dialect)
+        self.assertLessEqual(len(UUIDType.interned), UUID_CACHE_SIZE)
+
     def test_insert_uuid_hex(self):
         value = uuid.uuid4()
         model = TypeModel(uuid=value.hex)
@@ -365,3 +412,50 @@ class TestUUIDType(BaseTestCase):
         type_ = UUIDType()
         self.assertIsInstance(
             type_.load_dialect_impl(db.engine.dialect), UUID)
+
+
+class TestColumnTypeBenchmark(BaseTestCase):
+    """
+    Micro-benchmark of the conversion of rows loaded from the database,
+    comparing each column type against converting the same values the
+    straightforward way.  The results are always compared, the timings only
+    when ``PYFARM_RUN_BENCHMARKS=1`` is set.
+    """
+    ROWS = 10000
+
+    def assert_faster(self, column_type, reference, values):
+        dialect = db.engine.dialect
+
+        def convert():
+            return [column_type.process_result_value(value, dialect)
+                    for value in values]
+
+        def convert_reference():
+            return [reference(value) for value in values]
+
+        self.assertEqual(convert(), convert_reference())
+        if RUN_BENCHMARKS:
+            self.assertLess(
+                min(repeat(convert, number=1, repeat=3)),
+                min(repeat(convert_reference, number=1, repeat=3)))
+
+    def test_enum(self):
+        def scan(value):
+            for enum_value in _WorkState:
+                if value == enum_value:
+                    return enum_value
+
+        self.assert_faster(
+            WorkStateEnum(), scan,
+            [choice(list(_WorkState)).int for _ in range(self.ROWS)])
+
+    def test_ipv4(self):
+        self.assert_faster(
+            IPv4Address(), IPAddress,
+            [randint(0, IPv4Address.MAX_INT) for _ in range(self.ROWS)])
+
+    def test_uuid(self):
+        agent_ids = [uuid.uuid4().bytes for _ in range(100)]
+        self.assert_faster(
+            UUIDType(), lambda value: uuid.UUID(bytes=value),
+            [choice(agent_ids) for _ in range(self.ROWS)])
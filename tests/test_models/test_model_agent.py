@@ -20,14 +20,16 @@ import uuid
 from sqlalchemy.exc import DatabaseError
 
 
-from pyfarm.master.testutil import BaseTestCase
+from pyfarm.master.testutil import (
+    BaseTestCase, create_jobtype_version, create_job, create_agent)
 BaseTestCase.build_environment()
 
-from pyfarm.core.enums import AgentState, UseAgentAddress
+from pyfarm.core.enums import AgentState, UseAgentAddress, WorkState
 from pyfarm.master.application import db
 from pyfarm.models.software import Software, SoftwareVersion
 from pyfarm.models.tag import Tag
 from pyfarm.models.agent import Agent
+from pyfarm.models.task import Task
 
 try:
     from itertools import product
@@ -332,3 +334,39 @@ class TestModelValidation(AgentTestCase):
 
         with self.assertRaises(ValueError):
             model.ram = Agent.MAX_RAM + 10
+
+
+class TestRequeueTasks(BaseTestCase):
+    def test_requeue_tasks(self):
+        jobtype_version = create_jobtype_version()
+        agent = create_agent(1, cpus=32)
+        other_agent = create_agent(2)
+        jobs = [
+            create_job(jobtype_version,
+                       [WorkState.RUNNING, None, WorkState.RUNNING],
+                       WorkState.RUNNING, title="job0"),
+            create_job(jobtype_version, [WorkState.RUNNING, WorkState.DONE],
+                       WorkState.RUNNING, title="job1")]
+        tasks = [task for job in jobs for task in job.tasks.order_by(
+            Task.frame)]
+
+        agents = [agent, agent, other_agent, agent, agent]
+        for task, task_agent in zip(tasks, agents):
+            Task.query.filter_by(id=task.id).update(
+                {"agent_id": task_agent.id}, synchronize_session=False)
+        db.session.commit()
+
+        agent.state = AgentState.OFFLINE
+        self.assertEqual(sorted(agent.requeue_tasks()),
+                         sorted(job.id for job in jobs))
+        db.session.commit()
+
+        self.assertEqual([task.agent_id for task in tasks],
+                         [None, None, other_agent.id, None, agent.id])
+        self.assertEqual([task.state for task in tasks],
+                         [None, None, WorkState.RUNNING, None,
+                          WorkState.DONE])
+        # The first job still has a task running on the other agent
+        self.assertEqual([job.state for job in jobs],
+                         [WorkState.RUNNING, None])
+        self.assertEqual(agent.requeue_tasks(), [])
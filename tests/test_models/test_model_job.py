@@ -22,10 +22,13 @@ relationships.
 from textwrap import dedent
 
 from datetime import datetime
+from sqlalchemy import select
 from sqlalchemy.exc import DatabaseError
+from sqlalchemy.orm import undefer_group
 
 # test class must be loaded first
-from pyfarm.master.testutil import BaseTestCase
+from pyfarm.master.testutil import (
+    BaseTestCase, create_jobtype_version, create_job, create_agent)
 BaseTestCase.build_environment()
 
 from pyfarm.core.enums import WorkState
@@ -33,9 +36,12 @@ from pyfarm.master.application import db
 from pyfarm.models.tag import Tag
 from pyfarm.models.software import Software, JobSoftwareRequirement
 from pyfarm.models.agent import Agent
-from pyfarm.models.job import Job
+from pyfarm.models.job import Job, JobDependency
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.task import Task
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.scheduler.tasks import verify_job_task_counts
 
 
 class TestTags(BaseTestCase):
@@ -221,3 +227,238 @@ class TestJobEventsAndValidation(BaseTestCase):
         self.assertIsNone(model.time_started)
         model.state = WorkState.RUNNING
         self.assertIsInstance(model.time_started, datetime)
+
+
+class TestRerun(BaseTestCase):
+    def setUp(self):
+        super(TestRerun, self).setUp()
+        self.jobtype_version = create_jobtype_version()
+        self.queue = JobQueue(name="queue")
+        db.session.add(self.queue)
+        self.agent = create_agent()
+
+    def create_job(self, states, state, parents=None):
+        job = create_job(self.jobtype_version, states, state,
+                         queue=self.queue, parents=parents or [])
+        Task.query.filter_by(job_id=job.id).update(
+            {"agent_id": self.agent.id}, synchronize_session=False)
+        Task.query.filter_by(job_id=job.id, state=WorkState.FAILED).update(
+            {"failures": 1}, synchronize_session=False)
+        Job.query.filter_by(id=job.id).update(
+            {"completion_notify_sent": True}, synchronize_session=False)
+        db.session.expire_all()
+        return job
+
+    def task_states(self, job):
+        return [task.state for task in job.tasks.order_by(Task.frame)]
+
+    def test_rerun_with_children(self):
+        parent = self.create_job(
+            [WorkState.DONE, WorkState.FAILED, WorkState.RUNNING],
+            WorkState.RUNNING)
+        child = self.create_job([WorkState.DONE], WorkState.DONE,
+                                parents=[parent])
+        other_parent = self.create_job([WorkState.DONE], WorkState.DONE)
+        # Reachable through both parents, but only rerun once
+        grandchild = self.create_job(
+            [WorkState.FAILED], WorkState.FAILED,
+            parents=[child, other_parent])
+        unrelated = self.create_job([WorkState.DONE], WorkState.DONE)
+        db.session.commit()
+
+        self.assertEqual(Job.descendant_ids([parent.id]),
+                         set([parent.id, child.id, grandchild.id]))
+        self.assertEqual(Job.rerun_jobs([parent.id]), 4)
+        db.session.commit()
+
+        self.assertEqual(self.task_states(parent),
+                         [None, None, WorkState.RUNNING])
+        self.assertEqual(parent.state, WorkState.RUNNING)
+        self.assertFalse(parent.completion_notify_sent)
+        self.assertEqual(self.task_states(child), [None])
+        self.assertIsNone(child.state)
+        self.assertEqual(self.task_states(grandchild), [None])
+        self.assertEqual(grandchild.tasks.one().failures, 0)
+        self.assertIsNone(grandchild.tasks.one().agent_id)
+        self.assertEqual(other_parent.state, WorkState.DONE)
+        self.assertEqual(unrelated.state, WorkState.DONE)
+
+        event_count = TaskEventCount.query.one()
+        self.assertEqual(event_count.job_queue_id, self.queue.id)
+        self.assertEqual(event_count.num_restarted, 4)
+
+    def test_rerun_failed(self):
+        job = self.create_job([WorkState.DONE, WorkState.FAILED],
+                              WorkState.FAILED)
+        paused = self.create_job([WorkState.FAILED], WorkState.PAUSED)
+        done = self.create_job([WorkState.DONE], WorkState.DONE)
+        db.session.commit()
+
+        job.rerun_failed()
+        paused.rerun_failed()
+        done.rerun_failed()
+        db.session.commit()
+
+        self.assertEqual(self.task_states(job), [WorkState.DONE, None])
+        self.assertIsNone(job.state)
+        self.assertEqual(self.task_states(paused), [None])
+        self.assertEqual(paused.state, WorkState.PAUSED)
+        self.assertEqual(self.task_states(done), [WorkState.DONE])
+        self.assertEqual(done.state, WorkState.DONE)
+
+
+class TestUnfinishedParents(BaseTestCase):
+    def setUp(self):
+        super(TestUnfinishedParents, self).setUp()
+        self.jobtype_version = create_jobtype_version()
+
+    def create_job(self, parents=None):
+        return create_job(self.jobtype_version, parents=parents or [])
+
+    def test_parent_state(self):
+        parent = self.create_job()
+        other_parent = self.create_job()
+        other_parent.state = WorkState.DONE
+        child = self.create_job(parents=[parent, other_parent])
+        db.session.commit()
+        self.assertEqual(child.num_unfinished_parents, 1)
+
+        parent.state = WorkState.DONE
+        db.session.flush()
+        self.assertEqual(child.num_unfinished_parents, 0)
+        self.assertTrue(db.session.info.get("jobs_unblocked"))
+        db.session.commit()
+        self.assertNotIn("jobs_unblocked", db.session.info)
+
+        other_parent.state = None
+        db.session.commit()
+        self.assertEqual(child.num_unfinished_parents, 1)
+
+    def test_parents_changed_and_deleted(self):
+        parent = self.create_job()
+        child = self.create_job()
+        db.session.commit()
+        self.assertEqual(child.num_unfinished_parents, 0)
+
+        child.parents = [parent]
+        db.session.commit()
+        self.assertEqual(child.num_unfinished_parents, 1)
+
+        db.session.delete(parent)
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(child.num_unfinished_parents, 0)
+
+    def test_update_unfinished_parents(self):
+        parent = self.create_job()
+        child = self.create_job(parents=[parent])
+        db.session.commit()
+
+        Job.query.filter_by(id=parent.id).update(
+            {"state": WorkState.DONE}, synchronize_session=False)
+        Job.update_unfinished_parents()
+        db.session.commit()
+        self.assertEqual(child.num_unfinished_parents, 0)
+
+    def test_update_unfinished_parents_of_jobs(self):
+        parent = self.create_job()
+        other_parent = self.create_job()
+        child = self.create_job(parents=[parent, other_parent])
+        orphan = self.create_job()
+        unrelated = self.create_job(parents=[other_parent])
+        db.session.commit()
+
+        Job.query.filter_by(id=parent.id).update(
+            {"state": WorkState.DONE}, synchronize_session=False)
+        Job.query.filter(Job.id.in_([orphan.id, unrelated.id])).update(
+            {"num_unfinished_parents": 5}, synchronize_session=False)
+        Job.update_unfinished_parents([child.id, orphan.id])
+        db.session.commit()
+        self.assertEqual(child.num_unfinished_parents, 1)
+        self.assertEqual(orphan.num_unfinished_parents, 0)
+        self.assertEqual(unrelated.num_unfinished_parents, 5)
+
+        Job.query.filter_by(id=other_parent.id).update(
+            {"state": WorkState.DONE}, synchronize_session=False)
+        Job.update_unfinished_parents(select([JobDependency.c.childid]).where(
+            JobDependency.c.parentid == other_parent.id))
+        db.session.commit()
+        self.assertEqual(child.num_unfinished_parents, 0)
+        self.assertEqual(unrelated.num_unfinished_parents, 0)
+        self.assertEqual(orphan.num_unfinished_parents, 0)
+
+
+class TestTaskCounts(BaseTestCase):
+    def setUp(self):
+        super(TestTaskCounts, self).setUp()
+        self.job = create_job(create_jobtype_version(), [None] * 3)
+        self.tasks = self.job.tasks.order_by(Task.frame).all()
+        db.session.commit()
+
+    def counts(self):
+        return self.job.num_active_tasks, self.job.num_failed_tasks
+
+    def test_maintained(self):
+        self.assertEqual(self.counts(), (3, 0))
+
+        self.tasks[0].state = WorkState.DONE
+        self.job.requeue = 0
+        self.tasks[1].agent = create_agent()
+        self.tasks[1].state = WorkState.FAILED
+        db.session.flush()
+        self.assertEqual(self.counts(), (1, 1))
+        db.session.commit()
+        self.assertEqual(self.counts(), (1, 1))
+
+        # The old state is not loaded after the commit
+        self.tasks[1].state = None
+        db.session.commit()
+        self.assertEqual(self.counts(), (2, 0))
+
+        db.session.delete(self.tasks[2])
+        db.session.commit()
+        self.assertEqual(self.counts(), (1, 0))
+
+    def test_update_state(self):
+        self.job.update_state()
+        self.assertIsNone(self.job.state)
+
+        for task in self.tasks:
+            task.state = WorkState.DONE
+        self.job.update_state(new_task_state=WorkState.DONE)
+        self.assertEqual(self.job.state, WorkState.DONE)
+
+    def test_verify(self):
+        Task.query.filter_by(id=self.tasks[0].id).update(
+            {"state": WorkState.DONE}, synchronize_session=False)
+        db.session.commit()
+        self.assertEqual(self.counts(), (3, 0))
+
+        self.assertEqual(verify_job_task_counts(), 1)
+        self.assertEqual(self.counts(), (2, 0))
+        self.assertEqual(verify_job_task_counts(), 0)
+
+
+class TestPayload(BaseTestCase):
+    def setUp(self):
+        super(TestPayload, self).setUp()
+        job = create_job(create_jobtype_version(), data={"foo": "bar"},
+                         environ={"PATH": "/bin"})
+        db.session.commit()
+        self.job_id = job.id
+        db.session.remove()
+
+    def test_deferred(self):
+        job = Job.query.filter_by(id=self.job_id).one()
+        self.assertNotIn("data", job.__dict__)
+        self.assertNotIn("environ", job.__dict__)
+
+        # Loading either one loads the other as well
+        self.assertEqual(job.data, {"foo": "bar"})
+        self.assertEqual(job.__dict__["environ"], {"PATH": "/bin"})
+
+    def test_undefer(self):
+        job = Job.query.options(undefer_group("payload")).filter_by(
+            id=self.job_id).one()
+        self.assertEqual(job.__dict__["data"], {"foo": "bar"})
+        self.assertEqual(job.__dict__["environ"], {"PATH": "/bin"})
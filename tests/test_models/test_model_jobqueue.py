@@ -0,0 +1,167 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# test class must be loaded first
+from pyfarm.master.testutil import (
+    BaseTestCase, create_jobtype_version, create_job, create_agent)
+BaseTestCase.build_environment()
+
+from pyfarm.core.enums import WorkState, AgentState
+from pyfarm.master.application import db
+from pyfarm.models.jobqueue import JobQueue, JobQueueClosure
+from pyfarm.models.task import Task
+
+
+class TestJobQueueTree(BaseTestCase):
+    def setUp(self):
+        super(TestJobQueueTree, self).setUp()
+        self.jobtype_version = create_jobtype_version()
+        self.top = JobQueue(name="top")
+        self.middle = JobQueue(name="middle", parent=self.top)
+        self.bottom = JobQueue(name="bottom", parent=self.middle)
+        self.other = JobQueue(name="other")
+        db.session.add_all([self.top, self.middle, self.bottom, self.other])
+        db.session.flush()
+
+    def create_job(self, queue, agents, state=None):
+        job = create_job(
+            self.jobtype_version,
+            [WorkState.RUNNING if agent else None for agent in agents],
+            state, queue=queue)
+        for task, agent in zip(job.tasks.order_by(Task.frame), agents):
+            if agent:
+                Task.query.filter_by(id=task.id).update(
+                    {"agent_id": agent.id}, synchronize_session=False)
+        return job
+
+    def test_tree(self):
+        agent1 = create_agent(1, state=AgentState.RUNNING)
+        agent2 = create_agent(2, state=AgentState.RUNNING)
+        offline = create_agent(3, state=AgentState.OFFLINE)
+        self.create_job(self.bottom, [agent1, agent1, None],
+                        state=WorkState.RUNNING)
+        self.create_job(self.middle, [agent2, offline],
+                        state=WorkState.RUNNING)
+        self.create_job(self.middle, [None], state=WorkState.DONE)
+        self.create_job(self.other, [None])
+        db.session.commit()
+
+        tree = JobQueue.tree()
+        self.assertEqual(
+            set(tree), set([self.top.id, self.middle.id, self.bottom.id,
+                            self.other.id]))
+        self.assertEqual(tree[self.bottom.id]["path"], "/top/middle/bottom")
+        self.assertEqual(tree[self.bottom.id]["parent_id"], self.middle.id)
+        self.assertEqual(
+            [tree[x.id]["num_assigned_agents"] for x in
+             (self.top, self.middle, self.bottom, self.other)], [2, 2, 1, 0])
+        self.assertEqual(
+            [tree[x.id]["num_runnable_jobs"] for x in
+             (self.top, self.middle, self.bottom, self.other)], [2, 2, 1, 1])
+
+        self.assertEqual(self.top.num_assigned_agents(), 2)
+        self.assertEqual(self.other.num_assigned_agents(), 0)
+
+    def test_path(self):
+        self.assertEqual(self.bottom.fullpath, "/top/middle/bottom")
+
+        # Without a cached path it is looked up through the closure table
+        JobQueue.query.update({"fullpath": None}, synchronize_session=False)
+        db.session.commit()
+        self.assertIsNone(self.bottom.fullpath)
+        self.assertEqual(self.bottom.path(), "/top/middle/bottom")
+        self.assertEqual(self.top.path(), "/top")
+
+
+class TestJobQueueClosure(BaseTestCase):
+    def closure(self):
+        return sorted(tuple(x) for x in db.session.execute(
+            JobQueueClosure.select()))
+
+    def test_insert(self):
+        top = JobQueue(name="top")
+        child = JobQueue(name="child", parent=top)
+        db.session.add_all([top, child])
+        db.session.commit()
+
+        self.assertEqual(self.closure(), [
+            (top.id, top.id, 0), (top.id, child.id, 1),
+            (child.id, child.id, 0)])
+        self.assertEqual(child.fullpath, "/top/child")
+
+    def test_move_and_rename(self):
+        top = JobQueue(name="top")
+        other = JobQueue(name="other")
+        middle = JobQueue(name="middle", parent=top)
+        bottom = JobQueue(name="bottom", parent=middle)
+        db.session.add_all([top, other, middle, bottom])
+        db.session.commit()
+
+        middle.parent = other
+        db.session.commit()
+        self.assertEqual(bottom.fullpath, "/other/middle/bottom")
+        self.assertIn((other.id, bottom.id, 2), self.closure())
+        self.assertNotIn((top.id, bottom.id, 2), self.closure())
+
+        other.name = "renamed"
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(bottom.fullpath, "/renamed/middle/bottom")
+        self.assertEqual(JobQueue.check_closure(), {
+            "missing": [], "unexpected": [], "stale_paths": []})
+
+    def test_move_below_itself(self):
+        top = JobQueue(name="top")
+        child = JobQueue(name="child", parent=top)
+        db.session.add_all([top, child])
+        db.session.commit()
+
+        top.parent = child
+        with self.assertRaises(ValueError):
+            db.session.commit()
+
+    def test_delete(self):
+        top = JobQueue(name="top")
+        child = JobQueue(name="child", parent=top)
+        db.session.add_all([top, child])
+        db.session.commit()
+
+        db.session.delete(child)
+        db.session.commit()
+        self.assertEqual(self.closure(), [(top.id, top.id, 0)])
+
+    def test_check_and_rebuild(self):
+        top = JobQueue(name="top")
+        child = JobQueue(name="child", parent=top)
+        db.session.add_all([top, child])
+        db.session.commit()
+
+        db.session.execute(JobQueueClosure.delete().where(
+            JobQueueClosure.c.ancestor_id == top.id))
+        JobQueue.query.filter_by(id=child.id).update(
+            {"fullpath": "/wrong"}, synchronize_session=False)
+        db.session.commit()
+
+        problems = JobQueue.check_closure()
+        self.assertEqual(problems["missing"], [
+            (top.id, top.id, 0), (top.id, child.id, 1)])
+        self.assertEqual(problems["unexpected"], [])
+        self.assertEqual(problems["stale_paths"], [child.id])
+
+        self.assertEqual(JobQueue.rebuild_closure(), 3)
+        db.session.commit()
+        self.assertEqual(JobQueue.check_closure(), {
+            "missing": [], "unexpected": [], "stale_paths": []})
@@ -18,12 +18,14 @@ import time
 import uuid
 from datetime import datetime, timedelta
 
+from sqlalchemy import event
+
 # test class must be loaded first
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
 from pyfarm.master.application import db, login_serializer
-from pyfarm.models.user import User, Role
+from pyfarm.models.user import User, Role, principals
 
 
 class UserTest(BaseTestCase):
@@ -124,6 +126,45 @@ class UserTest(BaseTestCase):
             user.has_roles(required=[roles[0].name, roles[1].name, "foo"]))
 
 
+    def test_principal_cache(self):
+        user = User.create(uuid.uuid4().hex, uuid.uuid4().hex,
+                           roles=["render"])
+        user_id = user.id
+        db.session.remove()
+        principals.clear()
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            cached = User.get_cached(user_id)
+            self.assertTrue(cached.is_active())
+            self.assertTrue(cached.has_roles(allowed=["render", "admin"]))
+            self.assertFalse(cached.has_roles(required=["render", "admin"]))
+            self.assertEqual(len(statements), 1)
+
+            db.session.remove()
+            cached = User.get_cached(str(user_id))
+            self.assertTrue(cached.is_active())
+            self.assertEqual(len(statements), 1)
+        finally:
+            event.remove(
+                db.engine, "before_cursor_execute", before_cursor_execute)
+        self.assertEqual(cached.username, user.username)
+
+        # Committed changes to the roles are seen right away
+        role = Role.query.filter_by(name="render").one()
+        role.active = False
+        db.session.commit()
+        db.session.remove()
+        self.assertFalse(User.get_cached(user_id).is_active())
+
+        self.assertIsNone(User.get_cached(user_id + 1))
+
+
 class RoleTest(BaseTestCase):
     def test_create(self):
         rolename = uuid.uuid4().hex
@@ -0,0 +1,206 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+from json import loads
+
+from pyfarm.master.testutil import (
+    BaseTestCase, create_jobtype_version, create_job, create_agent)
+BaseTestCase.build_environment()
+
+from sqlalchemy import event
+
+from pyfarm.core.enums import WorkState, AgentState
+from pyfarm.master.application import db
+from pyfarm.models.agent import Agent
+from pyfarm.models.job import Job, JobNotifiedUser
+from pyfarm.models.tag import Tag
+from pyfarm.models.task import Task
+from pyfarm.models.user import User
+from pyfarm.scheduler import tasks as scheduler_tasks
+from pyfarm.scheduler.tasks import (
+    sweep_silent_agents, envelope_cache, load_job_envelopes,
+    assignment_message, dispatch_agent_updates)
+
+
+class TestSweepSilentAgents(BaseTestCase):
+    def create_agent(self, number, last_heard_from, state=AgentState.RUNNING):
+        return create_agent(number, state=state,
+                            last_heard_from=last_heard_from)
+
+    def test_sweep(self):
+        now = datetime.utcnow()
+        silent = self.create_agent(1, now - timedelta(hours=1))
+        recent = self.create_agent(2, now - timedelta(seconds=10))
+        disabled = self.create_agent(3, now - timedelta(hours=1),
+                                     state=AgentState.DISABLED)
+        never_heard_from = self.create_agent(4, None)
+
+        job = create_job(create_jobtype_version(), [WorkState.RUNNING] * 2)
+        tasks = job.tasks.order_by(Task.frame).all()
+        for task, agent in zip(tasks, [silent, recent]):
+            Task.query.filter_by(id=task.id).update(
+                {"agent_id": agent.id}, synchronize_session=False)
+        db.session.commit()
+
+        sweep_silent_agents()
+
+        self.assertEqual(
+            [agent.state for agent in (silent, recent, disabled,
+                                       never_heard_from)],
+            [AgentState.OFFLINE, AgentState.RUNNING, AgentState.DISABLED,
+             AgentState.RUNNING])
+        self.assertEqual([task.agent_id for task in tasks],
+                         [None, recent.id])
+        self.assertEqual([task.state for task in tasks],
+                         [None, WorkState.RUNNING])
+
+    def test_sweep_heard_from_meanwhile(self):
+        now = datetime.utcnow()
+        agent = self.create_agent(1, now - timedelta(hours=1))
+        db.session.commit()
+
+        selected = []
+
+        def after_cursor_execute(conn, cursor, statement, *args):
+            # The agent is heard from right after it was selected
+            if statement.startswith("SELECT") and not selected:
+                selected.append(statement)
+                conn.execute(Agent.__table__.update().where(
+                    Agent.id == agent.id).values(last_heard_from=now))
+
+        event.listen(db.engine, "after_cursor_execute", after_cursor_execute)
+        try:
+            sweep_silent_agents()
+        finally:
+            event.remove(
+                db.engine, "after_cursor_execute", after_cursor_execute)
+
+        db.session.expire_all()
+        self.assertEqual(agent.state, AgentState.RUNNING)
+
+
+class TestDispatchAgentUpdates(BaseTestCase):
+    def setUp(self):
+        super(TestDispatchAgentUpdates, self).setUp()
+        self.original_max = scheduler_tasks.AGENT_UPDATE_MAX_CONCURRENT
+        scheduler_tasks.AGENT_UPDATE_MAX_CONCURRENT = 3
+
+    def tearDown(self):
+        scheduler_tasks.AGENT_UPDATE_MAX_CONCURRENT = self.original_max
+        super(TestDispatchAgentUpdates, self).tearDown()
+
+    def create_agent(self, number, version="1.0", update_requested=None,
+                     state=AgentState.RUNNING):
+        return create_agent(number, state=state, version=version,
+                            upgrade_to="2.0",
+                            update_requested=update_requested)
+
+    def test_dispatch(self):
+        now = datetime.utcnow()
+        in_progress = self.create_agent(1, update_requested=now)
+        timed_out = self.create_agent(
+            2, update_requested=now - timedelta(hours=1))
+        waiting = [self.create_agent(number) for number in (3, 4)]
+        updated = self.create_agent(5, version="2.0")
+        offline = self.create_agent(6, state=AgentState.OFFLINE)
+        db.session.commit()
+
+        # One update is in progress, so only two more are started and the
+        # agents which were never asked go first
+        dispatch_agent_updates()
+        db.session.expire_all()
+        self.assertEqual(
+            [agent.update_requested is not None and
+             agent.update_requested > now for agent in
+             (in_progress, timed_out, waiting[0], waiting[1], updated,
+              offline)],
+            [False, False, True, True, False, False])
+
+        dispatch_agent_updates()
+        db.session.expire_all()
+        self.assertLess(timed_out.update_requested, now)
+
+        # Once an agent has reported the new version its slot is free again
+        in_progress.version = "2.0"
+        db.session.commit()
+        dispatch_agent_updates()
+        db.session.expire_all()
+        self.assertGreater(timed_out.update_requested, now)
+
+
+class TestJobEnvelopes(BaseTestCase):
+    def setUp(self):
+        super(TestJobEnvelopes, self).setUp()
+        envelope_cache.clear()
+        self.job = create_job(create_jobtype_version(), data={"foo": "bar"},
+                              tags=[Tag(tag="linux")])
+        self.user = User(username="user", password="password")
+        db.session.add_all([self.job, JobNotifiedUser(
+            job=self.job, user=self.user, on_deletion=True)])
+        db.session.commit()
+
+    def envelope(self):
+        return loads(load_job_envelopes([self.job.id])[self.job.id])
+
+    def test_envelope(self):
+        envelope = self.envelope()
+        self.assertEqual(envelope["jobtype"], {"name": "foo", "version": 1})
+        self.assertEqual(envelope["job"]["title"], "Test Job")
+        self.assertEqual(envelope["job"]["data"], {"foo": "bar"})
+        self.assertEqual(envelope["job"]["environ"], {})
+        self.assertEqual(envelope["job"]["tags"], ["linux"])
+        self.assertEqual(envelope["job"]["notified_users"], [
+            {"username": "user", "on_success": True, "on_failure": True,
+             "on_deletion": True}])
+
+        task = Task(job=self.job, frame=1)
+        db.session.add(task)
+        db.session.commit()
+        message = loads(assignment_message(
+            load_job_envelopes([self.job.id])[self.job.id], [task]))
+        self.assertEqual(message["job"], envelope["job"])
+        self.assertEqual(message["tasks"], [
+            {"id": task.id, "frame": 1, "attempt": 0, "tile": None}])
+
+    def test_cached_until_changed(self):
+        self.envelope()
+        version = self.job.envelope_version
+        self.assertIsNotNone(envelope_cache.get(self.job.id, version))
+
+        # Changes which are not sent to agents leave the version alone
+        self.job.weight = 5
+        db.session.commit()
+        self.assertEqual(self.job.envelope_version, version)
+
+        self.job.priority = 5
+        db.session.commit()
+        self.assertEqual(self.envelope()["job"]["priority"], 5)
+
+        self.job.tags.append(Tag(tag="windows"))
+        db.session.commit()
+        self.assertEqual(
+            sorted(self.envelope()["job"]["tags"]), ["linux", "windows"])
+
+        db.session.delete(JobNotifiedUser.query.filter_by(job=self.job).one())
+        db.session.commit()
+        self.assertEqual(self.envelope()["job"]["notified_users"], [])
+
+        Job.query.filter_by(id=self.job.id).update(
+            {"title": "Renamed"}, synchronize_session=False)
+        Job.bump_envelope_version([self.job.id])
+        db.session.commit()
+        self.assertEqual(self.envelope()["job"]["title"], "Renamed")
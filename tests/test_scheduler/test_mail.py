@@ -0,0 +1,279 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncore
+import re
+import smtpd
+from datetime import datetime
+from email import message_from_string
+from threading import Thread
+from time import sleep
+from unittest import TestCase, skipUnless
+
+from pyfarm.master.testutil import (
+    BaseTestCase, create_jobtype_version, create_job)
+BaseTestCase.build_environment()
+
+from sqlalchemy import event
+
+from pyfarm.core.enums import WorkState
+from pyfarm.master.application import db
+from pyfarm.models.job import Job, JobNotifiedUser
+from pyfarm.models.task import Task
+from pyfarm.models.tasklog import TaskLog, TaskTaskLogAssociation
+from pyfarm.models.user import User, PendingNotification
+from pyfarm.scheduler import tasks
+from pyfarm.scheduler.mail import MailDispatcher, compiled_template
+from pyfarm.scheduler.tasks import (
+    send_job_completion_mail, send_job_deletion_mail, send_mail_digests,
+    failed_task_logs)
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """
+    SMTP server running in a background thread which keeps the messages it
+    receives along with the client address they were sent from
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.running = True
+        self.thread = Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.01, count=1)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        self.messages.append((peer, rcpttos, message_from_string(data)))
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.close()
+        for channel in list(asyncore.socket_map.values()):
+            channel.close()
+
+    @property
+    def connections(self):
+        return len(set(peer for peer, _, _ in self.messages))
+
+
+class TestMailDispatcher(TestCase):
+    def setUp(self):
+        self.server = LocalSMTPServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def dispatcher(self, **kwargs):
+        return MailDispatcher("127.0.0.1", port=self.server.port, **kwargs)
+
+    def test_reuses_connection(self):
+        dispatcher = self.dispatcher()
+        for i in range(3):
+            dispatcher.send("pyfarm@localhost", ["user@localhost"],
+                            "Subject: %s\n\nbody" % i)
+        dispatcher.close()
+
+        self.assertEqual(
+            [message["Subject"] for _, _, message in self.server.messages],
+            ["0", "1", "2"])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnects(self):
+        dispatcher = self.dispatcher()
+        dispatcher.send("pyfarm@localhost", ["user@localhost"], "first")
+
+        # Looks like a connection the server has dropped
+        dispatcher.smtp.close()
+        dispatcher.send("pyfarm@localhost", ["user@localhost"], "second")
+        dispatcher.close()
+
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_idle_connection_replaced(self):
+        dispatcher = self.dispatcher(max_idle=0)
+        dispatcher.send("pyfarm@localhost", ["user@localhost"], "first")
+        sleep(0.01)
+        dispatcher.send("pyfarm@localhost", ["user@localhost"], "second")
+        dispatcher.close()
+
+        self.assertEqual(self.server.connections, 2)
+
+    def test_compiled_template(self):
+        template = compiled_template("{{ foo }}")
+        self.assertIs(compiled_template("{{ foo }}"), template)
+        self.assertEqual(template.render(foo="bar"), "bar")
+
+
+class TestNotificationMail(BaseTestCase):
+    def setUp(self):
+        super(TestNotificationMail, self).setUp()
+        self.server = LocalSMTPServer()
+        self.original_address = (tasks.mailer.server, tasks.mailer.port)
+        tasks.mailer.server = "127.0.0.1"
+        tasks.mailer.port = self.server.port
+
+        self.job = create_job(create_jobtype_version(),
+                              time_finished=datetime.utcnow())
+        self.now_user = User(username="now", password="password",
+                             email="now@localhost")
+        self.digest_user = User(username="digest", password="password",
+                                email="digest@localhost", mail_digest=True)
+        db.session.add_all([
+            self.job,
+            JobNotifiedUser(job=self.job, user=self.now_user,
+                            on_deletion=True),
+            JobNotifiedUser(job=self.job, user=self.digest_user,
+                            on_deletion=True)])
+        db.session.commit()
+
+    def tearDown(self):
+        tasks.mailer.close()
+        tasks.mailer.server, tasks.mailer.port = self.original_address
+        self.server.stop()
+        super(TestNotificationMail, self).tearDown()
+
+    def test_completion_and_digest(self):
+        send_job_completion_mail(self.job.id, True)
+
+        self.assertEqual(len(self.server.messages), 1)
+        _, to, message = self.server.messages[0]
+        self.assertEqual(to, ["now@localhost"])
+        self.assertEqual(message["Subject"],
+                         "Job Test Job completed successfully")
+        self.assertEqual(
+            [x.subject for x in PendingNotification.query.filter_by(
+                user=self.digest_user)],
+            ["Job Test Job completed successfully"])
+
+        send_job_deletion_mail(self.job.id, "foo", "Test Job",
+                               ["now@localhost", "digest@localhost",
+                                "other@localhost"])
+        self.assertEqual(self.server.messages[-1][1],
+                         ["other@localhost", "now@localhost"])
+        self.assertEqual(PendingNotification.query.count(), 2)
+
+        send_mail_digests()
+        _, to, message = self.server.messages[-1]
+        self.assertEqual(to, ["digest@localhost"])
+        self.assertEqual(message["Subject"], "2 job notifications")
+        self.assertIn("Job Test Job completed successfully",
+                      message.get_payload())
+        self.assertEqual(PendingNotification.query.count(), 0)
+
+        # All mail went over one connection
+        self.assertEqual(self.server.connections, 1)
+
+    def create_failed_tasks(self, logs):
+        """
+        Creates a failed task for each item of ``logs``, a list of
+        the log identifiers for each attempt of the task
+        """
+        failed_tasks = []
+        for frame, identifiers in enumerate(logs):
+            task = Task(job=self.job, frame=frame)
+            db.session.add(task)
+            db.session.flush()
+            Task.query.filter_by(id=task.id).update(
+                {"state": WorkState.FAILED}, synchronize_session=False)
+            for attempt, identifier in enumerate(identifiers, 1):
+                db.session.add(TaskTaskLogAssociation(
+                    log=TaskLog(identifier=identifier), task=task,
+                    attempt=attempt))
+            failed_tasks.append(task)
+        Job.update_task_counts([self.job.id])
+        db.session.commit()
+        return failed_tasks
+
+    def test_failed_task_logs(self):
+        failed_tasks = self.create_failed_tasks(
+            [["first.log", "second.log"], [], ["third.log"]])
+
+        self.assertEqual(failed_task_logs(self.job.id), [
+            (failed_tasks[2].id, 2, 1, "third.log"),
+            (failed_tasks[1].id, 1, None, None),
+            (failed_tasks[0].id, 0, 2, "second.log")])
+        self.assertEqual(failed_task_logs(self.job.id, limit=1), [
+            (failed_tasks[2].id, 2, 1, "third.log")])
+
+    @skipUnless(tasks.supports_window_functions(db.engine),
+                "window functions are not supported by the database")
+    def test_failed_task_logs_with_window_functions(self):
+        failed_tasks = self.create_failed_tasks(
+            [["first.log", "second.log"], ["third.log"], ["fourth.log"]])
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute",
+                     before_cursor_execute)
+        try:
+            logs = failed_task_logs(self.job.id, limit=2)
+        finally:
+            event.remove(
+                db.engine, "before_cursor_execute", before_cursor_execute)
+
+        self.assertEqual(logs, [
+            (failed_tasks[2].id, 2, 1, "fourth.log"),
+            (failed_tasks[1].id, 1, 1, "third.log")])
+        ranked = [statement for statement in statements
+                  if "row_number" in statement.lower()]
+        self.assertEqual(len(ranked), 1)
+        self.assertIsNone(re.search(r"\brank\b", ranked[0], re.I))
+
+    def test_failed_task_logs_without_window_functions(self):
+        failed_tasks = self.create_failed_tasks(
+            [["first.log", "second.log"], [], ["third.log"]])
+        expected = failed_task_logs(self.job.id)
+
+        original = tasks.supports_window_functions
+        tasks.supports_window_functions = lambda engine: False
+        try:
+            self.assertEqual(failed_task_logs(self.job.id), expected)
+            self.assertEqual(failed_task_logs(self.job.id, limit=2), [
+                (failed_tasks[2].id, 2, 1, "third.log"),
+                (failed_tasks[1].id, 1, None, None)])
+        finally:
+            tasks.supports_window_functions = original
+
+    def test_failed_log_urls(self):
+        failed_tasks = self.create_failed_tasks(
+            [["first.log", "second.log"], ["third.log"], ["fourth.log"]])
+        original_limit = tasks.MAX_FAILED_TASKS_IN_MAIL
+        tasks.MAX_FAILED_TASKS_IN_MAIL = 2
+        try:
+            send_job_completion_mail(self.job.id, False)
+        finally:
+            tasks.MAX_FAILED_TASKS_IN_MAIL = original_limit
+
+        _, _, message = self.server.messages[0]
+        body = message.get_payload()
+        self.assertIn("/tasks/%s/attempts/1/logs/fourth.log/logfile" %
+                      failed_tasks[2].id, body)
+        self.assertIn("third.log", body)
+        self.assertNotIn("second.log", body)
+        self.assertNotIn("first.log", body)
+        self.assertIn("and 1 more failed task", body)
@@ -0,0 +1,289 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from datetime import datetime, timedelta
+from random import Random
+from timeit import repeat
+
+from pyfarm.master.testutil import (
+    BaseTestCase, create_jobtype_version, create_job, create_agent)
+BaseTestCase.build_environment()
+
+from sqlalchemy import func
+
+from pyfarm.core.enums import WorkState, AgentState
+from pyfarm.master.application import db
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.statistics.agent_count import AgentCount
+from pyfarm.models.statistics.task_count import TaskCount
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.scheduler.statistics_tasks import (
+    count_agents, count_tasks, consolidate_task_event_counts,
+    consolidate_task_events_for_queue, rollup_agent_counts)
+
+# Timings are only compared when asked for, they are not reliable on shared
+# machines or when the tests run under coverage
+RUN_BENCHMARKS = os.environ.get("PYFARM_RUN_BENCHMARKS") == "1"
+
+
+class TestCountAgents(BaseTestCase):
+    def test_count_agents(self):
+        states = [AgentState.ONLINE, AgentState.ONLINE, AgentState.RUNNING,
+                  AgentState.DISABLED]
+        for i, state in enumerate(states):
+            create_agent(i + 1, state=state)
+        db.session.commit()
+
+        count_agents()
+
+        agent_count = AgentCount.query.one()
+        self.assertEqual(agent_count.resolution, 0)
+        self.assertEqual(
+            (agent_count.num_online, agent_count.num_running,
+             agent_count.num_offline, agent_count.num_disabled),
+            (2, 1, 0, 1))
+
+    def test_rollup_agent_counts(self):
+        now = datetime(2015, 6, 10, 12, 2)
+
+        def add_count(counted_time, num_online):
+            db.session.add(AgentCount(
+                counted_time=counted_time, num_online=num_online,
+                num_running=0, num_offline=0, num_disabled=0))
+
+        # Recent enough to be kept as they are
+        add_count(datetime(2015, 6, 10, 12, 1), 1)
+        add_count(datetime(2015, 6, 10, 11, 1), 2)
+        # Rolled up into five minute periods
+        add_count(datetime(2015, 6, 8, 10, 1), 2)
+        add_count(datetime(2015, 6, 8, 10, 2), 4)
+        add_count(datetime(2015, 6, 8, 10, 6), 2)
+        add_count(datetime(2015, 6, 8, 10, 7), 3)
+        # Rolled up into hours
+        add_count(datetime(2015, 5, 1, 10, 1), 5)
+        add_count(datetime(2015, 5, 1, 10, 59), 7)
+        # Expired
+        add_count(datetime(2013, 1, 1), 10)
+        db.session.commit()
+
+        rollup_agent_counts(now=now)
+
+        self.assertEqual(
+            sorted((x.counted_time, x.resolution, x.num_online)
+                   for x in AgentCount.query), [
+                (datetime(2015, 5, 1, 10), 3600, 6),
+                (datetime(2015, 6, 8, 10), 300, 3),
+                # Halves are always rounded up
+                (datetime(2015, 6, 8, 10, 5), 300, 3),
+                (datetime(2015, 6, 10, 11, 1), 0, 2),
+                (datetime(2015, 6, 10, 12, 1), 0, 1)])
+
+        # Rolled up counts are not touched again
+        rollup_agent_counts(now=now)
+        self.assertEqual(AgentCount.query.count(), 5)
+
+
+class TestCountTasks(BaseTestCase):
+    def test_count_tasks(self):
+        jobtype_version = create_jobtype_version()
+        queue1 = JobQueue(name="queue1")
+        queue2 = JobQueue(name="queue2")
+        empty_queue = JobQueue(name="empty")
+        db.session.add_all([queue1, queue2, empty_queue])
+
+        create_job(jobtype_version,
+                   [None, None, WorkState.RUNNING, WorkState.DONE],
+                   queue=queue1)
+        create_job(jobtype_version, [WorkState.FAILED, WorkState.DONE],
+                   queue=queue1)
+        create_job(jobtype_version, [WorkState.RUNNING] * 3, queue=queue2)
+        create_job(jobtype_version, [None, WorkState.FAILED])
+        db.session.commit()
+
+        count_tasks()
+
+        counts = dict((x.job_queue_id, x) for x in TaskCount.query)
+        self.assertEqual(
+            set(counts), set([queue1.id, queue2.id, empty_queue.id, None]))
+        self.assertEqual(len(set(x.counted_time for x in counts.values())), 1)
+
+        expected = {
+            queue1.id: (2, 1, 2, 1),
+            queue2.id: (0, 3, 0, 0),
+            empty_queue.id: (0, 0, 0, 0),
+            None: (1, 0, 0, 1)}
+        for job_queue_id, task_count in counts.items():
+            self.assertEqual(
+                (task_count.total_queued, task_count.total_running,
+                 task_count.total_done, task_count.total_failed),
+                expected[job_queue_id])
+
+
+class TestCountTasksBenchmark(BaseTestCase):
+    """
+    Benchmark of the ways to count the tasks in each queue on a few
+    thousand tasks spread over many queues: four correlated counts per
+    queue, which is how :func:`count_tasks` used to count them, the single
+    grouped query it uses now and summing up the counters maintained on
+    each job.  The results are always compared, the timings only when
+    ``PYFARM_RUN_BENCHMARKS=1`` is set.
+    """
+    QUEUES = 50
+    JOBS = 250
+    TASKS = 5000
+
+    def setUp(self):
+        super(TestCountTasksBenchmark, self).setUp()
+        jobtype_version = create_jobtype_version()
+        queues = [JobQueue(name="queue%s" % i) for i in range(self.QUEUES)]
+        random = Random(42)
+        jobs = [Job(title="job%s" % i, jobtype_version=jobtype_version,
+                    queue=random.choice(queues + [None]))
+                for i in range(self.JOBS)]
+        db.session.add_all(queues + jobs)
+        db.session.flush()
+
+        # Inserted in bulk, so the task counts of the jobs are updated
+        # afterwards
+        states = [None, WorkState.RUNNING, WorkState.DONE, WorkState.FAILED]
+        db.session.execute(Task.__table__.insert(), [
+            {"job_id": random.choice(jobs).id, "frame": frame,
+             "state": random.choice(states)}
+            for frame in range(self.TASKS)])
+        Job.update_task_counts()
+        db.session.commit()
+
+    def count_per_queue(self):
+        counts = {}
+        for job_queue_id, in db.session.query(JobQueue.id).all() + [(None, )]:
+            counts[job_queue_id] = tuple(
+                Task.query.filter(
+                    Task.job.has(Job.job_queue_id == job_queue_id),
+                    Task.state == state).count()
+                for state in (None, WorkState.RUNNING, WorkState.DONE,
+                              WorkState.FAILED))
+        return counts
+
+    def count_grouped(self):
+        TaskCount.query.delete()
+        count_tasks()
+        return dict(
+            (x.job_queue_id,
+             (x.total_queued, x.total_running, x.total_done, x.total_failed))
+            for x in TaskCount.query)
+
+    def count_from_counters(self):
+        return dict(
+            (job_queue_id, (active, failed)) for job_queue_id, active, failed
+            in db.session.query(
+                Job.job_queue_id, func.sum(Job.num_active_tasks),
+                func.sum(Job.num_failed_tasks)).group_by(Job.job_queue_id))
+
+    def test_count_tasks(self):
+        expected = self.count_per_queue()
+        self.assertEqual(sum(map(sum, expected.values())), self.TASKS)
+        self.assertEqual(self.count_grouped(), expected)
+
+        # The counters do not tell queued and running tasks apart, and
+        # queues without jobs have none
+        counters = self.count_from_counters()
+        self.assertLessEqual(set(counters), set(expected))
+        self.assertEqual(
+            counters,
+            dict((job_queue_id, (queued + running, failed))
+                 for job_queue_id, (queued, running, _, failed)
+                 in expected.items() if job_queue_id in counters))
+
+        if RUN_BENCHMARKS:
+            per_queue = min(repeat(self.count_per_queue, number=1, repeat=3))
+            grouped = min(repeat(self.count_grouped, number=1, repeat=3))
+            counters = min(
+                repeat(self.count_from_counters, number=1, repeat=3))
+            self.assertLess(grouped, per_queue)
+            self.assertLess(counters, grouped)
+
+
+class TestConsolidateTaskEvents(BaseTestCase):
+    now = datetime(2015, 6, 10, 12, 5)
+
+    def add_event_count(self, time_start, job_queue_id=None, **counts):
+        event_count = TaskEventCount(job_queue_id=job_queue_id, **counts)
+        event_count.time_start = time_start
+        event_count.time_end = time_start
+        db.session.add(event_count)
+
+    def counts(self):
+        return sorted(
+            ((x.time_start, x.time_end, x.resolution, x.job_queue_id,
+              x.num_new, x.num_done) for x in TaskEventCount.query),
+            key=lambda count: (count[0], count[3] or 0))
+
+    def test_consolidate(self):
+        self.add_event_count(datetime(2015, 6, 10, 11, 31), num_new=1)
+        self.add_event_count(datetime(2015, 6, 10, 11, 44), num_new=2)
+        self.add_event_count(datetime(2015, 6, 10, 11, 44), job_queue_id=1,
+                             num_done=1)
+        self.add_event_count(datetime(2015, 6, 10, 11, 50), num_new=4)
+        self.add_event_count(datetime(2015, 6, 10, 12, 1), num_new=8)
+        db.session.commit()
+
+        consolidate_task_event_counts(now=self.now)
+
+        self.assertEqual(self.counts(), [
+            (datetime(2015, 6, 10, 11, 30), datetime(2015, 6, 10, 11, 45),
+             900, None, 3, 0),
+            (datetime(2015, 6, 10, 11, 30), datetime(2015, 6, 10, 11, 45),
+             900, 1, 0, 1),
+            (datetime(2015, 6, 10, 11, 45), datetime(2015, 6, 10, 12, 0),
+             900, None, 4, 0),
+            # Still in the current period
+            (datetime(2015, 6, 10, 12, 1), datetime(2015, 6, 10, 12, 1),
+             0, None, 8, 0)])
+
+        # Consolidated counts are left alone by the next run
+        consolidate_task_event_counts(now=self.now)
+        self.assertEqual(len(self.counts()), 4)
+
+    def test_rollups_and_retention(self):
+        self.add_event_count(datetime(2015, 6, 7, 10, 1), num_new=1)
+        self.add_event_count(datetime(2015, 6, 7, 10, 59), num_new=2)
+        self.add_event_count(datetime(2015, 5, 1, 3, 0), num_new=4)
+        self.add_event_count(datetime(2015, 5, 1, 23, 0), num_new=8)
+        self.add_event_count(datetime(2013, 1, 1), num_new=16)
+        db.session.commit()
+
+        consolidate_task_event_counts(now=self.now)
+
+        self.assertEqual(self.counts(), [
+            (datetime(2015, 5, 1), datetime(2015, 5, 2), 86400, None, 12, 0),
+            (datetime(2015, 6, 7, 10), datetime(2015, 6, 7, 11), 3600, None,
+             3, 0)])
+
+    def test_consolidate_for_queue(self):
+        time_start = datetime.utcnow() - timedelta(hours=1)
+        self.add_event_count(time_start, num_new=1)
+        self.add_event_count(time_start, job_queue_id=1, num_new=2)
+        db.session.commit()
+
+        consolidate_task_events_for_queue(1)
+
+        self.assertEqual(
+            sorted(((x.job_queue_id or 0, x.resolution)
+                    for x in TaskEventCount.query)),
+            [(0, 0), (1, 900)])
@@ -0,0 +1,89 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from io import BytesIO
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from pyfarm.master.testutil import (
+    BaseTestCase, InMemoryTaskLogStorage, create_jobtype_version, create_job)
+BaseTestCase.build_environment()
+
+from pyfarm.master import tasklog_storage
+from pyfarm.master.application import db
+from pyfarm.master.tasklog_storage import ShardedTaskLogStorage
+from pyfarm.models.tasklog import TaskLog, TaskTaskLogAssociation
+from pyfarm.scheduler.tasks import (
+    clean_up_orphaned_task_logs, compress_task_log)
+
+dummy_log = b"1,test log entry\n2,another test log entry\n"
+
+
+class TestTaskLogTasks(BaseTestCase):
+    def create_storage(self):
+        root = mkdtemp()
+        self.addCleanup(rmtree, root)
+        return ShardedTaskLogStorage(root)
+
+    def setUp(self):
+        super(TestTaskLogTasks, self).setUp()
+        self.original_storage = tasklog_storage._storage
+        self.storage = tasklog_storage._storage = self.create_storage()
+
+        self.task = create_job(create_jobtype_version(), [None]).tasks.one()
+        db.session.commit()
+
+    def tearDown(self):
+        tasklog_storage._storage = self.original_storage
+        super(TestTaskLogTasks, self).tearDown()
+
+    def test_clean_up_orphaned_task_logs(self):
+        db.session.add_all([
+            TaskTaskLogAssociation(
+                log=TaskLog(identifier="kept.csv"), task=self.task,
+                attempt=1),
+            TaskLog(identifier="orphaned.csv")])
+        db.session.commit()
+        for identifier in ("kept.csv", "orphaned.csv", "unknown.csv",
+                           "compressed.csv"):
+            self.storage.write(identifier, BytesIO(dummy_log))
+        self.storage.compress("compressed.csv")
+
+        clean_up_orphaned_task_logs()
+
+        self.assertEqual(list(self.storage.iter_logs()),
+                         [("kept.csv", False)])
+        self.assertEqual(
+            [log.identifier for log in TaskLog.query], ["kept.csv"])
+
+    def test_compress_task_log(self):
+        self.storage.write("testlog.csv", BytesIO(dummy_log))
+
+        compress_task_log("testlog.csv")
+
+        self.assertEqual(list(self.storage.iter_logs()),
+                         [("testlog.csv", True)])
+        logfile = self.storage.open_compressed("testlog.csv")
+        self.assertEqual(logfile.read(), dummy_log)
+        logfile.close()
+
+        with self.assertRaises(IOError):
+            compress_task_log("missing.csv")
+
+
+class TestTaskLogTasksInMemoryStorage(TestTaskLogTasks):
+    def create_storage(self):
+        return InMemoryTaskLogStorage()